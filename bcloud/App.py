@@ -38,6 +38,7 @@ from bcloud.SharePage import SharePage
 from bcloud.SigninDialog import SigninDialog
 from bcloud.TrashPage import TrashPage
 from bcloud.UploadPage import UploadPage
+from bcloud.TransferScheduler import BandwidthLimiter, TransferScheduler
 from bcloud.FileWatcher import WatchFileChange
 
 try:
@@ -274,6 +275,8 @@ class App:
                 if self.profile['use-status-icon'] and not self.status_icon:
                     self.init_status_icon()
                 self.set_dark_theme(self.profile['use-dark-theme'])
+                self.transfer_scheduler.set_max_conns(
+                        self.profile['transfer-connections'])
 
     def on_signout_action_activated(self, action, params):
         '''在退出登录前, 应该保存当前用户的所有数据'''
@@ -338,6 +341,9 @@ class App:
                                        page.tooltip, self.default_color])
 
         self.default_color = self.get_default_color()
+        self.transfer_scheduler = TransferScheduler(
+                self.profile['transfer-connections'])
+        self.bandwidth_limiter = BandwidthLimiter(self.profile)
         self.nav_liststore.clear()
         children = self.notebook.get_children()
         for child in children:
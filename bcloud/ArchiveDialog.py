@@ -0,0 +1,113 @@
+
+# Copyright (C) 2014-2015 LiuLang <gsushzhsosgsu@gmail.com>
+# Use of this source code is governed by GPLv3 license that can be found
+# in http://www.gnu.org/licenses/gpl-3.0.html
+
+import math
+
+from gi.repository import Gtk
+from gi.repository import Pango
+
+from bcloud import Config
+_ = Config._
+
+PAGE_SIZE = 100  # 每页显示的任务数
+
+
+class ArchiveDialog(Gtk.Dialog):
+    '''分页显示已完成的任务.
+
+    已完成的任务被移到了数据库的存档表里, 启动时不会被读入, 只在打开这个
+    对话框时才按页查询.
+    '''
+
+    def __init__(self, parent, app, title, db, table, columns):
+        '''
+        db      - TaskDB
+        table   - 存档表的名字
+        columns - [(标题, 数据库中的列名), ], 第一列会被拉伸
+        '''
+        super().__init__(title, app.window, Gtk.DialogFlags.MODAL,
+                         (Gtk.STOCK_CLOSE, Gtk.ResponseType.CLOSE))
+        self.set_default_response(Gtk.ResponseType.CLOSE)
+        self.set_default_size(800, 520)
+        self.set_border_width(10)
+
+        self.db = db
+        self.table = table
+        self.columns = columns
+        self.page = 0
+        self.pages = 1
+
+        box = self.get_content_area()
+
+        control_box = Gtk.Box(spacing=5)
+        box.pack_start(control_box, False, False, 0)
+
+        self.prev_button = Gtk.Button.new_with_label(_('Previous'))
+        self.prev_button.connect('clicked', self.on_prev_button_clicked)
+        control_box.pack_start(self.prev_button, False, False, 0)
+
+        self.next_button = Gtk.Button.new_with_label(_('Next'))
+        self.next_button.connect('clicked', self.on_next_button_clicked)
+        control_box.pack_start(self.next_button, False, False, 0)
+
+        self.page_label = Gtk.Label()
+        control_box.pack_start(self.page_label, False, False, 5)
+
+        clear_button = Gtk.Button.new_with_label(_('Clear'))
+        clear_button.set_tooltip_text(_('Remove all finished tasks'))
+        clear_button.connect('clicked', self.on_clear_button_clicked)
+        control_box.pack_end(clear_button, False, False, 0)
+
+        scrolled_win = Gtk.ScrolledWindow()
+        box.pack_start(scrolled_win, True, True, 5)
+
+        self.liststore = Gtk.ListStore(*[str for column in columns])
+        treeview = Gtk.TreeView(model=self.liststore)
+        treeview.set_headers_clickable(True)
+        scrolled_win.add(treeview)
+        for index, (heading, name) in enumerate(columns):
+            cell = Gtk.CellRendererText(ellipsize=Pango.EllipsizeMode.END,
+                                        ellipsize_set=True)
+            col = Gtk.TreeViewColumn(heading, cell, text=index)
+            col.set_resizable(True)
+            if index == 0:
+                col.set_expand(True)
+            treeview.append_column(col)
+
+        box.show_all()
+        self.load()
+
+    def load(self):
+        count = self.db.query('SELECT COUNT(*) FROM {0}'.format(self.table))
+        total = count[0][0] if count else 0
+        self.pages = max(1, math.ceil(total / PAGE_SIZE))
+        self.page = min(self.page, self.pages - 1)
+        names = ', '.join(name for heading, name in self.columns)
+        sql = 'SELECT {0} FROM {1} ORDER BY rowid DESC LIMIT ? OFFSET ?'
+        sql = sql.format(names, self.table)
+        rows = self.db.query(sql, [PAGE_SIZE, self.page * PAGE_SIZE])
+        self.liststore.clear()
+        for row in rows:
+            self.liststore.append([str(value) for value in row])
+        self.page_label.set_text(_('Page {0} of {1} ({2} tasks)').format(
+                self.page + 1, self.pages, total))
+        self.prev_button.set_sensitive(self.page > 0)
+        self.next_button.set_sensitive(self.page < self.pages - 1)
+
+    def on_prev_button_clicked(self, button):
+        if self.page > 0:
+            self.page -= 1
+            self.load()
+
+    def on_next_button_clicked(self, button):
+        if self.page < self.pages - 1:
+            self.page += 1
+            self.load()
+
+    def on_clear_button_clicked(self, button):
+        self.db.execute('DELETE FROM {0}'.format(self.table))
+        self.db.flush()
+        self.page = 0
+        self.load()
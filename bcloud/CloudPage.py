@@ -139,6 +139,7 @@ class CloudPage(Gtk.Box):
         # status, status_name, percent, human_size, tooltip
         self.liststore = Gtk.ListStore(str, str, str, str, GObject.TYPE_INT64,
                                        GObject.TYPE_INT64, int, str, int, str, str)
+        self.row_index = gutil.RowIndex(self.liststore, TASKID_COL)
         self.treeview = Gtk.TreeView(model=self.liststore)
         self.treeview.set_headers_clickable(True)
         self.treeview.set_reorderable(True)
@@ -190,7 +191,7 @@ class CloudPage(Gtk.Box):
                 return
             tasks = info['task_info']
             for task in tasks:
-                self.liststore.append([
+                self.row_index.append([
                     task['task_id'],
                     task['task_name'],
                     task['save_path'],
@@ -223,10 +224,7 @@ class CloudPage(Gtk.Box):
 
     def get_row_by_task_id(self, task_id):
         '''返回这个任务的TreeModelRow, 如果不存在, 就返回None.'''
-        for row in self.liststore:
-            if row and row[TASKID_COL] == task_id:
-                return row
-        return None
+        return self.row_index.get(task_id)
 
     def scan_tasks(self):
         '''定期获取离线下载任务的信息, 比如10秒钟'''
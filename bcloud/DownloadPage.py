@@ -3,11 +3,12 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in http://www.gnu.org/licenses/gpl-3.0.html
 
+import collections
 import json
 import os
-import sqlite3
 import threading
 import time
+import traceback
 
 from gi.repository import Gdk
 from gi.repository import Gio
@@ -16,21 +17,33 @@ from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Pango
 
+from bcloud.ArchiveDialog import ArchiveDialog
 from bcloud import Config
 _ = Config._
-from bcloud.Downloader import Downloader, get_tmp_filepath
+from bcloud.Downloader import Downloader, LinkCache, get_tmp_filepath
+from bcloud.Downloader import LINK_PREFETCH_NUM
 from bcloud import gutil
 from bcloud import pcs
 from bcloud import util
 from bcloud.const import State
+from bcloud.log import logger
 from bcloud.Shutdown import Shutdown
+from bcloud.TaskDB import TaskDB
 
 
 TASK_FILE = 'tasks.sqlite'
+ARCHIVE_TABLE = 'tasks_archive'  # 已完成的任务
+ARCHIVE_QUERY_NUM = 500  # 每次最多在存档表中查询500个文件, SQLite 限制了参数个数
 RUNNING_STATES = (State.FINISHED, State.DOWNLOADING, State.WAITING)
 (NAME_COL, PATH_COL, FSID_COL, SIZE_COL, CURRSIZE_COL, LINK_COL,
     ISDIR_COL, SAVENAME_COL, SAVEDIR_COL, STATE_COL, STATENAME_COL,
-    HUMANSIZE_COL, PERCENT_COL, TOOLTIP_COL) = list(range(14))
+    HUMANSIZE_COL, PERCENT_COL, TOOLTIP_COL, PRIORITY_COL) = list(range(15))
+
+# 不超过16M 的文件走小文件通道, 它有单独的并发数, 不会被大文件堵住
+SMALL_FILE_SIZE = 16 * 2 ** 20
+SMALL_LANE, BULK_LANE = 0, 1
+# 任务的优先级
+PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW = 1, 0, -1
 
 StateNames = (
     _('DOWNLOADING'),
@@ -95,8 +108,8 @@ class DownloadPage(Gtk.Box):
     first_run = True
     retry_tasks = []
     workers = {}                    # { `fs_id': (worker,row) }
+    worker_lanes = {}               # { `fs_id': SMALL_LANE/BULK_LANE }
     app_infos = {}                  # { `fs_id': app }
-    commit_count = 0
     download_speed_received = 0     # size of received data
     download_speed_sid = 0          # signal id
     DOWNLOAD_SPEED_INTERVAL = 3000  # update download speed every 3s
@@ -105,6 +118,11 @@ class DownloadPage(Gtk.Box):
         super().__init__(orientation=Gtk.Orientation.VERTICAL)
         self.app = app
         self.shutdown = Shutdown()
+        self.link_cache = LinkCache()
+        self.progress = gutil.ProgressAggregator(self.on_progress)
+        # 等待中的任务, 按优先级排序
+        self.small_queue = gutil.TaskHeap()
+        self.bulk_queue = gutil.TaskHeap()
 
         if Config.GTK_GE_312:
             self.headerbar = Gtk.HeaderBar()
@@ -145,6 +163,14 @@ class DownloadPage(Gtk.Box):
                                        self.on_open_folder_button_clicked)
             self.headerbar.pack_start(open_folder_button)
 
+            archive_button = Gtk.Button()
+            archive_img = Gtk.Image.new_from_icon_name(
+                    'document-open-recent-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
+            archive_button.set_image(archive_img)
+            archive_button.set_tooltip_text(_('Finished tasks'))
+            archive_button.connect('clicked', self.on_archive_button_clicked)
+            self.headerbar.pack_start(archive_button)
+
             shutdown_button = Gtk.ToggleButton()
             shutdown_img = Gtk.Image.new_from_icon_name(
                     'system-shutdown-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
@@ -199,6 +225,10 @@ class DownloadPage(Gtk.Box):
             open_folder_button.props.margin_left = 40
             control_box.pack_start(open_folder_button, False, False, 0)
 
+            archive_button = Gtk.Button.new_with_label(_('Finished tasks'))
+            archive_button.connect('clicked', self.on_archive_button_clicked)
+            control_box.pack_start(archive_button, False, False, 0)
+
             shutdown_button = Gtk.ToggleButton()
             shutdown_button.set_label(_('Shutdown'))
             shutdown_button.set_tooltip_text(
@@ -226,12 +256,16 @@ class DownloadPage(Gtk.Box):
 
         # name, path, fs_id, size, currsize, link,
         # isdir, save_dir, save_name, state, statename,
-        # humansize, percent, tooltip
+        # humansize, percent, tooltip, priority
         self.liststore = Gtk.ListStore(str, str, str, GObject.TYPE_INT64,
                                        GObject.TYPE_INT64, str,
                                        GObject.TYPE_INT, str, str,
                                        GObject.TYPE_INT, str, str,
-                                       GObject.TYPE_INT, str)
+                                       GObject.TYPE_INT, str,
+                                       GObject.TYPE_INT)
+        self.row_index = gutil.RowIndex(
+                self.liststore, FSID_COL, state_column=STATE_COL,
+                state_changed=self.on_task_state_changed)
         self.treeview = Gtk.TreeView(model=self.liststore)
         self.treeview.set_tooltip_column(TOOLTIP_COL)
         self.treeview.set_headers_clickable(True)
@@ -291,16 +325,15 @@ class DownloadPage(Gtk.Box):
         '''这个任务数据库只在程序开始时读入, 在程序关闭时导出.
 
         因为Gtk没有像在Qt中那么方便的使用SQLite, 而必须将所有数据读入一个
-        liststore中才行.
+        liststore中才行. 已完成的任务被移到存档表中, 启动时不会被读入.
         '''
         cache_path = os.path.join(Config.CACHE_DIR,
                                   self.app.profile['username'])
         if not os.path.exists(cache_path):
             os.makedirs(cache_path, exist_ok=True)
         db = os.path.join(cache_path, TASK_FILE)
-        self.conn = sqlite3.connect(db)
-        self.cursor = self.conn.cursor()
-        sql = '''CREATE TABLE IF NOT EXISTS tasks (
+        self.db = TaskDB(db)
+        sql = '''CREATE TABLE IF NOT EXISTS {0} (
         name CHAR NOT NULL,
         path CHAR NOT NULL,
         fsid CHAR NOT NULL,
@@ -314,30 +347,47 @@ class DownloadPage(Gtk.Box):
         statename CHAR NOT NULL,
         humansize CHAR NOT NULL,
         percent INT NOT NULL,
-        tooltip CHAR
+        tooltip CHAR,
+        priority INTEGER NOT NULL DEFAULT 0
         )
         '''
-        self.cursor.execute(sql)
+        self.db.execute(sql.format('tasks'))
+        self.db.execute(sql.format(ARCHIVE_TABLE))
+        # 以前的版本中没有priority 这一列
+        for table in ('tasks', ARCHIVE_TABLE):
+            columns = self.db.query('PRAGMA table_info({0})'.format(table))
+            if 'priority' not in [column[1] for column in columns]:
+                self.db.execute('''ALTER TABLE {0} ADD COLUMN
+                priority INTEGER NOT NULL DEFAULT 0'''.format(table))
+        self.db.execute('CREATE INDEX IF NOT EXISTS tasks_fsid ON tasks(fsid)')
+        # 每个文件在存档表中只保留一条记录, 先去掉以前重复存档的记录
+        self.db.execute('''DELETE FROM tasks_archive WHERE rowid NOT IN
+        (SELECT MAX(rowid) FROM tasks_archive GROUP BY fsid)''')
+        self.db.execute('DROP INDEX IF EXISTS tasks_archive_fsid')
+        self.db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS
+        tasks_archive_fsid_index ON tasks_archive(fsid)''')
+        # 以前的版本中, 已完成的任务也放在tasks 表中
+        self.db.execute('''INSERT OR REPLACE INTO tasks_archive
+        SELECT * FROM tasks WHERE state=?''', [State.FINISHED, ])
+        self.db.execute('DELETE FROM tasks WHERE state=?', [State.FINISHED, ])
 
     def on_destroy(self, *args):
         if not self.first_run:
+            self.progress.flush()
             self.pause_tasks()
-            self.conn.commit()
-            self.conn.close()
+            self.db.close()
             for worker, row in self.workers.values():
                 worker.pause()
                 row[CURRSIZE_COL] = worker.row[CURRSIZE_COL]
     
     def load_tasks_from_db(self):
-        req = self.cursor.execute('SELECT * FROM tasks')
-        for task in req:
-            self.liststore.append(task)
+        for task in self.db.query('SELECT * FROM tasks'):
+            self.row_index.append(task)
 
     def add_task_db(self, task):
         '''向数据库中写入一个新的任务记录'''
-        sql = 'INSERT INTO tasks VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
-        req = self.cursor.execute(sql, task)
-        self.check_commit()
+        sql = 'INSERT INTO tasks VALUES(?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
+        self.db.execute(sql, task)
 
     def get_task_db(self, fs_id):
         '''从数据库中查询fsid的信息.
@@ -346,18 +396,16 @@ class DownloadPage(Gtk.Box):
         如果没有的话, 就返回None
         '''
         sql = 'SELECT * FROM tasks WHERE fsid=?'
-        req = self.cursor.execute(sql, [fs_id, ])
-        if req:
-            return req.fetchone()
+        rows = self.db.query(sql, [fs_id, ])
+        if rows:
+            return rows[0]
         else:
-            None
+            return None
 
     def check_commit(self, force=False):
-        '''当修改数据库超过100次后, 就自动commit数据.'''
-        self.commit_count = self.commit_count + 1
-        if force or self.commit_count >= 100:
-            self.commit_count = 0
-            self.conn.commit()
+        '''数据由TaskDB 在后台定时提交, force 为True 时立即提交.'''
+        if force:
+            self.db.flush()
 
     def update_task_db(self, row):
         '''更新数据库中的任务信息'''
@@ -372,73 +420,146 @@ class DownloadPage(Gtk.Box):
         currsize=?, state=?, statename=?, humansize=?, percent=?
         WHERE fsid=?
         '''
-        self.cursor.execute(sql, [
+        self.db.update(row[FSID_COL], sql, [
             row[CURRSIZE_COL], STATE, STATENAME,
             row[HUMANSIZE_COL], row[PERCENT_COL], row[FSID_COL]
         ])
-        self.check_commit()
+
+    def set_priority_db(self, fs_id, priority):
+        '''修改任务的优先级'''
+        sql = 'UPDATE tasks SET priority=? WHERE fsid=?'
+        self.db.execute(sql, [priority, fs_id], key=fs_id)
 
     def remove_task_db(self, fs_id):
-        '''将任务从数据库中删除'''
+        '''将任务从数据库中删除.
+
+        存档表中的记录不受影响, 它们只在ArchiveDialog 中被清除.
+        '''
         sql = 'DELETE FROM tasks WHERE fsid=?'
-        self.cursor.execute(sql, [fs_id, ])
-        self.check_commit()
+        self.db.execute(sql, [fs_id, ], key=fs_id)
+
+    def archive_task_db(self, fs_id):
+        '''把已完成的任务移到存档表中, 同一个文件只保留最后一次的记录'''
+        sql = '''INSERT OR REPLACE INTO tasks_archive
+        SELECT * FROM tasks WHERE fsid=?'''
+        self.db.execute(sql, [fs_id, ], key=fs_id)
+        sql = 'DELETE FROM tasks WHERE fsid=?'
+        self.db.execute(sql, [fs_id, ], key=fs_id)
+
+    def get_archived_db(self, fs_ids):
+        '''查询存档表中已下载完成的文件.
+
+        返回{fsid: 本地文件路径}, 只包含本地文件还存在的那些.
+        查询会等待TaskDB 提交之前的修改, 所以只能在后台线程中调用.
+        '''
+        archived = {}
+        fs_ids = list(fs_ids)
+        for i in range(0, len(fs_ids), ARCHIVE_QUERY_NUM):
+            chunk = fs_ids[i:i+ARCHIVE_QUERY_NUM]
+            sql = '''SELECT fsid, savedir, savename FROM tasks_archive
+            WHERE fsid IN ({0})'''.format(','.join('?' * len(chunk)))
+            for fs_id, save_dir, save_name in self.db.query(sql, chunk):
+                filepath = os.path.join(save_dir, save_name)
+                if os.path.exists(filepath):
+                    archived[fs_id] = filepath
+        return archived
 
     def get_row_by_fsid(self, fs_id):
         '''确认在Liststore中是否存在这条任务. 如果存在, 返回TreeModelRow,
         否则就返回None'''
-        for row in self.liststore:
-            if row[FSID_COL] == fs_id:
-                return row
-        return None
+        return self.row_index.get(fs_id)
 
     # Open API
     def add_launch_task(self, pcs_file, app_info):
         self.check_first()
         fs_id = str(pcs_file['fs_id'])
         self.app_infos[fs_id] = app_info
-        self.add_task(pcs_file)
+        # 下载完成后会被立即打开, 用户正在等着它
+        self.add_task(pcs_file, priority=PRIORITY_HIGH)
 
-    def launch_app(self, fs_id):
+    def launch_app(self, fs_id, filepath=None):
         if fs_id in self.app_infos:
-            row = self.get_row_by_fsid(fs_id)
-            if not row:
-                return
+            if not filepath:
+                row = self.get_row_by_fsid(fs_id)
+                if not row:
+                    return
+                filepath = os.path.join(row[SAVEDIR_COL], row[SAVENAME_COL])
             app_info = self.app_infos[fs_id]
-            filepath = os.path.join(row[SAVEDIR_COL], row[SAVENAME_COL])
             gfile = Gio.File.new_for_path(filepath)
             app_info.launch([gfile, ], None)
             self.app_infos.pop(fs_id, None)
 
     # Open API
     def add_tasks(self, pcs_files, dirname=''):
-        '''建立批量下载任务, 包括目录'''
-        def on_list_dir(info, error=None):
-            path, pcs_files = info
-            if error or not pcs_files:
-                dialog = Gtk.MessageDialog(self.app.window,
-                        Gtk.DialogFlags.MODAL,
-                        Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE,
-                        _('Failed to scan folder to download'))
-                dialog.format_secondary_text(
-                        _('Please download {0} again').format(path))
-                dialog.run()
-                dialog.destroy()
+        '''建立批量下载任务, 包括目录.
+
+        目录在后台线程中由pcs.walk_dir() 并行遍历, 每得到一页文件就加入
+        下载任务, 不用等整个目录树遍历完. 存档表也在这个线程中查询.
+        '''
+        def on_walk_dir(path, pcs_files, archived):
+            if pcs_files is None:
+                failed_paths.append(path)
                 return
-            self.add_tasks(pcs_files, dirname)
+            for pcs_file in pcs_files:
+                self.add_task(pcs_file, dirname, scan=False,
+                              archived=archived)
+            self.scan_tasks()
+
+        def on_walk_finished():
+            # 所有获取失败的目录只在一个对话框中列出
+            if not failed_paths:
+                return
+            dialog = Gtk.MessageDialog(self.app.window,
+                    Gtk.DialogFlags.MODAL,
+                    Gtk.MessageType.ERROR, Gtk.ButtonsType.CLOSE,
+                    _('Failed to scan folder to download'))
+            dialog.format_secondary_text(
+                    _('Please download {0} again').format(
+                        '\n'.join(failed_paths)))
+            dialog.run()
+            dialog.destroy()
+
+        def get_archived(pcs_files):
+            return self.get_archived_db(
+                    str(pcs_file['fs_id']) for pcs_file in pcs_files)
+
+        def walk_dirs(files, paths):
+            try:
+                if files:
+                    GLib.idle_add(on_walk_dir, None, files,
+                                  get_archived(files))
+                if not paths:
+                    return
+                for path, pcs_files in pcs.walk_dir(self.app.cookie,
+                                                    self.app.tokens, paths):
+                    archived = get_archived(pcs_files) if pcs_files else {}
+                    GLib.idle_add(on_walk_dir, path, pcs_files, archived)
+            except Exception:
+                logger.error(traceback.format_exc())
+            finally:
+                GLib.idle_add(on_walk_finished)
 
         self.check_first()
-        for pcs_file in pcs_files:
-            if pcs_file['isdir']:
-                gutil.async_call(pcs.list_dir_all, self.app.cookie,
-                                 self.app.tokens, pcs_file['path'],
-                                 callback=on_list_dir)
-            else:
-                self.add_task(pcs_file, dirname)
-        self.check_commit(force=True)
+        failed_paths = []  # 获取失败的目录
+        files = [pcs_file for pcs_file in pcs_files if not pcs_file['isdir']]
+        dir_paths = [pcs_file['path'] for pcs_file in pcs_files
+                     if pcs_file['isdir']]
+        if files or dir_paths:
+            thread = threading.Thread(target=walk_dirs,
+                                      args=(files, dir_paths))
+            thread.daemon = True
+            thread.start()
+
+    def add_task(self, pcs_file, dirname='', scan=True,
+                 priority=PRIORITY_NORMAL, archived=None):
+        '''加入新的下载任务.
+
+        archived - 由get_archived_db() 在后台线程中查好的存档记录; 为None
+                   时会先在后台线程中查询这个文件, 然后再回到主线程添加.
+        '''
+        def on_archived_got(archived, error=None):
+            self.add_task(pcs_file, dirname, scan, priority, archived or {})
 
-    def add_task(self, pcs_file, dirname=''):
-        '''加入新的下载任务'''
         if pcs_file['isdir']:
             return
         fs_id = str(pcs_file['fs_id'])
@@ -450,6 +571,16 @@ class DownloadPage(Gtk.Box):
             if row[STATE_COL] == State.FINISHED:
                 self.launch_app(fs_id)
             return
+        # 已下载完成并被存档的文件, 只要本地文件还在, 就不再重复下载
+        if archived is None:
+            gutil.async_call(self.get_archived_db, [fs_id, ],
+                             callback=on_archived_got)
+            return
+        if fs_id in archived:
+            self.app.toast(_('Task exists: {0}').format(
+                           pcs_file['server_filename']))
+            self.launch_app(fs_id, archived[fs_id])
+            return
         if not dirname:
             dirname = self.app.profile['save-dir']
         save_dir = os.path.dirname(
@@ -473,57 +604,107 @@ class DownloadPage(Gtk.Box):
             human_size,
             0,
             tooltip,
+            priority,
         )
-        self.liststore.append(task)
+        self.row_index.append(task)
         self.add_task_db(task)
-        self.scan_tasks()
+        if scan:
+            self.scan_tasks()
 
     def scan_tasks(self, ignore_shutdown=False):
-        '''扫描所有下载任务, 并在需要时启动新的下载.'''
-        for row in self.liststore:
-            if len(self.workers.keys()) >= self.app.profile['concurr-download']:
-                break
-            if row[STATE_COL] == State.WAITING:
-                self.start_worker(row)
+        '''扫描所有下载任务, 并在需要时启动新的下载.
+
+        同时提前获取接下来几个等待任务的下载链接, 这样有空闲的下载线程时,
+        不用再等待locatedownload.
+        '''
+        def start_lane(queue, lane, limit):
+            while lanes[lane] < limit:
+                fs_id = queue.pop()
+                if fs_id is None:
+                    break
+                row = self.get_row_by_fsid(fs_id)
+                if not row or row[STATE_COL] != State.WAITING:
+                    continue
+                self.start_worker(row, lane)
+                lanes[lane] += 1
+
+        # 重建索引时才会把新读入的等待任务放入队列
+        self.row_index.sync()
+        lanes = collections.Counter(self.worker_lanes.values())
+        bulk_limit = self.app.profile['concurr-download']
+        start_lane(self.small_queue, SMALL_LANE,
+                   self.app.profile['concurr-small-download'])
+        start_lane(self.bulk_queue, BULK_LANE, bulk_limit)
+        # 没有大文件在等待时, 小文件也可以使用大文件通道的空位
+        if not self.bulk_queue:
+            start_lane(self.small_queue, BULK_LANE, bulk_limit)
+
+        prefetch = []
+        for queue in (self.small_queue, self.bulk_queue):
+            for fs_id in queue.peek(LINK_PREFETCH_NUM):
+                row = self.get_row_by_fsid(fs_id)
+                if row:
+                    prefetch.append(row[PATH_COL])
+        if prefetch:
+            self.link_cache.prefetch(self.app.cookie, prefetch)
 
         if not self.shutdown_button.get_active() or ignore_shutdown:
             return
         # Shutdown system after all tasks have finished
-        for row in self.liststore:
-            if (row[STATE_COL] not in
-                    (State.PAUSED, State.FINISHED, State.CANCELED, State.RETRYING)):
+        for state in (State.DOWNLOADING, State.WAITING, State.ERROR):
+            if self.row_index.count(state):
                 return
         self.shutdown.shutdown()
 
-    def start_worker(self, row):
-        '''为task新建一个后台下载线程, 并开始下载.'''
+    def get_task_queue(self, size):
+        if size <= SMALL_FILE_SIZE:
+            return self.small_queue
+        else:
+            return self.bulk_queue
+
+    def on_task_state_changed(self, row, old_state, state):
+        '''由row_index 调用, 维护等待队列'''
+        fs_id = row[FSID_COL]
+        queue = self.get_task_queue(row[SIZE_COL])
+        if state == State.WAITING:
+            queue.push(fs_id, row[PRIORITY_COL])
+        elif old_state == State.WAITING:
+            queue.remove(fs_id)
+
+    def on_progress(self, fs_id, received, received_total, records):
+        '''由ProgressAggregator 定时调用, 更新任务的下载进度'''
+        self.download_speed_add(received)
+        row = None
+        if fs_id in self.workers:
+            row = self.workers[fs_id][1]
+        else:
+            row = self.get_row_by_fsid(fs_id)
+        if not row:
+            return
+
+        row[CURRSIZE_COL] = received_total
+        curr_size = util.get_human_size(row[CURRSIZE_COL], False)[0]
+        total_size = util.get_human_size(row[SIZE_COL])[0]
+        row[PERCENT_COL] = int(row[CURRSIZE_COL] / row[SIZE_COL] * 100)
+        row[HUMANSIZE_COL] = '{0} / {1}'.format(curr_size, total_size)
+        self.update_task_db(row)
+
+    def start_worker(self, row, lane=BULK_LANE):
+        '''为task新建一个后台下载线程, 并开始下载.
+
+        lane - 这个任务占用的是哪个通道的并发数
+        '''
         def on_worker_started(worker, fs_id):
             pass
 
         def on_worker_received(worker, fs_id, received, received_total):
-            GLib.idle_add(do_worker_received, fs_id, received, received_total)
-
-        def do_worker_received(fs_id, received, received_total):
-            self.download_speed_add(received)
-            row = None
-            if fs_id in self.workers:
-                row = self.workers[fs_id][1]
-            else:
-                row = self.get_row_by_fsid(fs_id)
-            if not row:
-                return
-
-            row[CURRSIZE_COL] = received_total
-            curr_size = util.get_human_size(row[CURRSIZE_COL], False)[0]
-            total_size = util.get_human_size(row[SIZE_COL])[0]
-            row[PERCENT_COL] = int(row[CURRSIZE_COL] / row[SIZE_COL] * 100)
-            row[HUMANSIZE_COL] = '{0} / {1}'.format(curr_size, total_size)
-            self.update_task_db(row)
+            self.progress.update(fs_id, received, received_total)
 
         def on_worker_downloaded(worker, fs_id):
             GLib.idle_add(do_worker_downloaded, fs_id)
 
         def do_worker_downloaded(fs_id):
+            self.progress.discard(fs_id)
             row = None
             if fs_id in self.workers:
                 row = self.workers[fs_id][1]
@@ -538,8 +719,10 @@ class DownloadPage(Gtk.Box):
             row[HUMANSIZE_COL] = '{0} / {1}'.format(total_size, total_size)
             row[STATENAME_COL] = StateNames[State.FINISHED]
             self.update_task_db(row)
+            self.archive_task_db(row[FSID_COL])
             self.check_commit(force=True)
             self.workers.pop(row[FSID_COL], None)
+            self.worker_lanes.pop(row[FSID_COL], None)
             self.app.toast(_('{0} downloaded'.format(row[NAME_COL])))
             self.launch_app(fs_id)
             self.scan_tasks()
@@ -548,6 +731,7 @@ class DownloadPage(Gtk.Box):
             GLib.idle_add(do_worker_network_error, fs_id)
 
         def do_worker_network_error(fs_id):
+            self.progress.flush()
             row = self.workers.get(fs_id, None)
             if row:
                 row = row[1]
@@ -587,6 +771,7 @@ class DownloadPage(Gtk.Box):
         row[STATENAME_COL] = StateNames[State.DOWNLOADING]
         worker = Downloader(self, row)
         self.workers[row[FSID_COL]] = (worker, row)
+        self.worker_lanes[row[FSID_COL]] = lane
         worker.connect('started', on_worker_started)
         worker.connect('received', on_worker_received)
         worker.connect('downloaded', on_worker_downloaded)
@@ -604,12 +789,15 @@ class DownloadPage(Gtk.Box):
     def remove_worker(self, fs_id, stop=True):
         if fs_id not in self.workers:
             return
+        # 先保存这个任务最后的进度
+        self.progress.flush()
         worker = self.workers[fs_id][0]
         if stop:
             worker.stop()
         else:
             worker.pause()
         self.workers.pop(fs_id, None)
+        self.worker_lanes.pop(fs_id, None)
 
     def restart_task(self, row):
         '''重启下载任务.
@@ -686,7 +874,7 @@ class DownloadPage(Gtk.Box):
         self.remove_task_db(row[FSID_COL])
         tree_iter = row.iter
         if tree_iter:
-            self.liststore.remove(tree_iter)
+            self.row_index.remove(tree_iter)
         if scan:
             self.scan_tasks()
 
@@ -752,6 +940,18 @@ class DownloadPage(Gtk.Box):
         self.check_commit(force=True)
         self.scan_tasks()
 
+    def on_archive_button_clicked(self, button):
+        self.check_first()
+        dialog = ArchiveDialog(self, self.app, _('Finished tasks'), self.db,
+                               ARCHIVE_TABLE, (
+                                   (_('Name'), 'name'),
+                                   (_('Size'), 'humansize'),
+                                   (_('Path'), 'path'),
+                                   (_('Save To'), 'savedir'),
+                               ))
+        dialog.run()
+        dialog.destroy()
+
     def on_open_folder_button_clicked(self, button):
         model, tree_paths = self.selection.get_selected_rows()
         if not tree_paths:
@@ -790,12 +990,16 @@ class DownloadPage(Gtk.Box):
                 event.button != Gdk.BUTTON_SECONDARY):
             return False
         selection = self.selection.get_selected_rows()
-        if not selection or len(selection[1]) != 1:
+        if not selection or not selection[1]:
             return False
+        if len(selection[1]) > 1:
+            self.popup_priority_menu(event, selection[1])
+            return True
         selected_path = selection[1][0]
         row = self.liststore[int(str(selected_path))]
         if row[STATE_COL] != State.FINISHED:
-            return
+            self.popup_priority_menu(event, selection[1])
+            return True
         fs_id = row[FSID_COL]
         file_type = self.app.mime.get(row[PATH_COL], False, icon_size=64)[1]
 
@@ -850,3 +1054,39 @@ class DownloadPage(Gtk.Box):
 
         menu.show_all()
         menu.popup(None, None, None, None, event.button, event.time)
+        return True
+
+    def popup_priority_menu(self, event, tree_paths):
+        '''为选中的未完成任务设定优先级'''
+        def on_priority_activated(menu_item, priority):
+            for fs_id in fs_ids:
+                row = self.get_row_by_fsid(fs_id)
+                if row:
+                    self.set_task_priority(row, priority)
+            self.check_commit(force=True)
+            self.scan_tasks()
+
+        fs_ids = [self.liststore[tree_path][FSID_COL]
+                  for tree_path in tree_paths
+                  if self.liststore[tree_path][STATE_COL] != State.FINISHED]
+        if not fs_ids:
+            return
+
+        menu = Gtk.Menu()
+        self.menu = menu
+        for priority, label in ((PRIORITY_HIGH, _('High Priority')),
+                                (PRIORITY_NORMAL, _('Normal Priority')),
+                                (PRIORITY_LOW, _('Low Priority'))):
+            menu_item = Gtk.MenuItem.new_with_label(label)
+            menu_item.connect('activate', on_priority_activated, priority)
+            menu.append(menu_item)
+        menu.show_all()
+        menu.popup(None, None, None, None, event.button, event.time)
+
+    def set_task_priority(self, row, priority):
+        if row[PRIORITY_COL] == priority:
+            return
+        row[PRIORITY_COL] = priority
+        self.set_priority_db(row[FSID_COL], priority)
+        if row[STATE_COL] == State.WAITING:
+            self.get_task_queue(row[SIZE_COL]).push(row[FSID_COL], priority)
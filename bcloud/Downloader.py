@@ -3,70 +3,644 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in http://www.gnu.org/licenses/gpl-3.0.html
 
+import collections
+import http.client
 import json
 import multiprocessing
 import os
-from queue import Queue
+from queue import Queue, Empty
 import re
+import struct
 import threading
 import time
 import traceback
+import urllib.error
+import urllib.parse
+import zlib
 
 from urllib import request
 from gi.repository import GLib
 from gi.repository import GObject
 
+from bcloud import Config
 from bcloud import const
-from bcloud.const import State, DownloadMode
+from bcloud.const import State, DownloadMode, FsyncMode
 from bcloud import net
 from bcloud import pcs
 from bcloud import util
 from bcloud.log import logger
+from bcloud.TransferScheduler import DOWNLOAD
 
 CHUNK_SIZE = 131072       # 128K
 RETRIES = 3               # 连接失败时的重试次数
 DOWNLOAD_RETRIES = 10     # 下载线程的重试次数
-THRESHOLD_TO_FLUSH = 500  # 磁盘写入数据次数超过这个值时, 就进行一次同步.
+THRESHOLD_TO_FLUSH = 500  # 写入数据超过这么多个CHUNK_SIZE 时, 就提交一次日志.
 SMALL_FILE_SIZE = 1048576 # 1M, 下载小文件时用单线程下载
+MIN_STEAL_SIZE = 1048576  # 1M, 分片剩余数据少于它的两倍时, 就不再被拆分
+ENDGAME_DUPLICATES = 1    # endgame 阶段每个分片最多被重复下载的次数
+WRITE_BUFFER_SIZE = 1048576  # 1M, 每个下载线程的默认写入缓存大小
+# 以下两个值的默认值, 服务器在rank_param 里会给出新的值
+MAX_CONTINUOUS_FAILURE = 30  # mirror 连续失败这么多次后, 就不再使用它
+BAK_RANK_SLICE_NUM = 20      # 每下载这么多块数据, 就重新评估一次mirror
+SLOW_MIRROR_RATIO = 0.5      # mirror 的速度低于最快的mirror 的这个比例时, 就换掉它
+# 以下用于自动调整连接数及数据块大小
+AUTO_MIN_SEGMENTS = 2
+AUTO_MAX_SEGMENTS = 16
+AUTO_MIN_CHUNK_SIZE = 65536    # 64K
+AUTO_MAX_CHUNK_SIZE = 4194304  # 4M
+TUNE_INTERVAL = 3              # 每隔3秒评估一次下载速度
+TUNE_GAIN = 1.1                # 增加连接后, 总速度至少要提高10%
+TUNE_PROBE_INTERVALS = 10      # 稳定这么多个周期后, 再尝试增加连接
+TUNING_FILE = 'download-tuning.json'
+# 下载链接缓存
+LINK_CACHE_TTL = 1800          # 下载链接缓存30分钟
+LINK_EXPIRED_CODES = (403, 410)  # mirror 返回这些状态码时, 说明链接已失效
+LINK_PREFETCH_NUM = 4          # 提前获取下载链接的等待任务数
 
 (NAME_COL, PATH_COL, FSID_COL, SIZE_COL, CURRSIZE_COL, LINK_COL,
     ISDIR_COL, SAVENAME_COL, SAVEDIR_COL, STATE_COL, STATENAME_COL,
     HUMANSIZE_COL, PERCENT_COL) = list(range(13))
 
-BATCH_FINISISHED, BATCH_ERROR = -1, -2
+BATCH_FINISISHED, BATCH_ERROR, BATCH_DISK_ERROR = -1, -2, -3
+BATCH_WAKEUP = -4  # TransferScheduler 中有空闲的连接了
+STATUS_VERSION = 2
+JOURNAL_MAX_SEGMENTS = 128  # 断点续传日志最多能记录的分片数
+
+fdatasync = getattr(os, 'fdatasync', os.fsync)
 
 def get_tmp_filepath(dir_name, save_name):
     '''返回最终路径名及临时路径名'''
     filepath = os.path.join(dir_name, save_name)
     return filepath, filepath + '.part', filepath + '.bcloud-stat'
 
+def load_status(conf_filepath, size):
+    '''读取旧版本(JSON 格式)的断点续传信息, 返回[[start, end, received], ...]
+
+    end 不包含在分片内. 最早版本的分片信息里, end 是包含在内的, 需要转换.
+    '''
+    with open(conf_filepath) as conf_fh:
+        info = json.load(conf_fh)
+    if isinstance(info, dict) and info.get('version') == STATUS_VERSION:
+        return info['segments']
+    return [[start, min(end + 1, size), received]
+            for start, end, received in info]
+
+
+class ResumeJournal:
+    '''断点续传日志, 记录文件大小及每个分片的[start, end, received].
+
+    文件格式是固定的:
+      * 文件头: magic, 最大分片数, 文件大小;
+      * 两个大小相同的记录槽, 每个槽里有序号, 分片数, CRC32 及所有分片.
+    每次提交时, 用pwrite() 覆盖较旧的那个槽, 所以任何时候都至少有一个完整的
+    槽; 读取时使用CRC 校验通过并且序号最大的那个槽.
+
+    fsync_mode 为FsyncMode.JOURNAL 时, 提交之前先把.part 文件的数据同步到
+    磁盘, 再写入并同步日志, 这样断电后日志里记录的数据一定已经在磁盘上了.
+    '''
+
+    MAGIC = b'BCJ1'
+    HEADER = struct.Struct('<4sIQ')     # magic, max_segments, size
+    SLOT_HEADER = struct.Struct('<QII') # seq, count, crc32
+    SEGMENT = struct.Struct('<QQQ')     # start, end, received
+
+    def __init__(self, fd, size, max_segments=JOURNAL_MAX_SEGMENTS, seq=0,
+                 fsync_mode=FsyncMode.JOURNAL):
+        self.fd = fd
+        self.size = size
+        self.max_segments = max_segments
+        self.seq = seq
+        self.fsync_mode = fsync_mode
+        self.slot_size = (self.SLOT_HEADER.size +
+                          self.SEGMENT.size * max_segments)
+
+    @classmethod
+    def create(cls, path, size, status, fsync_mode=FsyncMode.JOURNAL):
+        fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        journal = cls(fd, size, fsync_mode=fsync_mode)
+        try:
+            os.pwrite(fd, cls.HEADER.pack(cls.MAGIC, journal.max_segments,
+                                          size), 0)
+            os.ftruncate(fd, cls.HEADER.size + journal.slot_size * 2)
+            journal.commit(status)
+        except OSError:
+            os.close(fd)
+            raise
+        return journal
+
+    @classmethod
+    def load(cls, path, fsync_mode=FsyncMode.JOURNAL):
+        '''读取日志, 返回(journal, status); 如果日志已损坏, 返回(None, None)'''
+        fd = os.open(path, os.O_RDWR)
+        try:
+            magic, max_segments, size = cls.HEADER.unpack(
+                    os.pread(fd, cls.HEADER.size, 0))
+        except struct.error:
+            magic = None
+        if magic != cls.MAGIC:
+            os.close(fd)
+            return None, None
+        journal = cls(fd, size, max_segments, fsync_mode=fsync_mode)
+        best = None
+        for slot in range(2):
+            data = os.pread(fd, journal.slot_size, journal.slot_offset(slot))
+            record = journal.parse_slot(data)
+            if record and (not best or record[0] > best[0]):
+                best = record
+        if not best:
+            os.close(fd)
+            return None, None
+        journal.seq = best[0]
+        return journal, best[1]
+
+    def slot_offset(self, slot):
+        return self.HEADER.size + self.slot_size * slot
+
+    def parse_slot(self, data):
+        try:
+            seq, count, crc = self.SLOT_HEADER.unpack_from(data)
+        except struct.error:
+            return None
+        if seq == 0 or count > self.max_segments:
+            return None
+        end = self.SLOT_HEADER.size + self.SEGMENT.size * count
+        payload = data[self.SLOT_HEADER.size:end]
+        if (len(payload) != end - self.SLOT_HEADER.size or
+                zlib.crc32(struct.pack('<QI', seq, count) + payload) != crc):
+            return None
+        status = [list(self.SEGMENT.unpack_from(payload, i * self.SEGMENT.size))
+                  for i in range(count)]
+        return seq, status
+
+    def commit(self, status, data_fd=None):
+        '''将status 写入较旧的那个槽'''
+        sync = self.fsync_mode == FsyncMode.JOURNAL
+        if sync and data_fd is not None:
+            fdatasync(data_fd)
+        status = status[:self.max_segments]
+        seq = self.seq + 1
+        payload = b''.join(self.SEGMENT.pack(*segment) for segment in status)
+        crc = zlib.crc32(struct.pack('<QI', seq, len(status)) + payload)
+        os.pwrite(self.fd, self.SLOT_HEADER.pack(seq, len(status), crc) + payload,
+                  self.slot_offset(seq % 2))
+        if sync:
+            fdatasync(self.fd)
+        self.seq = seq
+
+    def close(self):
+        os.close(self.fd)
+
+
+class TimedHTTPConnection(http.client.HTTPConnection):
+    '''记录连接建立完成(包括DNS 查询) 的时间'''
+
+    connected_at = 0
+
+    def connect(self):
+        super().connect()
+        self.connected_at = time.time()
+
+
+class TimedHTTPSConnection(http.client.HTTPSConnection):
+    '''记录连接建立完成(包括DNS 查询及TLS 握手) 的时间'''
+
+    connected_at = 0
+
+    def connect(self):
+        super().connect()
+        self.connected_at = time.time()
+
+
+class TimedHandler(request.HTTPHandler, request.HTTPSHandler):
+    '''记住最近一次打开的连接, 用来从请求的总时间里扣除建立连接的时间,
+    得到time-to-first-byte. 有重定向时, 记住的是最后一个连接.
+    '''
+
+    def __init__(self):
+        request.HTTPSHandler.__init__(self)
+        self.conn = None
+
+    def connection(self, conn_class):
+        def new_connection(host, **kwargs):
+            self.conn = conn_class(host, **kwargs)
+            return self.conn
+        return new_connection
+
+    def http_open(self, req):
+        return self.do_open(self.connection(TimedHTTPConnection), req)
+
+    def https_open(self, req):
+        kwargs = {'context': self._context}
+        if getattr(self, '_check_hostname', None) is not None:
+            kwargs['check_hostname'] = self._check_hostname
+        return self.do_open(self.connection(TimedHTTPSConnection), req,
+                            **kwargs)
+
+
+class SegmentTuner:
+    '''根据实测的带宽及延迟, 自动调整下载连接数及每次读取的数据块大小.
+
+    每个下载任务有自己的SegmentTuner. 从较少的连接开始, 只要增加连接后
+    总速度还在明显提高, 就继续增加; 增加连接不再有效或者开始出错时, 就减少
+    一个连接, 并稳定下来, 隔一段时间之后再尝试增加. 数据块大小取RTT 乘以
+    单个连接的带宽(BDP), 这里的RTT 是Range 请求的time-to-first-byte, 不包括
+    建立连接的时间.
+    调整的结果按实际使用的mirror 主机保存在TUNING_FILE 里, 下次从这些主机
+    下载时直接使用.
+    '''
+
+    _lock = threading.Lock()
+
+    def __init__(self, profile_name, hosts):
+        '''hosts - 这个文件所有mirror 的主机, 按优先顺序排列'''
+        self.path = os.path.join(Config.CACHE_DIR, profile_name, TUNING_FILE)
+        self.host = hosts[0] if hosts else ''
+        saved = self.load()
+        info = {}
+        for host in hosts:
+            if host in saved:
+                self.host = host
+                info = saved[host]
+                break
+        self.segments = info.get('segments', AUTO_MIN_SEGMENTS)
+        self.chunk_size = info.get('chunk-size', CHUNK_SIZE)
+        self.growing = True
+        self.best_speed = 0
+        self.stable_intervals = 0
+        self.received = 0
+        self.errors = 0
+        self.last_time = time.time()
+
+    def load(self):
+        with self._lock:
+            return self._load()
+
+    def _load(self):
+        try:
+            with open(self.path) as fh:
+                return json.load(fh)
+        except (OSError, ValueError):
+            return {}
+
+    def save(self, host=None):
+        '''host - 实际下载时使用最多的mirror 主机.
+
+        多个任务可能同时保存, 所以读取和写入都在_lock 中进行; 先写入临时
+        文件再替换, 写到一半时崩溃也不会损坏原来的文件.
+        '''
+        if host:
+            self.host = host
+        tmp_path = self.path + '.tmp'
+        with self._lock:
+            info = self._load()
+            info[self.host] = {
+                'segments': self.segments,
+                'chunk-size': self.chunk_size,
+            }
+            try:
+                with open(tmp_path, 'w') as fh:
+                    json.dump(info, fh)
+                os.replace(tmp_path, self.path)
+            except OSError:
+                logger.error(traceback.format_exc())
+
+    def add_received(self, size):
+        self.received += size
+
+    def add_error(self):
+        self.errors += 1
+
+    def tune(self, rtt, conn_speed):
+        '''每隔TUNE_INTERVAL 秒调整一次, 调整了的话就返回True'''
+        now = time.time()
+        elapsed = now - self.last_time
+        if elapsed < TUNE_INTERVAL:
+            return False
+        speed = self.received / elapsed
+        segments = self.segments
+        if self.errors:
+            # 服务器开始拒绝连接, 减少连接
+            self.segments = max(AUTO_MIN_SEGMENTS, self.segments - 1)
+            self.growing = False
+            self.stable_intervals = 0
+        elif self.growing:
+            if speed > self.best_speed * TUNE_GAIN:
+                self.best_speed = speed
+                self.segments = min(AUTO_MAX_SEGMENTS, self.segments + 1)
+            else:
+                # 上一次增加的连接没有带来明显的提高, 退回去
+                self.segments = max(AUTO_MIN_SEGMENTS, self.segments - 1)
+                self.growing = False
+                self.stable_intervals = 0
+        else:
+            self.stable_intervals += 1
+            if self.stable_intervals >= TUNE_PROBE_INTERVALS:
+                self.best_speed = speed
+                self.growing = True
+
+        if rtt and conn_speed:
+            bdp = int(rtt * conn_speed)
+            chunk_size = AUTO_MIN_CHUNK_SIZE
+            while chunk_size < bdp and chunk_size < AUTO_MAX_CHUNK_SIZE:
+                chunk_size *= 2
+            self.chunk_size = chunk_size
+
+        self.received = 0
+        self.errors = 0
+        self.last_time = now
+        if segments != self.segments:
+            logger.debug('SegmentTuner: %s, segments %s -> %s, chunk %s' %
+                         (self.host, segments, self.segments, self.chunk_size))
+        return True
+
+
+class LinkCache:
+    '''缓存文件的下载链接(locatedownload 的结果), 以远程路径为键.
+
+    链接在LINK_CACHE_TTL 秒后过期, mirror 返回403/410 时也会被作废.
+    这样任务重试或继续下载时不用再请求一次locatedownload, 还可以提前为
+    等待中的任务获取链接. 同一个路径同时只会有一个线程去请求它.
+    '''
+
+    def __init__(self, ttl=LINK_CACHE_TTL):
+        self.ttl = ttl
+        self.links = {}    # {path: (urls, rank_param, timestamp)}
+        self.pending = {}  # {path: threading.Event}
+        self.lock = threading.Lock()
+
+    def _lookup(self, path):
+        link = self.links.get(path)
+        if link and time.time() - link[2] < self.ttl:
+            return link
+        self.links.pop(path, None)
+        return None
+
+    def get(self, cookie, path):
+        '''返回(urls, rank_param), 缓存中没有的话, 就请求服务器'''
+        while True:
+            with self.lock:
+                link = self._lookup(path)
+                if link:
+                    return link[0], link[1]
+                event = self.pending.get(path)
+                if not event:
+                    event = threading.Event()
+                    self.pending[path] = event
+                    break
+            # 其它线程正在获取这个链接, 等它完成
+            event.wait()
+
+        urls, rank_param = [], None
+        try:
+            urls, rank_param = pcs.get_download_links(cookie, path)
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            with self.lock:
+                if urls:
+                    now = time.time()
+                    for key in [k for k, v in self.links.items()
+                                if now - v[2] >= self.ttl]:
+                        del self.links[key]
+                    self.links[path] = (urls, rank_param, now)
+                self.pending.pop(path, None)
+            event.set()
+        return urls, rank_param
+
+    def prefetch(self, cookie, paths):
+        '''在后台获取这些文件的下载链接'''
+        for path in paths:
+            with self.lock:
+                if path in self.pending or self._lookup(path):
+                    continue
+            thread = threading.Thread(target=self.get, args=(cookie, path))
+            thread.daemon = True
+            thread.start()
+
+    def invalidate(self, path):
+        with self.lock:
+            self.links.pop(path, None)
+
+
+class MirrorSelector:
+    '''管理一个文件的多个下载链接(mirror), 可被多个下载线程共用.
+
+    记录每个mirror 上的连接数, 单个连接的下载速度和连续失败次数, 新的连接
+    会被分配到最合适的mirror 上. 连续失败次数超过max_continuous_failure
+    的mirror 会被弃用, 速度明显偏慢的mirror 上的连接会被迁移到快的mirror.
+    '''
+
+    def __init__(self, urls, rank_param=None):
+        rank_param = rank_param or {}
+        self.max_failures = rank_param.get('max_continuous_failure',
+                                           MAX_CONTINUOUS_FAILURE)
+        # 服务器可能返回0, 它被用作除数
+        self.check_interval = max(1, int(rank_param.get('bak_rank_slice_num',
+                                                        BAK_RANK_SLICE_NUM)))
+        self.lock = threading.Lock()
+        # {url: [conns, speed, continuous_failures, disabled]}
+        self.mirrors = collections.OrderedDict(
+                (url, [0, 0.0, 0, False]) for url in urls)
+        # 是否有mirror 返回过403/410
+        self.expired = False
+
+    def _alive(self):
+        alive = [(url, m) for url, m in self.mirrors.items() if not m[3]]
+        return alive
+
+    def _best_speed(self):
+        return max([m[1] for url, m in self._alive()] or [0])
+
+    def best_speed(self):
+        '''最快的mirror 上单个连接的下载速度'''
+        with self.lock:
+            return self._best_speed()
+
+    def best_url(self):
+        '''测得的速度最快的mirror, 都还没有测速时返回None'''
+        with self.lock:
+            measured = [(m[1], url) for url, m in self.mirrors.items() if m[1]]
+            if not measured:
+                return None
+            return max(measured)[1]
+
+    def _pick(self, exclude=None):
+        alive = [(url, m) for url, m in self._alive() if url != exclude]
+        if not alive:
+            return None
+        # 尚未测速的mirror, 假定它与最快的一样快, 以便它能被尝试
+        best_speed = self._best_speed() or 1
+        def cost(item):
+            url, m = item
+            return (m[0] + 1) / (m[1] or best_speed)
+        return min(alive, key=cost)[0]
+
+    def acquire(self, exclude=None):
+        '''为一个新连接选择mirror, 如果所有mirror 都已弃用, 返回None'''
+        with self.lock:
+            url = self._pick(exclude)
+            if url is None and exclude and not self.mirrors[exclude][3]:
+                url = exclude
+            if url:
+                self.mirrors[url][0] += 1
+            return url
+
+    def attach(self, url):
+        '''使用一个已经在url 上打开的连接'''
+        with self.lock:
+            self.mirrors[url][0] += 1
+            return url
+
+    def release(self, url):
+        with self.lock:
+            if url in self.mirrors:
+                self.mirrors[url][0] -= 1
+
+    def switch(self, url):
+        '''把连接从url 迁移到另一个mirror'''
+        self.release(url)
+        return self.acquire(exclude=url)
+
+    def report_received(self, url, size, elapsed):
+        with self.lock:
+            mirror = self.mirrors[url]
+            speed = size / max(elapsed, 0.001)
+            mirror[1] = speed if not mirror[1] else mirror[1] * 0.8 + speed * 0.2
+            mirror[2] = 0
+
+    def report_error(self, url):
+        with self.lock:
+            mirror = self.mirrors[url]
+            mirror[2] += 1
+            if mirror[2] >= self.max_failures:
+                logger.warn('MirrorSelector: disable mirror %s' % url)
+                mirror[3] = True
+
+    def report_expired(self, url):
+        '''mirror 返回403/410, 链接已失效, 立即弃用它'''
+        with self.lock:
+            logger.warn('MirrorSelector: link expired %s' % url)
+            self.mirrors[url][3] = True
+            self.expired = True
+
+    def should_switch(self, url):
+        '''如果url 明显比最快的mirror 慢, 就返回更好的mirror, 否则返回None'''
+        with self.lock:
+            mirror = self.mirrors[url]
+            if not mirror[3]:
+                best_speed = self._best_speed()
+                if not mirror[1] or mirror[1] >= best_speed * SLOW_MIRROR_RATIO:
+                    return None
+            new_url = self._pick(exclude=url)
+            if not new_url:
+                return None
+            mirror[0] -= 1
+            self.mirrors[new_url][0] += 1
+            logger.debug('MirrorSelector: switch %s -> %s' % (url, new_url))
+            return new_url
+
 
 class DownloadBatch(threading.Thread):
+    '''下载文件的一个分片[start_size, end_size).
 
-    def __init__(self, id_, queue, url, lock, start_size, end_size, fh,
-                 timeout):
+    end_size 可以在下载过程中被Downloader 缩小, 以便把后面的数据交给空闲的
+    线程去下载. 每写入一块数据, 就把当前的offset 发送给Downloader.
+    下载链接由Downloader 从mirrors 中分配好之后传入, 出错或者速度太慢时会
+    换到其它mirror.
+
+    收到的数据先放到写入缓存里, 缓存满了之后再用os.pwrite() 一次写入磁盘.
+    每个线程都使用自己的文件描述符(dup), 不需要加锁, 也不共享文件位置;
+    Downloader 关闭它的文件描述符时, 也不会影响到仍在运行的线程.
+
+    stream - (url, req), 已经打开的从文件开头读取的响应, 第一个分片可以
+    直接使用它, 不用再建立连接.
+    '''
+
+    def __init__(self, id_, queue, mirrors, url, start_size, end_size, fd,
+                 timeout, buffer_size=WRITE_BUFFER_SIZE, stream=None):
         super().__init__()
+        self.daemon = True
         self.id_ = id_
         self.queue = queue
+        self.mirrors = mirrors
+        # 已经在mirrors 中占用了的下载链接
         self.url = url
-        self.lock = lock
         self.start_size = start_size
         self.end_size = end_size
-        self.fh = fh
+        self.offset = start_size
+        self.fd = os.dup(fd)
         self.timeout = timeout
+        self.buffer_size = buffer_size
+        self.stream = stream
+        # 写入缓存, 在download() 中创建, 线程退出时释放
+        self.buf = None
+        # 每次读取的数据块大小, 可以被SegmentTuner 调整
+        self.chunk_size = CHUNK_SIZE
+        # 最近一次Range 请求的time-to-first-byte, 用来估计RTT
+        self.rtt = 0
+        # (scheduler, task, host), 线程退出时要释放在TransferScheduler
+        # 中申请的连接; 换mirror 时, 它也被移到新的主机上
+        self.slot = None
+        # BandwidthLimiter, 用于限速
+        self.limiter = None
         self.stop_flag = False
 
     def run(self):
-        self.download()
+        try:
+            try:
+                self.download()
+            finally:
+                self.mirrors.release(self.url)
+        except Exception:
+            # 未预料到的错误也要通知Downloader, 否则它会一直等待这个线程
+            logger.error(traceback.format_exc())
+            self.queue.put((self, BATCH_ERROR), block=False)
+        finally:
+            self.buf = None
+            if self.stream:
+                self.stream[1].close()
+                self.stream = None
+            os.close(self.fd)
+            if self.slot:
+                scheduler, task, host = self.slot
+                scheduler.release(task, host)
 
     def stop(self):
         self.stop_flag = True
 
+    def set_url(self, url):
+        '''换到另一个mirror, TransferScheduler 中的连接也被记到它的主机上.
+
+        新主机上的连接已满时, 继续使用原来的mirror, 返回False.
+        '''
+        if url and self.slot:
+            scheduler, task, host = self.slot
+            new_host = urllib.parse.urlparse(url).netloc
+            if new_host != host:
+                if not scheduler.move(task, host, new_host):
+                    # 把mirrors 中的连接也还给原来的mirror
+                    self.mirrors.release(url)
+                    self.mirrors.attach(self.url)
+                    return False
+                self.slot = (scheduler, task, new_host)
+        self.url = url
+        return True
+
+    def switch_mirror(self):
+        '''当前mirror 出错, 换一个mirror'''
+        self.mirrors.report_error(self.url)
+        url = self.mirrors.switch(self.url)
+        # url 为None 时, 所有mirror 都已弃用, 这个连接已被释放;
+        # 新mirror 的主机连接已满时, 会再用原来的mirror 重试
+        self.set_url(url)
+        return bool(url)
+
     def get_req(self, start_size, end_size):
         '''打开socket'''
         logger.debug('DownloadBatch.get_req: %s, %s' % (start_size, end_size))
-        opener = request.build_opener()
-        content_range = 'bytes={0}-{1}'.format(start_size, end_size)
+        handler = TimedHandler()
+        opener = request.build_opener(handler)
+        content_range = 'bytes={0}-{1}'.format(start_size, end_size - 1)
         opener.addheaders = [
             ('Range', content_range),
             ('User-Agent', const.USER_AGENT),
@@ -75,35 +649,64 @@ class DownloadBatch(threading.Thread):
         ]
         for i in range(RETRIES):
             try:
-                return opener.open(self.url, timeout=self.timeout)
+                start_time = time.time()
+                req = opener.open(self.url, timeout=self.timeout)
+                # 从连接建立完成到收到响应头, 不包括DNS 查询及TLS 握手
+                connected_at = handler.conn.connected_at if handler.conn else 0
+                self.rtt = time.time() - max(start_time, connected_at)
+                return req
             #except OSError:
             #    logger.error(traceback.format_exc())
-            #    self.queue.put((self.id_, BATCH_ERROR), block=False)
+            #    self.queue.put((self, BATCH_ERROR), block=False)
             #    return None
+            except urllib.error.HTTPError as e:
+                logger.error(traceback.format_exc())
+                if e.code in LINK_EXPIRED_CODES:
+                    self.mirrors.report_expired(self.url)
+                if not self.switch_mirror():
+                    break
             except:
                 logger.error(traceback.format_exc())
-        else:
-            self.queue.put((self.id_, BATCH_ERROR), block=False)
-            return None
+                if not self.switch_mirror():
+                    break
+        return None
 
     def download(self):
-        offset = self.start_size
-        req = self.get_req(offset, self.end_size)
+        offset = self.offset
+        if self.stream:
+            req, self.stream = self.stream[1], None
+        else:
+            req = self.get_req(offset, self.end_size)
+        if not req:
+            self.queue.put((self, BATCH_ERROR), block=False)
+            return
+        blocks = 0
+        self.buf = buf = bytearray()
 
         while not self.stop_flag:
             for i in range(DOWNLOAD_RETRIES):
                 if not req:
                     req = self.get_req(offset, self.end_size)
                     logger.debug('DownloadBatch.download: socket reconnected')
+                    if not req:
+                        self.queue.put((self, BATCH_ERROR), block=False)
+                        return
                     continue
                 try:
-                    block = req.read(CHUNK_SIZE)
+                    chunk_size = self.chunk_size
+                    if self.limiter:
+                        chunk_size = self.limiter.chunk_size(DOWNLOAD,
+                                                             chunk_size)
+                    start_time = time.time()
+                    block = req.read(chunk_size)
                     if not block:
                         logger.error('DownloadBatch, block is empty: %s, %s, %s, %s' %
                                      (offset, self.start_size, self.end_size,
                                       len(block)))
                         req = None
                     else:
+                        self.mirrors.report_received(
+                                self.url, len(block), time.time() - start_time)
                         break
                 except (OSError, AttributeError):
                     logger.error(traceback.format_exc())
@@ -111,23 +714,43 @@ class DownloadBatch(threading.Thread):
                 except  :
                     logger.error( 'Time out occured.')
                     req = None
+                if not self.switch_mirror():
+                    self.queue.put((self, BATCH_ERROR), block=False)
+                    return
             else:
-                self.queue.put((self.id_, BATCH_ERROR), block=False)
+                self.queue.put((self, BATCH_ERROR), block=False)
                 return
 
-            with self.lock:
-                if self.fh.closed:
-                    return
-                self.fh.seek(offset)
-                self.fh.write(block)
-                self.queue.put((self.id_, len(block)), block=False)
-
+            if self.stop_flag:
+                return
+            if self.limiter:
+                self.limiter.download(len(block))
+            buf += block
             offset = offset + len(block)
-            # 下载完成
-            if offset >= self.end_size:
-                self.queue.put((self.id_, BATCH_FINISISHED), block=False)
+            # 下载完成, end_size 可能已被缩小
+            finished = offset >= self.end_size
+            if finished or len(buf) >= max(self.buffer_size, self.chunk_size):
+                try:
+                    os.pwrite(self.fd, buf, offset - len(buf))
+                except OSError:
+                    logger.error(traceback.format_exc())
+                    self.queue.put((self, BATCH_DISK_ERROR), block=False)
+                    return
+                buf.clear()
+                self.offset = offset
+                self.queue.put((self, offset), block=False)
+            if finished:
+                self.queue.put((self, BATCH_FINISISHED), block=False)
                 return
 
+            # 当前mirror 太慢的话, 就从这个位置开始, 换到更快的mirror
+            blocks += 1
+            if blocks % self.mirrors.check_interval == 0:
+                url = self.mirrors.should_switch(self.url)
+                if url and self.set_url(url):
+                    req.close()
+                    req = None
+
 
 class Downloader(threading.Thread, GObject.GObject):
     '''管理每个下载任务, 使用了多线程下载.
@@ -154,8 +777,15 @@ class Downloader(threading.Thread, GObject.GObject):
         self.cookie = parent.app.cookie
         self.tokens = parent.app.tokens
         self.default_threads = int(parent.app.profile['download-segments'])
+        self.auto_segments = parent.app.profile['download-segments-auto']
+        self.profile_name = parent.app.profile['username']
         self.timeout = int(parent.app.profile['download-timeout'])
         self.download_mode = parent.app.profile['download-mode']
+        self.buffer_size = int(parent.app.profile['download-buffer-size'])
+        self.fsync_mode = parent.app.profile['download-fsync']
+        self.link_cache = parent.link_cache
+        self.scheduler = parent.app.transfer_scheduler
+        self.limiter = parent.app.bandwidth_limiter
         self.row = row[:]
 
     def download(self):
@@ -174,139 +804,369 @@ class Downloader(threading.Thread, GObject.GObject):
                 name, ext = os.path.splitext(filepath)
                 filepath = '{0}_{1}{2}'.format(name, util.curr_time(), ext)
 
-        url = pcs.get_download_link(self.cookie, row[PATH_COL])
-        if not url:
+        urls, rank_param = self.link_cache.get(self.cookie, row[PATH_COL])
+        if not urls:
             row[STATE_COL] = State.ERROR
             self.emit('network-error', row[FSID_COL])
             logger.warn('Failed to get url to download')
             return
 
+        if self.auto_segments:
+            hosts = [urllib.parse.urlparse(url).netloc for url in urls]
+            self.tuner = SegmentTuner(self.profile_name, hosts)
+            self.default_threads = self.tuner.segments
+        else:
+            self.tuner = None
+
+        journal = None
+        stream = None
         if os.path.exists(conf_filepath) and os.path.exists(tmp_filepath):
-            with open(conf_filepath) as conf_fh:
-                status = json.load(conf_fh)
-            threads = len(status)
-            if threads > 1 and threads != self.default_threads:
-                logger.warn("threads of task doesn't equal default_threads %d %d" %
-                            (threads, self.default_threads))
-            file_exists = True
-            fh = open(tmp_filepath, 'rb+')
-            fh.seek(0)
+            size = os.path.getsize(tmp_filepath)
+            journal, status = self.load_journal(conf_filepath, size)
+        if journal:
+            threads = self.default_threads
+            fd = os.open(tmp_filepath, os.O_RDWR)
         else:
-            req = net.urlopen_simple(url)
-            if not req:
-                logger.warn('Failed to get url to download')
-                self.emit('network-error', row[FSID_COL])
-                return
-            content_length = req.getheader('Content-Length')
-            # Fixed: baiduPCS using non iso-8859-1 codec in http headers
-            if not content_length:
-                match = re.search('\sContent-Length:\s*(\d+)', str(req.headers))
-                if not match:
+            # 新任务的大小直接取自文件元数据, 不再单独请求一次服务器
+            size = row[SIZE_COL]
+            if size <= 0:
+                stream = self.probe_size(urls)
+                if not stream:
                     logger.warn('Failed to get url to download')
                     self.emit('network-error', row[FSID_COL])
                     return
-                content_length = match.group(1)
-            size = int(content_length)
+                size = stream[2]
+                if size == 0:
+                    stream[1].close()
+                    stream = None
             if size == 0:
                 open(filepath, 'a').close()
                 self.emit('downloaded', row[FSID_COL])
                 return
+            elif self.tuner:
+                # 每个连接至少下载SMALL_FILE_SIZE 的数据
+                threads = max(1, min(self.default_threads,
+                                     size // SMALL_FILE_SIZE))
             elif size <= SMALL_FILE_SIZE:
                 threads = 1
             else:
                 threads = self.default_threads
             average_size, pad_size = divmod(size, threads)
-            file_exists = False
             status = []
-            fh = open(tmp_filepath, 'wb')
+            for id_ in range(threads):
+                start_size = id_ * average_size
+                end_size = start_size + average_size
+                if id_ == threads - 1:
+                    end_size = end_size + pad_size
+                status.append([start_size, end_size, 0])
+            fd = None
             try:
-                fh.truncate(size)
+                fd = os.open(tmp_filepath,
+                             os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+                os.ftruncate(fd, size)
+                journal = ResumeJournal.create(conf_filepath, size, status,
+                                               self.fsync_mode)
             except (OSError, IOError):
-                e = truncate.format_exc()
+                e = traceback.format_exc()
                 logger.error(e)
+                if fd is not None:
+                    os.close(fd)
+                if stream:
+                    stream[1].close()
                 self.emit('disk-error', row[FSID_COL], tmp_filepath)
                 return
 
-        # task list
-        tasks = []
+        # 探测大小时得到的响应, 会被用作第一个分片的数据流
+        self.stream = stream
+        self.status = status
+        self.batches = []
+        self.threads = threads
+        self.mirrors = MirrorSelector(urls, rank_param)
+        self.fd = fd
         # message queue
-        queue = Queue()
-        # threads lock
-        lock = threading.RLock()
-        for id_ in range(threads):
-            if file_exists:
-                start_size, end_size, received = status[id_]
-                if start_size + received >= end_size:
-                    # part of file has been downloaded
-                    continue
-                start_size += received
-            else:
-                start_size = id_ * average_size
-                end_size = start_size + average_size - 1
-                if id_ == threads - 1:
-                    end_size = end_size + pad_size + 1
-                status.append([start_size, end_size, 0])
-            task = DownloadBatch(id_, queue, url, lock, start_size, end_size,
-                                 fh, self.timeout)
-            tasks.append(task)
-
-        for task in tasks:
-            task.start()
+        self.queue = Queue()
+        self.scheduler.register(self)
+        self.fill_batches()
 
         try:
-            conf_count = 0
-            done = 0
+            unsaved = 0
+            received_total = sum(t[2] for t in status)
             self.emit('started', row[FSID_COL])
             while row[STATE_COL] == State.DOWNLOADING:
-                id_, received = queue.get()
+                if self.is_finished():
+                    row[STATE_COL] = State.FINISHED
+                    break
+                if self.tuner:
+                    self.auto_tune()
+                try:
+                    batch, offset = self.queue.get(timeout=TUNE_INTERVAL)
+                except Empty:
+                    continue
+                if offset == BATCH_WAKEUP:
+                    self.fill_batches()
+                    continue
+                if batch not in self.batches:
+                    continue
+                segment = status[batch.id_]
                 # FINISHED
-                if received == BATCH_FINISISHED:
-                    done += 1
-                    if done == len(tasks):
-                        row[STATE_COL] = State.FINISHED
-                        break
+                if offset == BATCH_FINISISHED:
+                    if segment[0] + segment[2] >= segment[1]:
+                        self.stop_segment(batch.id_)
                     else:
-                        continue
+                        self.batches.remove(batch)
+                    self.fill_batches()
+                    continue
+                elif offset == BATCH_DISK_ERROR:
+                    self.emit('disk-error', row[FSID_COL], tmp_filepath)
+                    row[STATE_COL] = State.ERROR
+                    break
                 # error occurs
-                elif received == BATCH_ERROR:
+                elif offset == BATCH_ERROR:
+                    self.batches.remove(batch)
+                    if self.tuner:
+                        self.tuner.add_error()
+                    # 这个分片还有其它线程在下载(endgame)
+                    if any(b.id_ == batch.id_ for b in self.batches):
+                        continue
                     row[STATE_COL] = State.ERROR
                     break
-                status[id_][2] += received
-                conf_count += 1
-                # flush data and status to disk
-                if conf_count > THRESHOLD_TO_FLUSH:
-                    with lock:
-                        if not fh.closed:
-                            fh.flush()
-                    with open(conf_filepath, 'w') as fh:
-                        json.dump(status, fh)
-                    conf_count = 0
-                received_total = sum(t[2] for t in status)
+                received = min(offset, segment[1]) - segment[0]
+                if received <= segment[2]:
+                    continue
+                received, segment[2] = received - segment[2], received
+                received_total += received
+                unsaved += received
+                if self.tuner:
+                    self.tuner.add_received(received)
+                # flush data and commit status to disk
+                if unsaved > THRESHOLD_TO_FLUSH * CHUNK_SIZE:
+                    journal.commit(status, fd)
+                    unsaved = 0
                 self.emit('received', row[FSID_COL], received, received_total)
         except Exception:
             logger.error(traceback.format_exc())
             row[STATE_COL] = State.ERROR
-        with lock:
-            if not fh.closed:
-                fh.close()
-        for task in tasks:
-            if task.isAlive():
-                task.stop()
-        with open(conf_filepath, 'w') as fh:
-            json.dump(status, fh)
+        for batch in self.batches:
+            batch.stop()
+        self.scheduler.unregister(self)
+        if self.stream:
+            self.stream[1].close()
+        if self.tuner:
+            best_url = self.mirrors.best_url()
+            if best_url:
+                self.tuner.save(urllib.parse.urlparse(best_url).netloc)
+            else:
+                self.tuner.save()
+        try:
+            if row[STATE_COL] == State.FINISHED:
+                if self.fsync_mode == FsyncMode.JOURNAL:
+                    fdatasync(fd)
+            elif row[STATE_COL] != State.CANCELED:
+                journal.commit(status, fd)
+        except OSError:
+            logger.error(traceback.format_exc())
+        journal.close()
+        os.close(fd)
 
         if row[STATE_COL] == State.CANCELED:
             os.remove(tmp_filepath)
             if os.path.exists(conf_filepath):
                 os.remove(conf_filepath)
         elif row[STATE_COL] == State.ERROR:
+            if self.mirrors.expired:
+                self.link_cache.invalidate(row[PATH_COL])
             self.emit('network-error', row[FSID_COL])
         elif row[STATE_COL] == State.FINISHED:
+            self.link_cache.invalidate(row[PATH_COL])
             self.emit('downloaded', row[FSID_COL])
             os.rename(tmp_filepath, filepath)
             if os.path.exists(conf_filepath):
                 os.remove(conf_filepath)
 
+    def probe_size(self, urls):
+        '''文件元数据里没有大小时, 用一个GET 请求从服务器获取.
+
+        只有状态码为200, 或者206 并且Content-Range 覆盖了整个文件时, 才会
+        使用这个响应; 否则(比如服务器返回了400/500 的错误页面) 就换下一个
+        mirror. 返回(url, req, size), req 的数据会被第一个分片直接读取;
+        失败时返回None.
+        '''
+        expired = False
+        for url in urls:
+            req = net.urlopen_simple(url)
+            if not req:
+                continue
+            if req.code not in (200, 206):
+                logger.warn('Downloader.probe_size: HTTP %s, %s' %
+                            (req.code, url))
+                if req.code in LINK_EXPIRED_CODES:
+                    expired = True
+                req.close()
+                continue
+            content_length = req.getheader('Content-Length')
+            # Fixed: baiduPCS using non iso-8859-1 codec in http headers
+            if not content_length:
+                match = re.search('\sContent-Length:\s*(\d+)',
+                                  str(req.headers))
+                if not match:
+                    req.close()
+                    continue
+                content_length = match.group(1)
+            size = int(content_length)
+            if req.code == 206:
+                match = re.match('bytes\s+0-(\d+)/(\d+)',
+                                 req.getheader('Content-Range') or '')
+                if (not match or int(match.group(1)) + 1 != size or
+                        int(match.group(2)) != size):
+                    logger.warn('Downloader.probe_size: bad Content-Range, %s'
+                                % url)
+                    req.close()
+                    continue
+            return url, req, size
+        # 链接已失效, 重试时重新获取
+        if expired:
+            self.link_cache.invalidate(self.row[PATH_COL])
+        return None
+
+    def load_journal(self, conf_filepath, size):
+        '''读取断点续传日志, 旧版本的JSON 格式会被转换成新的日志'''
+        try:
+            journal, status = ResumeJournal.load(conf_filepath,
+                                                 self.fsync_mode)
+            if journal:
+                if journal.size != size:
+                    journal.close()
+                    return None, None
+                return journal, status
+            status = load_status(conf_filepath, size)
+            return ResumeJournal.create(conf_filepath, size, status,
+                                        self.fsync_mode), status
+        except (OSError, ValueError, TypeError):
+            logger.error(traceback.format_exc())
+            return None, None
+
+    def fill_batches(self):
+        '''为所有空闲的连接分配任务.
+
+        先从MirrorSelector 选出mirror, 再按它的主机从TransferScheduler 申请
+        连接, 申请不到时, 等它通知.
+        '''
+        while len(self.batches) < self.threads:
+            if self.stream:
+                url = self.mirrors.attach(self.stream[0])
+            else:
+                url = self.mirrors.acquire()
+            if not url:
+                # 所有mirror 都已弃用
+                if not self.batches and not self.is_finished():
+                    self.row[STATE_COL] = State.ERROR
+                break
+            host = urllib.parse.urlparse(url).netloc
+            if not self.scheduler.try_acquire(self, host, self.wakeup):
+                self.mirrors.release(url)
+                break
+            if not self.schedule_batch(url, host):
+                self.scheduler.release(self, host)
+                self.mirrors.release(url)
+                break
+
+    def wakeup(self):
+        '''TransferScheduler 中有连接被释放了'''
+        self.queue.put((None, BATCH_WAKEUP), block=False)
+
+    def auto_tune(self):
+        '''根据SegmentTuner 的结果, 调整连接数及数据块大小'''
+        rtts = [batch.rtt for batch in self.batches if batch.rtt]
+        rtt = sum(rtts) / len(rtts) if rtts else 0
+        if not self.tuner.tune(rtt, self.mirrors.best_speed()):
+            return
+        for batch in self.batches:
+            batch.chunk_size = self.tuner.chunk_size
+        self.threads = self.tuner.segments
+        # 减少连接时, 停止最后启动的那些线程, 它们的分片会在之后被重新分配
+        while len(self.batches) > self.threads:
+            self.batches.pop().stop()
+        self.fill_batches()
+
+    def is_finished(self):
+        return all(start + received >= end
+                   for start, end, received in self.status)
+
+    def get_segment_offset(self, id_):
+        '''分片当前的下载位置, 下载线程的offset 可能比status 里的新'''
+        start, end, received = self.status[id_]
+        offset = start + received
+        for batch in self.batches:
+            if batch.id_ == id_:
+                offset = max(offset, batch.offset)
+        return min(offset, end)
+
+    def start_batch(self, id_, start_size, url, host):
+        stream = None
+        if self.stream and start_size == 0 and url == self.stream[0]:
+            stream, self.stream = self.stream[:2], None
+        batch = DownloadBatch(id_, self.queue, self.mirrors, url, start_size,
+                              self.status[id_][1], self.fd, self.timeout,
+                              self.buffer_size, stream)
+        if self.tuner:
+            batch.chunk_size = self.tuner.chunk_size
+        # 这个连接已在fill_batches() 中申请过了
+        batch.slot = (self.scheduler, self, host)
+        batch.limiter = self.limiter
+        self.batches.append(batch)
+        batch.start()
+
+    def stop_segment(self, id_):
+        '''分片已完成, 停止下载它的所有线程'''
+        for batch in [b for b in self.batches if b.id_ == id_]:
+            batch.stop()
+            self.batches.remove(batch)
+
+    def schedule_batch(self, url, host):
+        '''为空闲的连接分配任务, 如果没有可分配的, 就返回False.
+
+        依次尝试:
+          * 尚未开始下载的分片;
+          * 拆分剩余数据最多的分片, 新线程下载它的后半部分;
+          * endgame 阶段, 重复下载还未完成的分片, 谁先完成就用谁的.
+        url, host 是已经为这个连接分配好的mirror 及其主机.
+        '''
+        busy = {}
+        for batch in self.batches:
+            busy[batch.id_] = busy.get(batch.id_, 0) + 1
+        remaining = []
+        for id_, (start, end, received) in enumerate(self.status):
+            offset = self.get_segment_offset(id_)
+            if offset >= end:
+                continue
+            if id_ not in busy:
+                self.start_batch(id_, offset, url, host)
+                return True
+            remaining.append((end - offset, id_, offset))
+        if not remaining:
+            return False
+
+        size, id_, offset = max(remaining)
+        if (size >= MIN_STEAL_SIZE * 2 and busy[id_] == 1 and
+                len(self.status) < JOURNAL_MAX_SEGMENTS):
+            split = offset + size // 2
+            end = self.status[id_][1]
+            self.status[id_][1] = split
+            for batch in self.batches:
+                if batch.id_ == id_:
+                    batch.end_size = split
+            self.status.append([split, end, 0])
+            logger.debug('Downloader: split segment %s at %s' % (id_, split))
+            self.start_batch(len(self.status) - 1, split, url, host)
+            return True
+
+        for size, id_, offset in sorted(remaining, reverse=True):
+            if busy[id_] <= ENDGAME_DUPLICATES:
+                logger.debug('Downloader: endgame, duplicate segment %s' % id_)
+                self.start_batch(id_, offset, url, host)
+                return True
+        return False
+
     def destroy(self):
         '''自毁'''
         self.pause()
@@ -136,6 +136,9 @@ class PreferencesDialog(Gtk.Dialog):
         segments_spin.set_value(self.app.profile['download-segments'])
         segments_spin.props.halign = Gtk.Align.START
         segments_spin.connect('value-changed', self.on_segments_value_changed)
+        segments_spin.set_sensitive(
+                not self.app.profile['download-segments-auto'])
+        self.segments_spin = segments_spin
         download_grid.attach(segments_spin, 1, 2, 1, 1)
         segments_label2 = Gtk.Label.new(_('connections'))
         segments_label2.props.xalign = 0
@@ -191,6 +194,76 @@ class PreferencesDialog(Gtk.Dialog):
         confirm_deletion_switch.props.halign = Gtk.Align.START
         download_grid.attach(confirm_deletion_switch, 1, 6, 1, 1)
 
+        segments_auto_label = Gtk.Label.new(_('Tune connections automatically:'))
+        segments_auto_label.props.xalign = 1
+        download_grid.attach(segments_auto_label, 0, 7, 1, 1)
+        segments_auto_switch = Gtk.Switch()
+        segments_auto_switch.set_active(
+                self.app.profile['download-segments-auto'])
+        segments_auto_switch.connect('notify::active',
+                                     self.on_segments_auto_switch_activate)
+        segments_auto_switch.props.halign = Gtk.Align.START
+        segments_auto_switch.set_tooltip_text(
+                _('Adjust connections per task and read size to the measured bandwidth and latency'))
+        download_grid.attach(segments_auto_switch, 1, 7, 1, 1)
+
+        transfer_conns_label = Gtk.Label.new(_('Total connections:'))
+        transfer_conns_label.props.xalign = 1
+        download_grid.attach(transfer_conns_label, 0, 8, 1, 1)
+        transfer_conns_spin = Gtk.SpinButton.new_with_range(1, 64, 1)
+        transfer_conns_spin.set_value(
+                self.app.profile['transfer-connections'])
+        transfer_conns_spin.props.halign = Gtk.Align.START
+        transfer_conns_spin.set_tooltip_text(
+                _('Connections shared by all downloads and uploads'))
+        transfer_conns_spin.connect('value-changed',
+                                    self.on_transfer_conns_value_changed)
+        download_grid.attach(transfer_conns_spin, 1, 8, 1, 1)
+
+        download_limit_label = Gtk.Label.new(_('Download speed limit:'))
+        download_limit_label.props.xalign = 1
+        download_grid.attach(download_limit_label, 0, 9, 1, 1)
+        download_limit_spin = Gtk.SpinButton.new_with_range(0, 1048576, 10)
+        download_limit_spin.set_value(self.app.profile['download-limit'])
+        download_limit_spin.props.halign = Gtk.Align.START
+        download_limit_spin.set_tooltip_text(_('0 means no limit'))
+        download_limit_spin.connect('value-changed',
+                                    self.on_limit_value_changed,
+                                    'download-limit')
+        download_grid.attach(download_limit_spin, 1, 9, 1, 1)
+        download_limit_unit = Gtk.Label.new(_('kB/s'))
+        download_limit_unit.props.xalign = 0
+        download_grid.attach(download_limit_unit, 2, 9, 1, 1)
+
+        bandwidth_limit_label = Gtk.Label.new(_('Total speed limit:'))
+        bandwidth_limit_label.props.xalign = 1
+        download_grid.attach(bandwidth_limit_label, 0, 10, 1, 1)
+        bandwidth_limit_spin = Gtk.SpinButton.new_with_range(0, 1048576, 10)
+        bandwidth_limit_spin.set_value(self.app.profile['bandwidth-limit'])
+        bandwidth_limit_spin.props.halign = Gtk.Align.START
+        bandwidth_limit_spin.set_tooltip_text(
+                _('Shared by downloads and uploads, 0 means no limit'))
+        bandwidth_limit_spin.connect('value-changed',
+                                     self.on_limit_value_changed,
+                                     'bandwidth-limit')
+        download_grid.attach(bandwidth_limit_spin, 1, 10, 1, 1)
+        bandwidth_limit_unit = Gtk.Label.new(_('kB/s'))
+        bandwidth_limit_unit.props.xalign = 0
+        download_grid.attach(bandwidth_limit_unit, 2, 10, 1, 1)
+
+        concurr_small_label = Gtk.Label.new(_('Concurrent small downloads:'))
+        concurr_small_label.props.xalign = 1
+        download_grid.attach(concurr_small_label, 0, 11, 1, 1)
+        concurr_small_spin = Gtk.SpinButton.new_with_range(0, 10, 1)
+        concurr_small_spin.set_value(
+                self.app.profile['concurr-small-download'])
+        concurr_small_spin.props.halign = Gtk.Align.START
+        concurr_small_spin.set_tooltip_text(
+                _('Files up to 16M are not blocked by large files'))
+        concurr_small_spin.connect('value-changed',
+                                   self.on_concurr_small_download_value_changed)
+        download_grid.attach(concurr_small_spin, 1, 11, 1, 1)
+
 
         # upload tab
         upload_grid = Gtk.Grid()
@@ -260,6 +333,35 @@ class PreferencesDialog(Gtk.Dialog):
         dest_dir_button.connect('clicked', self.on_destdir_clicked)
         upload_grid.attach(dest_dir_button, 1, 5, 1, 1)
 
+        upload_limit_label = Gtk.Label.new(_('Upload speed limit:'))
+        upload_limit_label.props.xalign = 1
+        upload_grid.attach(upload_limit_label, 0, 6, 1, 1)
+        upload_limit_spin = Gtk.SpinButton.new_with_range(0, 1048576, 10)
+        upload_limit_spin.set_value(self.app.profile['upload-limit'])
+        upload_limit_spin.props.halign = Gtk.Align.START
+        upload_limit_spin.set_tooltip_text(_('0 means no limit'))
+        upload_limit_spin.connect('value-changed',
+                                  self.on_limit_value_changed, 'upload-limit')
+        upload_grid.attach(upload_limit_spin, 1, 6, 1, 1)
+        upload_limit_unit = Gtk.Label.new(_('kB/s'))
+        upload_limit_unit.props.xalign = 0
+        upload_grid.attach(upload_limit_unit, 2, 6, 1, 1)
+
+        slice_threads_label = Gtk.Label.new(_('Per task:'))
+        slice_threads_label.props.xalign = 1
+        upload_grid.attach(slice_threads_label, 0, 7, 1, 1)
+        slice_threads_spin = Gtk.SpinButton.new_with_range(1, 8, 1)
+        slice_threads_spin.set_value(self.app.profile['upload-slice-threads'])
+        slice_threads_spin.props.halign = Gtk.Align.START
+        slice_threads_spin.set_tooltip_text(
+                _('Slices of a large file uploaded at the same time'))
+        slice_threads_spin.connect('value-changed',
+                                   self.on_slice_threads_value_changed)
+        upload_grid.attach(slice_threads_spin, 1, 7, 1, 1)
+        slice_threads_label2 = Gtk.Label.new(_('connections'))
+        slice_threads_label2.props.xalign = 0
+        upload_grid.attach(slice_threads_label2, 2, 7, 1, 1)
+
         sync_elements = (sync_dir_label, sync_dir_button, sync_dest_dir_label,
                          dest_dir_button)
         for element in sync_elements:
@@ -296,6 +398,9 @@ class PreferencesDialog(Gtk.Dialog):
     def on_concurr_download_value_changed(self, concurr_spin):
         self.app.profile['concurr-download'] = concurr_spin.get_value()
 
+    def on_concurr_small_download_value_changed(self, concurr_spin):
+        self.app.profile['concurr-small-download'] = concurr_spin.get_value()
+
     def on_dir_update(self, file_button):
         dir_name = file_button.get_filename()
         if dir_name:
@@ -304,6 +409,20 @@ class PreferencesDialog(Gtk.Dialog):
     def on_segments_value_changed(self, segments_spin):
         self.app.profile['download-segments'] = segments_spin.get_value()
 
+    def on_segments_auto_switch_activate(self, switch, event):
+        status = switch.get_active()
+        self.app.profile['download-segments-auto'] = status
+        self.segments_spin.set_sensitive(not status)
+
+    def on_transfer_conns_value_changed(self, transfer_conns_spin):
+        self.app.profile['transfer-connections'] = \
+                transfer_conns_spin.get_value()
+
+    def on_limit_value_changed(self, limit_spin, key):
+        '''修改限速值, 立即生效'''
+        self.app.profile[key] = int(limit_spin.get_value())
+        self.app.bandwidth_limiter.configure(self.app.profile)
+
     def on_retries_value_changed(self, retries_spin):
         self.app.profile['retries-each'] = retries_spin.get_value()
 
@@ -321,6 +440,10 @@ class PreferencesDialog(Gtk.Dialog):
     def on_concurr_upload_value_changed(self, concurr_spin):
         self.app.profile['concurr-upload'] = concurr_spin.get_value()
 
+    def on_slice_threads_value_changed(self, slice_threads_spin):
+        self.app.profile['upload-slice-threads'] = \
+                slice_threads_spin.get_value()
+
     def on_upload_hidden_switch_activate(self, switch, event):
         self.app.profile['upload-hidden-files'] = switch.get_active()
 
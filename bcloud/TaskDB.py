@@ -0,0 +1,216 @@
+
+# Copyright (C) 2014-2015 LiuLang <gsushzhsosgsu@gmail.com>
+# Use of this source code is governed by GPLv3 license that can be found
+# in http://www.gnu.org/licenses/gpl-3.0.html
+
+from queue import Queue, Empty
+import sqlite3
+import threading
+import time
+import traceback
+
+from bcloud.log import logger
+
+FLUSH_INTERVAL = 1  # 每隔1秒把积累的修改写入数据库
+WAIT_INTERVAL = 0.5  # 等待后台线程回复时, 每隔0.5秒检查一次它是否已退出
+
+# 队列中的操作类型
+EXECUTE, UPDATE, QUERY, FLUSH, CLOSE = list(range(5))
+
+
+class TaskDB:
+    '''在后台线程中读写任务数据库.
+
+    SQLite 连接只在后台线程中使用, 并开启了WAL 模式. 主线程调用execute()/
+    update() 时只是把修改放入队列, 后台线程每隔FLUSH_INTERVAL 秒在一个事务
+    中写入它们: 同一个key 的多次update() 只保留最后一次, 相邻的同一条SQL
+    语句用executemany() 批量执行. 这样fsync 就不会阻塞Gtk 的主循环了.
+
+    execute() 可以指定key, 这时它之前的update() 不会和之后的合并, 比如
+    在把任务移到另一个表之前, 它的最新状态一定会被写入.
+
+    query() 会等待之前的修改都被执行后再查询, 所以总能读到最新的数据.
+    数据库关闭之后再调用query() 或者flush(wait=True), 会抛出
+    sqlite3.ProgrammingError.
+
+    每条语句都在自己的savepoint 中执行, 出错时只撤销这一条, 同一事务中的
+    其它修改照常提交; 但同一个key 之后的操作会被跳过, 比如把任务移到存档
+    表时, 插入失败了, 就不能再把它从原来的表中删除.
+    '''
+
+    def __init__(self, db_path, flush_interval=FLUSH_INTERVAL):
+        self.db_path = db_path
+        self.flush_interval = flush_interval
+        self.queue = Queue()
+        self.closed = False
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def execute(self, sql, params=(), key=None):
+        '''按顺序执行一条修改数据库的SQL 语句'''
+        self.queue.put((EXECUTE, key, sql, params, None))
+
+    def update(self, key, sql, params=()):
+        '''更新一条记录; 提交之前同一个key 的更新只有最后一次会被执行'''
+        self.queue.put((UPDATE, key, sql, params, None))
+
+    def query(self, sql, params=()):
+        '''查询数据库, 会阻塞直到后台线程返回结果, 返回所有的记录'''
+        result = {}
+        event = threading.Event()
+        self.check_closed()
+        self.queue.put((QUERY, None, sql, params, (event, result)))
+        self.wait(event)
+        return result.get('rows', [])
+
+    def flush(self, wait=False):
+        '''立即提交已有的修改'''
+        event = threading.Event()
+        if wait:
+            self.check_closed()
+        self.queue.put((FLUSH, None, None, None, (event, None)))
+        if wait:
+            self.wait(event)
+
+    def check_closed(self):
+        if self.closed:
+            raise sqlite3.ProgrammingError(
+                    'TaskDB is closed: {0}'.format(self.db_path))
+
+    def wait(self, event):
+        '''等待后台线程的回复, 线程已退出时不再等待'''
+        while not event.wait(WAIT_INTERVAL):
+            self.check_closed()
+
+    def close(self):
+        '''提交所有修改并关闭数据库'''
+        self.queue.put((CLOSE, None, None, None, None))
+        self.thread.join()
+
+    def run(self):
+        try:
+            self.serve()
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            self.closed = True
+
+    def serve(self):
+        conn = sqlite3.connect(self.db_path, isolation_level=None)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')
+            # WAL 模式下, 只在checkpoint 时才需要fsync
+            conn.execute('PRAGMA synchronous=NORMAL')
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+        ops = []
+        deadline = None
+        while True:
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            try:
+                op = self.queue.get(timeout=timeout)
+            except Empty:
+                self.commit(conn, ops)
+                ops = []
+                deadline = None
+                continue
+            kind, key, sql, params, waiter = op
+            if kind in (EXECUTE, UPDATE):
+                ops.append(op)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_interval
+                continue
+
+            self.commit(conn, ops)
+            ops = []
+            deadline = None
+            if kind == QUERY:
+                event, result = waiter
+                try:
+                    result['rows'] = conn.execute(sql, params).fetchall()
+                except sqlite3.Error:
+                    logger.error(traceback.format_exc())
+                event.set()
+            elif kind == FLUSH:
+                waiter[0].set()
+            elif kind == CLOSE:
+                conn.close()
+                break
+
+    def commit(self, conn, ops):
+        '''在一个事务中执行ops'''
+        if not ops:
+            return
+        # 同一个key 的更新只保留最后一次, 放在它最后出现的位置; 带有这个
+        # key 的execute() 把更新分成前后两段, 它们不会被合并
+        epochs = {}
+        op_keys = []
+        last_update = {}
+        for index, op in enumerate(ops):
+            kind, key = op[0], op[1]
+            if key is None:
+                op_keys.append(None)
+            elif kind == UPDATE:
+                op_key = (key, op[2], epochs.get(key, 0))
+                op_keys.append(op_key)
+                last_update[op_key] = index
+            else:
+                op_keys.append(None)
+                epochs[key] = epochs.get(key, 0) + 1
+        batches = []  # [(sql, [(key, params), ...]), ]
+        for index, op in enumerate(ops):
+            kind, key, sql, params, waiter = op
+            if kind == UPDATE and last_update[op_keys[index]] != index:
+                continue
+            if batches and batches[-1][0] == sql:
+                batches[-1][1].append((key, params))
+            else:
+                batches.append((sql, [(key, params)]))
+        try:
+            conn.execute('BEGIN')
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+            return
+        failed_keys = set()
+        for sql, items in batches:
+            items = [item for item in items if item[0] not in failed_keys]
+            if not items:
+                continue
+            if len(items) > 1 and self.execute_savepoint(
+                    conn, conn.executemany, sql,
+                    [params for key, params in items], log=False):
+                continue
+            # 逐条重新执行, 找出出错的那条
+            for key, params in items:
+                if key in failed_keys:
+                    continue
+                if not self.execute_savepoint(conn, conn.execute, sql,
+                                              params):
+                    if key is not None:
+                        failed_keys.add(key)
+        try:
+            conn.execute('COMMIT')
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+            try:
+                conn.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+
+    def execute_savepoint(self, conn, func, sql, params, log=True):
+        '''在savepoint 中执行语句, 出错时只撤销它, 并返回False'''
+        conn.execute('SAVEPOINT op')
+        try:
+            func(sql, params)
+        except sqlite3.Error:
+            if log:
+                logger.error('TaskDB: %s, %s\n%s' %
+                             (sql, params, traceback.format_exc()))
+            conn.execute('ROLLBACK TO op')
+            conn.execute('RELEASE op')
+            return False
+        conn.execute('RELEASE op')
+        return True
@@ -0,0 +1,285 @@
+
+# Copyright (C) 2014-2015 LiuLang <gsushzhsosgsu@gmail.com>
+# Use of this source code is governed by GPLv3 license that can be found
+# in http://www.gnu.org/licenses/gpl-3.0.html
+
+import collections
+import math
+import threading
+import time
+
+from bcloud.log import logger
+
+HOST_CONNECTIONS = 8  # 同一个主机上最多同时使用的连接数
+# 以下用于限速
+DOWNLOAD, UPLOAD = 0, 1
+BUCKET_BURST = 0.2    # 令牌桶最多积累0.2秒的流量, 这样限速比较平滑
+MIN_QUANTUM = 4096    # 限速时每次读写的最小数据量
+SCHEDULE_CHECK_INTERVAL = 60  # 每隔60秒检查一次限速时间表
+# 限速相关的设置项, 单位都是kB/s, 0 表示不限速
+LIMIT_KEYS = ('bandwidth-limit', 'download-limit', 'upload-limit')
+
+
+class TransferScheduler:
+    '''管理所有上传及下载任务共用的连接.
+
+    每个连接(下载线程或者正在上传的分片) 开始前都要先在这里申请, 结束后
+    释放. 总连接数不超过max_conns, 同一个主机上的连接数不超过host_conns.
+
+    公平分配: 每个任务先最多占用max_conns / 任务数 个连接; 只有没有份额
+    未满的任务在等待时, 才能超过这个份额. 一个连接被释放后, 正在等待的任务
+    会收到通知, 这样它就可以被交给别的任务使用.
+    '''
+
+    def __init__(self, max_conns, host_conns=HOST_CONNECTIONS):
+        self.max_conns = max(1, int(max_conns))
+        self.host_conns = host_conns
+        self.cond = threading.Condition()
+        self.total = 0
+        self.hosts = collections.Counter()
+        self.tasks = {}  # {task: 已占用的连接数}
+        # 申请失败, 正在等待的任务, {task: (wakeup, host)}
+        self.waiting = collections.OrderedDict()
+        # 在acquire() 中阻塞等待的线程数, 同一个任务可能有多个线程在等待
+        self.blocked = collections.Counter()
+
+    def set_max_conns(self, max_conns):
+        with self.cond:
+            self.max_conns = max(1, int(max_conns))
+            self._notify()
+
+    def register(self, task):
+        with self.cond:
+            self.tasks.setdefault(task, 0)
+
+    def unregister(self, task):
+        '''任务结束, 它的份额会被分给其它任务'''
+        with self.cond:
+            self.tasks.pop(task, None)
+            self.waiting.pop(task, None)
+            self._notify()
+
+    def _share(self):
+        return math.ceil(self.max_conns / max(1, len(self.tasks)))
+
+    def _can_acquire(self, task, host):
+        if self.total >= self.max_conns:
+            return False
+        if self.hosts[host] >= self.host_conns:
+            return False
+        share = self._share()
+        if self.tasks.get(task, 0) < share:
+            return True
+        # 已超过公平份额, 只有没有份额未满的任务在等待时, 才能继续分配;
+        # 所在主机的连接已满的任务拿不到这个连接, 不用让给它
+        for waiting_task, (wakeup, waiting_host) in self.waiting.items():
+            if (waiting_task is not task and
+                    self.tasks.get(waiting_task, 0) < share and
+                    self.hosts[waiting_host] < self.host_conns):
+                return False
+        return True
+
+    def _take(self, task, host):
+        if not self.blocked[task]:
+            self.waiting.pop(task, None)
+        self.total += 1
+        self.hosts[host] += 1
+        if task in self.tasks:
+            self.tasks[task] += 1
+
+    def _notify(self):
+        self.cond.notify_all()
+        for wakeup, host in list(self.waiting.values()):
+            if wakeup:
+                wakeup()
+
+    def try_acquire(self, task, host, wakeup=None):
+        '''申请一个连接, 不会阻塞.
+
+        申请失败时返回False, 之后有连接被释放时, 会调用wakeup().
+        '''
+        with self.cond:
+            if self._can_acquire(task, host):
+                self._take(task, host)
+                return True
+            self.waiting[task] = (wakeup, host)
+            return False
+
+    def acquire(self, task, host, timeout=None):
+        '''申请一个连接, 最多等待timeout 秒, 成功后返回True'''
+        with self.cond:
+            if not self._can_acquire(task, host):
+                self.waiting.setdefault(task, (None, host))
+                self.blocked[task] += 1
+                try:
+                    acquired = self.cond.wait_for(
+                            lambda: self._can_acquire(task, host), timeout)
+                finally:
+                    self.blocked[task] -= 1
+                    if not self.blocked[task]:
+                        del self.blocked[task]
+                if not acquired:
+                    # 调用者可能不会再申请了(比如任务已暂停), 不能让它继续
+                    # 阻止其它任务超过份额
+                    if not self.blocked[task]:
+                        self.waiting.pop(task, None)
+                    return False
+            self._take(task, host)
+            return True
+
+    def move(self, task, old_host, new_host):
+        '''连接换到了另一个主机上, 比如下载线程换了mirror.
+
+        新主机上的连接已满时不会切换, 返回False.
+        '''
+        with self.cond:
+            if self.hosts[new_host] >= self.host_conns:
+                return False
+            self.hosts[old_host] -= 1
+            self.hosts[new_host] += 1
+            self._notify()
+            return True
+
+    def release(self, task, host):
+        with self.cond:
+            self.total -= 1
+            self.hosts[host] -= 1
+            if task in self.tasks:
+                self.tasks[task] -= 1
+            self._notify()
+
+
+class TokenBucket:
+    '''令牌桶, 可被多个线程共用.
+
+    rate 是每秒的字节数, 0 表示不限速. 令牌最多积累BUCKET_BURST 秒, 令牌
+    不够时允许透支, 由调用者等待相应的时间, 这样多个线程会按申请的顺序
+    依次得到带宽.
+    '''
+
+    def __init__(self, rate=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.tokens = 0
+        self.timestamp = time.monotonic()
+
+    def set_rate(self, rate):
+        with self.lock:
+            if rate != self.rate:
+                self.rate = rate
+                self.tokens = 0
+                self.timestamp = time.monotonic()
+
+    def reserve(self, size):
+        '''取出size 个令牌, 返回需要等待的秒数'''
+        with self.lock:
+            if not self.rate:
+                return 0
+            now = time.monotonic()
+            self.tokens = min(self.rate * BUCKET_BURST,
+                              self.tokens + (now - self.timestamp) * self.rate)
+            self.timestamp = now
+            self.tokens -= size
+            return max(0, -self.tokens / self.rate)
+
+
+class BandwidthLimiter:
+    '''所有上传及下载任务共用的限速器.
+
+    包括总的限速以及上传/下载各自的限速, 取值来自profile, 修改之后要调用
+    configure(). profile['bandwidth-schedule'] 是一周内的限速时间表, 每项
+    是一个dict, 比如:
+      {"days": [0, 1, 2, 3, 4], "start": "09:00", "end": "18:00",
+       "upload-limit": 100}
+    days 中0 表示周一; end 早于start 时表示跨过午夜. 第一个匹配当前时间的
+    项里的限速值会替换profile 里的对应值.
+    '''
+
+    def __init__(self, profile):
+        self.total = TokenBucket()
+        self.buckets = (TokenBucket(), TokenBucket())
+        self.configure(profile)
+
+    def configure(self, profile):
+        self.profile = profile
+        self.limits, self.rules = self.parse_limits(profile)
+        self.apply()
+
+    def parse_limits(self, profile):
+        '''检查并解析profile 中的限速设置, 格式错误的项会被忽略.
+
+        返回(limits, rules), limits 是{key: kB/s}; rules 是
+        [(days, start, end, limits), ], start/end 是从午夜开始的分钟数.
+        这些设置可能被手动修改过, 所以只在这里检查一次, 不会在传输过程中
+        出错.
+        '''
+        limits = {}
+        for key in LIMIT_KEYS:
+            try:
+                limits[key] = max(0, int(profile.get(key, 0)))
+            except (TypeError, ValueError):
+                logger.warn('BandwidthLimiter: invalid %s: %r' %
+                            (key, profile.get(key)))
+                limits[key] = 0
+        rules = []
+        for rule in profile.get('bandwidth-schedule') or []:
+            try:
+                days = set(rule.get('days', range(7)))
+                hour, minute = rule.get('start', '00:00').split(':')
+                start = int(hour) * 60 + int(minute)
+                hour, minute = rule.get('end', '24:00').split(':')
+                end = int(hour) * 60 + int(minute)
+                rule_limits = {key: max(0, int(rule[key]))
+                               for key in LIMIT_KEYS if key in rule}
+            except (AttributeError, TypeError, ValueError):
+                logger.warn('BandwidthLimiter: invalid schedule: %r' % rule)
+                continue
+            rules.append((days, start, end, rule_limits))
+        return limits, rules
+
+    def get_limits(self, now=None):
+        '''返回当前时间的限速值, 单位是kB/s'''
+        limits = dict(self.limits)
+        now = time.localtime(now)
+        minutes = now.tm_hour * 60 + now.tm_min
+        for days, start, end, rule_limits in self.rules:
+            if now.tm_wday not in days:
+                continue
+            if start <= end:
+                matched = start <= minutes < end
+            else:
+                matched = minutes >= start or minutes < end
+            if matched:
+                limits.update(rule_limits)
+                break
+        return limits
+
+    def apply(self):
+        limits = self.get_limits()
+        self.total.set_rate(limits['bandwidth-limit'] * 1024)
+        self.buckets[DOWNLOAD].set_rate(limits['download-limit'] * 1024)
+        self.buckets[UPLOAD].set_rate(limits['upload-limit'] * 1024)
+        self.next_check = time.monotonic() + SCHEDULE_CHECK_INTERVAL
+
+    def chunk_size(self, direction, chunk_size):
+        '''限速时, 每次读写的数据量不超过BUCKET_BURST 秒的流量'''
+        rates = [bucket.rate for bucket in (self.total, self.buckets[direction])
+                 if bucket.rate]
+        if not rates:
+            return chunk_size
+        return max(MIN_QUANTUM, min(chunk_size, int(min(rates) * BUCKET_BURST)))
+
+    def consume(self, direction, size):
+        '''传输size 字节的数据之前调用, 超速时会在这里等待'''
+        if time.monotonic() >= self.next_check:
+            self.apply()
+        delay = max(self.total.reserve(size),
+                    self.buckets[direction].reserve(size))
+        if delay > 0:
+            time.sleep(delay)
+
+    def download(self, size):
+        self.consume(DOWNLOAD, size)
+
+    def upload(self, size):
+        self.consume(UPLOAD, size)
@@ -5,7 +5,6 @@
 
 import math
 import os
-import sqlite3
 
 from gi.repository import Gio
 from gi.repository import GLib
@@ -13,14 +12,18 @@ from gi.repository import GObject
 from gi.repository import Gtk
 from gi.repository import Pango
 
+from bcloud.ArchiveDialog import ArchiveDialog
 from bcloud import Config
 _ = Config._
 from bcloud.const import UploadState as State
 from bcloud.const import ValidatePathState
 from bcloud.const import ValidatePathStateText
 from bcloud.FolderBrowserDialog import FolderBrowserDialog
-from bcloud.Uploader import Uploader
+from bcloud.TaskDB import TaskDB
+from bcloud.Uploader import (Uploader, UploadPreflight, RemotePathCache,
+                             SliceSizer, SLICE_THRESHOLD)
 from bcloud import gutil
+from bcloud import hasher
 from bcloud.log import logger
 from bcloud import pcs
 from bcloud import util
@@ -29,6 +32,9 @@ from bcloud import util
     CURRSIZE_COL, STATE_COL, STATENAME_COL, HUMANSIZE_COL,
     PERCENT_COL, TOOLTIP_COL, THRESHOLD_COL) = list(range(12))
 TASK_FILE = 'upload.sqlite'
+ARCHIVE_TABLE = 'upload_archive'  # 已完成的任务
+HASH_CACHE_FILE = 'hash-cache.sqlite'
+HASH_AHEAD = 4  # 提前为这么多个等待中的任务计算md5
 
 StateNames = [
     _('UPLOADING'),
@@ -50,11 +56,11 @@ class UploadPage(Gtk.Box):
     tooltip = _('Uploading files')
     first_run = True
     workers = {}  # {`fid`: (worker, row)}
-    commit_count = 0
 
     def __init__(self, app):
         super().__init__(orientation=Gtk.Orientation.VERTICAL)
         self.app = app
+        self.progress = gutil.ProgressAggregator(self.on_progress)
         if Config.GTK_GE_312:
             self.headerbar = Gtk.HeaderBar()
             self.headerbar.props.show_close_button = True
@@ -94,6 +100,14 @@ class UploadPage(Gtk.Box):
                                        self.on_open_folder_button_clicked)
             self.headerbar.pack_start(open_folder_button)
 
+            archive_button = Gtk.Button()
+            archive_img = Gtk.Image.new_from_icon_name(
+                    'document-open-recent-symbolic', Gtk.IconSize.SMALL_TOOLBAR)
+            archive_button.set_image(archive_img)
+            archive_button.set_tooltip_text(_('Finished tasks'))
+            archive_button.connect('clicked', self.on_archive_button_clicked)
+            self.headerbar.pack_start(archive_button)
+
             upload_box = Gtk.Box()
             upload_box_context = upload_box.get_style_context()
             upload_box_context.add_class(Gtk.STYLE_CLASS_RAISED)
@@ -171,6 +185,10 @@ class UploadPage(Gtk.Box):
             open_folder_button.props.margin_left = 40
             control_box.pack_start(open_folder_button, False, False, 0)
 
+            archive_button = Gtk.Button.new_with_label(_('Finished tasks'))
+            archive_button.connect('clicked', self.on_archive_button_clicked)
+            control_box.pack_start(archive_button, False, False, 0)
+
             remove_finished_button = Gtk.Button.new_with_label(
                     _('Remove completed tasks'))
             remove_finished_button.connect('clicked',
@@ -191,6 +209,8 @@ class UploadPage(Gtk.Box):
                                        GObject.TYPE_INT64, GObject.TYPE_INT64,
                                        int, str, str, GObject.TYPE_INT, str,
                                        GObject.TYPE_INT64)
+        self.row_index = gutil.RowIndex(self.liststore, FID_COL,
+                                        SOURCEPATH_COL, state_column=STATE_COL)
         self.treeview = Gtk.TreeView(model=self.liststore)
         self.treeview.set_headers_clickable(True)
         self.treeview.set_reorderable(True)
@@ -249,9 +269,19 @@ class UploadPage(Gtk.Box):
         if not os.path.exists(cache_path):
             os.makedirs(cache_path, exist_ok=True)
         db = os.path.join(cache_path, TASK_FILE)
-        self.conn = sqlite3.connect(db)
-        self.cursor = self.conn.cursor()
-        sql = '''CREATE TABLE IF NOT EXISTS upload (
+        self.db = TaskDB(db)
+        # 本地文件的md5 缓存, 由Uploader 使用
+        self.hash_cache = hasher.HashCache(
+                os.path.join(cache_path, HASH_CACHE_FILE))
+        self.hash_pool = hasher.HashPool(self.hash_cache)
+        self.hashed = set()  # md5 已经算好的任务的fid
+        self.preflighting = set()  # 正在由UploadPreflight 预检的任务的fid
+        self.preflighted = set()  # 预检完成, 只需上传文件内容的任务的fid
+        # 根据测量到的网速选择新任务的分片大小
+        self.slice_sizer = SliceSizer()
+        # 远程目录/文件是否存在, 由Uploader 和UploadPreflight 共用
+        self.path_cache = RemotePathCache(self.slice_sizer)
+        sql = '''CREATE TABLE IF NOT EXISTS {0} (
         fid INTEGER PRIMARY KEY,
         name CHAR NOT NULL,
         source_path CHAR NOT NULL,
@@ -266,46 +296,81 @@ class UploadPage(Gtk.Box):
         threshold INTEGER NOT NULL
         )
         '''
-        self.cursor.execute(sql)
+        self.db.execute(sql.format('upload'))
+        # 已完成的任务被移到存档表中, 启动时不会被读入
+        self.db.execute(sql.format(ARCHIVE_TABLE))
         sql = '''CREATE TABLE IF NOT EXISTS slice (
         fid INTEGER NOT NULL,
         slice_end INTEGER NOT NULL,
-        md5 CHAR NOT NULL
+        md5 CHAR NOT NULL,
+        slice_index INTEGER
         )
         '''
-        self.cursor.execute(sql)
+        self.db.execute(sql)
+        self.db.execute(
+                'CREATE INDEX IF NOT EXISTS upload_source_path '
+                'ON upload(source_path)')
+        # 旧版本的数据库里没有slice_index, 那时的分片是按顺序上传的,
+        # 可以由slice_end 算出它
+        columns = [r[1] for r in self.db.query('PRAGMA table_info(slice)')]
+        if 'slice_index' not in columns:
+            self.db.execute('ALTER TABLE slice ADD COLUMN slice_index INTEGER')
+            self.db.execute('''UPDATE slice SET slice_index =
+            (slice_end - 1) / (SELECT threshold FROM upload
+                               WHERE upload.fid = slice.fid)
+            ''')
+        # 每个分片只能有一条记录, 先去掉以前重复写入的记录
+        self.db.execute('''DELETE FROM slice WHERE rowid NOT IN
+        (SELECT MAX(rowid) FROM slice GROUP BY fid, slice_index)''')
+        self.db.execute('DROP INDEX IF EXISTS slice_fid')
+        self.db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS slice_fid_index
+        ON slice(fid, slice_index)''')
+        # 同一个文件上传到同一个位置, 在存档表中只保留最后一次的记录
+        self.db.execute('''DELETE FROM upload_archive WHERE rowid NOT IN
+        (SELECT MAX(rowid) FROM upload_archive GROUP BY source_path, path)''')
+        self.db.execute('''CREATE UNIQUE INDEX IF NOT EXISTS
+        upload_archive_path_index ON upload_archive(source_path, path)''')
+        # 以前的版本中, 已完成的任务也放在upload 表中
+        self.db.execute('''INSERT OR REPLACE INTO upload_archive
+        SELECT * FROM upload WHERE state=?''', [State.FINISHED, ])
+        self.db.execute('DELETE FROM upload WHERE state=?', [State.FINISHED, ])
+        # 新任务的fid 在这里分配, 这样添加任务时不用等待数据库返回lastrowid
+        self.next_fid = 1
+        for table in ('upload', ARCHIVE_TABLE):
+            sql = 'SELECT MAX(fid) FROM {0}'.format(table)
+            self.next_fid = max(self.next_fid,
+                                (self.db.query(sql)[0][0] or 0) + 1)
 
     def reload(self):
         pass
 
     def load_tasks_from_db(self):
         sql = 'SELECT * FROM upload'
-        req = self.cursor.execute(sql)
-        for task in req:
-            self.liststore.append(task)
+        for task in self.db.query(sql):
+            self.row_index.append(task)
 
     def check_commit(self, force=False):
-        '''当修改数据库超过50次后, 就自动commit数据.'''
-        self.commit_count = self.commit_count + 1
-        if force or self.commit_count >= 50:
-            self.commit_count = 0
-            self.conn.commit()
+        '''数据由TaskDB 在后台定时提交, force 为True 时立即提交.'''
+        if force:
+            self.db.flush()
 
     def add_task_db(self, task, force=True):
         '''向数据库中写入一个新的任务记录, 并返回它的fid'''
+        fid = self.next_fid
+        self.next_fid += 1
         sql = '''INSERT INTO upload (
-        name, source_path, path, size, curr_size, state, state_name,
+        fid, name, source_path, path, size, curr_size, state, state_name,
         human_size, percent, tooltip, threshold)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
-        req = self.cursor.execute(sql, task)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)'''
+        self.db.execute(sql, [fid, ] + list(task))
         self.check_commit(force=force)
-        return req.lastrowid
+        return fid
 
-    def add_slice_db(self, fid, slice_end, md5):
-        '''在数据库中加入上传任务分片信息'''
-        sql = 'INSERT INTO slice VALUES(?, ?, ?)'
-        self.cursor.execute(sql, (fid, slice_end, md5))
-        self.check_commit()
+    def add_slice_db(self, fid, slice_index, slice_end, md5):
+        '''在数据库中加入上传任务分片信息, 同一个分片只保留最后一次的记录'''
+        sql = '''INSERT OR REPLACE INTO slice (fid, slice_end, md5, slice_index)
+        VALUES(?, ?, ?, ?)'''
+        self.db.execute(sql, (fid, slice_end, md5, slice_index))
 
     def get_task_db(self, source_path):
         '''从数据库中查询source_path的信息.
@@ -314,23 +379,24 @@ class UploadPage(Gtk.Box):
         如果没有的话, 就返回None
         '''
         sql = 'SELECT * FROM upload WHERE source_path=?'
-        req = self.cursor.execute(sql, [source_path, ])
-        if req:
-            return req.fetchone()
+        rows = self.db.query(sql, [source_path, ])
+        if rows:
+            return rows[0]
         else:
-            None
+            return None
 
     def get_slice_db(self, fid):
         '''从数据库中取得fid的所有分片.
         
-        返回的是一个list, 里面是按顺序排好的md5的值
+        返回的是一个list, 里面是按分片序号排好的md5的值
         '''
-        sql = 'SELECT md5 FROM slice WHERE fid=?'
-        req = self.cursor.execute(sql, [fid, ])
-        if req:
-            return [r[0] for r in req]
-        else:
-            return None
+        sql = 'SELECT md5 FROM slice WHERE fid=? ORDER BY slice_index'
+        return [r[0] for r in self.db.query(sql, [fid, ])]
+
+    def get_slice_indexes(self, fid):
+        '''从数据库中取得fid 已上传完成的分片序号'''
+        sql = 'SELECT slice_index FROM slice WHERE fid=?'
+        return [r[0] for r in self.db.query(sql, [fid, ])]
 
     def update_task_db(self, row, force=False):
         '''更新数据库中的任务信息'''
@@ -338,32 +404,46 @@ class UploadPage(Gtk.Box):
         curr_size=?, state=?, state_name=?, human_size=?, percent=?
         WHERE fid=?
         '''
-        self.cursor.execute(sql, [
+        self.db.update(row[FID_COL], sql, [
             row[CURRSIZE_COL], row[STATE_COL], row[STATENAME_COL],
             row[HUMANSIZE_COL], row[PERCENT_COL], row[FID_COL]
         ])
         self.check_commit(force=force)
 
     def remove_task_db(self, fid, force=False):
-        '''将任务从数据库中删除'''
+        '''将任务从数据库中删除.
+
+        存档表中的记录不受影响, 它们只在ArchiveDialog 中被清除.
+        '''
         self.remove_slice_db(fid)
         sql = 'DELETE FROM upload WHERE fid=?'
-        self.cursor.execute(sql, [fid, ])
+        self.db.execute(sql, [fid, ], key=fid)
         self.check_commit(force=force)
 
+    def archive_task_db(self, fid):
+        '''把已完成的任务移到存档表中.
+
+        以前上传过的同一个文件的记录会被替换掉.
+        '''
+        sql = '''INSERT OR REPLACE INTO upload_archive
+        SELECT * FROM upload WHERE fid=?'''
+        self.db.execute(sql, [fid, ], key=fid)
+        sql = 'DELETE FROM upload WHERE fid=?'
+        self.db.execute(sql, [fid, ], key=fid)
+
     def remove_slice_db(self, fid):
         '''将上传任务的分片从数据库中删除'''
         sql = 'DELETE FROM slice WHERE fid=?'
-        self.cursor.execute(sql, [fid, ])
-        self.check_commit()
+        self.db.execute(sql, [fid, ])
 
     def on_destroy(self, *args):
         if not self.first_run:
-            self.conn.commit()
+            self.progress.flush()
             for row in self.liststore:
                 self.pause_task(row, scan=False)
-            self.conn.commit()
-            self.conn.close()
+            self.db.close()
+            self.hash_pool.stop()
+            self.hash_cache.close()
 
     # Open API
     def add_file_task(self, dir_name=None):
@@ -420,11 +500,27 @@ class UploadPage(Gtk.Box):
         dir_name    - 文件在服务器上的父目录, 如果为None的话, 会弹出一个
                       对话框让用户来选择一个目录.
         '''
-        def scan_folders(folder_path):
+        def add_tasks(source_paths, dir_name, in_folder=False):
+            for source_path in source_paths:
+                if util.validate_pathname(source_path) != ValidatePathState.OK:
+                    invalid_paths.append(source_path)
+                    continue
+                if (os.path.split(source_path)[1].startswith('.') and
+                        not self.app.profile['upload-hidden-files']):
+                    continue
+                if os.path.isfile(source_path):
+                    fid = self.upload_file(source_path, dir_name)
+                    if fid and in_folder:
+                        folder_fids.append(fid)
+                elif os.path.isdir(source_path):
+                    scan_folders(source_path, dir_name)
+
+        def scan_folders(folder_path, dir_name):
             file_list = os.listdir(folder_path)
             source_paths = [os.path.join(folder_path, f) for f in file_list]
-            self.upload_files(source_paths,
-                    os.path.join(dir_name, os.path.split(folder_path)[1]))
+            add_tasks(source_paths,
+                      os.path.join(dir_name, os.path.split(folder_path)[1]),
+                      in_folder=True)
 
         self.check_first()
         if not dir_name:
@@ -436,17 +532,10 @@ class UploadPage(Gtk.Box):
             dir_name = folder_dialog.get_path()
             folder_dialog.destroy()
         invalid_paths = []
-        for source_path in source_paths:
-            if util.validate_pathname(source_path) != ValidatePathState.OK:
-                invalid_paths.append(source_path)
-                continue
-            if (os.path.split(source_path)[1].startswith('.') and
-                    not self.app.profile['upload-hidden-files']):
-                continue
-            if os.path.isfile(source_path):
-                self.upload_file(source_path, dir_name)
-            elif os.path.isdir(source_path):
-                scan_folders(source_path)
+        folder_fids = []  # 目录中的文件, 要先经过批量预检
+        add_tasks(source_paths, dir_name)
+        if folder_fids:
+            self.start_preflight(folder_fids)
 
         self.app.blink_page(self)
         self.scan_tasks()
@@ -485,23 +574,18 @@ class UploadPage(Gtk.Box):
         dialog.destroy()
 
     def upload_file(self, source_path, dir_name):
-        '''上传一个文件'''
-        row = self.get_task_db(source_path)
+        '''上传一个文件, 返回新任务的fid'''
         source_dir, filename = os.path.split(source_path)
         
         path = os.path.join(dir_name, filename)
         size = os.path.getsize(source_path)
         total_size = util.get_human_size(size)[0]
         tooltip = gutil.escape(_('From {0}\nTo {1}').format(source_path, path))
-        if size < 2 ** 27:           # 128M 
-            threshold = 2 ** 17      # 128K
-        elif size < 2 ** 29:         # 512M
-            threshold =  2 ** 19     # 512K
-        elif size < 10 * (2 ** 30):  # 10G
-            threshold = math.ceil(size / 1000)
-        else:
-            self.app.toast(_('{0} is too large to upload (>10G).').format(path))
-            return
+        threshold = self.slice_sizer.get_slice_size(
+                size, int(self.app.profile['upload-slice-threads']))
+        if not threshold:
+            self.app.toast(_('{0} is too large to upload.').format(path))
+            return None
         task = [
             filename,
             source_path,
@@ -517,7 +601,48 @@ class UploadPage(Gtk.Box):
         ]
         row_id = self.add_task_db(task, force=False)
         task.insert(0, row_id)
-        self.liststore.append(task)
+        self.row_index.append(task)
+        return row_id
+
+    def start_preflight(self, fids):
+        '''在后台批量创建目录并尝试快速上传, 见UploadPreflight'''
+        def on_preflight_uploaded(preflight, fid):
+            GLib.idle_add(do_preflight_uploaded, fid)
+
+        def do_preflight_uploaded(fid):
+            self.preflighting.discard(fid)
+            row = self.get_row_by_fid(fid)
+            # 预检期间任务可能已被暂停, 删除或者启动了, 这时不能把它标记为
+            # 已完成; 继续上传时Uploader 会再检查一遍
+            if not row or row[STATE_COL] != State.WAITING:
+                self.scan_tasks()
+                return
+            self.set_task_uploaded(row)
+            self.scan_tasks()
+
+        def on_preflight_checked(preflight, fid, preflighted):
+            GLib.idle_add(do_preflight_checked, fid, preflighted)
+
+        def do_preflight_checked(fid, preflighted):
+            self.preflighting.discard(fid)
+            if preflighted:
+                self.preflighted.add(fid)
+                self.hashed.add(fid)
+            self.scan_tasks()
+
+        rows = []
+        for fid in fids:
+            row = self.get_row_by_fid(fid)
+            if row and row[STATE_COL] == State.WAITING:
+                rows.append(row)
+                self.preflighting.add(fid)
+        if not rows:
+            return
+        preflight = UploadPreflight(self, rows, self.app.cookie,
+                                    self.app.tokens)
+        preflight.connect('uploaded', on_preflight_uploaded)
+        preflight.connect('checked', on_preflight_checked)
+        preflight.start()
 
     def start_task(self, row, scan=True):
         '''启动上传任务.
@@ -544,6 +669,8 @@ class UploadPage(Gtk.Box):
 
     def pause_task(self, row, scan=True):
         '''暂停下载任务'''
+        # 预检的结果会被忽略, 继续上传时不用再等它
+        self.preflighting.discard(row[FID_COL])
         if row[STATE_COL] == State.UPLOADING:
             self.remove_worker(row[FID_COL], stop=False)
         if row[STATE_COL] in (State.UPLOADING, State.WAITING):
@@ -555,47 +682,90 @@ class UploadPage(Gtk.Box):
 
     def remove_task(self, row, scan=True):
         '''删除下载任务'''
+        self.preflighting.discard(row[FID_COL])
         if row[STATE_COL] == State.UPLOADING:
             self.remove_worker(row[FID_COL], stop=True)
         self.remove_task_db(row[FID_COL])
         tree_iter = row.iter
         if tree_iter:
-            self.liststore.remove(tree_iter)
+            self.row_index.remove(tree_iter)
         if scan:
             self.scan_tasks()
 
     def scan_tasks(self):
-        if len(self.workers.keys()) >= self.app.profile['concurr-upload']:
-            return
-        for row in self.liststore:
-            if len(self.workers.keys()) >= self.app.profile['concurr-upload']:
-                break
-            if row[STATE_COL] == State.WAITING:
-                self.start_worker(row)
+        '''启动等待中的任务.
+
+        大文件要先由HashPool 在后台算好md5, 才会被启动, 这样上传线程不用
+        等待磁盘; 同时提前为接下来的HASH_AHEAD 个任务计算md5.
+        '''
+        hash_ahead = 0
+        # 只访问等待中的任务, 正在预检的任务要等预检结束
+        free = max(0, self.app.profile['concurr-upload'] - len(self.workers))
+        for row in self.row_index.get_by_state(State.WAITING,
+                                               free + HASH_AHEAD,
+                                               exclude=self.preflighting):
+            if self.is_hashed(row):
+                if (len(self.workers.keys()) <
+                        self.app.profile['concurr-upload']):
+                    self.start_worker(row)
+            elif hash_ahead < HASH_AHEAD:
+                hash_ahead += 1
+                self.hash_pool.submit(row[FID_COL], row[SOURCEPATH_COL],
+                                      row[THRESHOLD_COL],
+                                      pcs.RAPIDUPLOAD_THRESHOLD,
+                                      self.on_file_hashed)
         return True
 
-    def start_worker(self, row):
-        def on_worker_slice_sent(worker, fid, slice_end, md5):
-            GLib.idle_add(do_worker_slice_sent, fid, slice_end, md5)
+    def is_hashed(self, row):
+        '''这个任务是否可以开始上传, 小文件不需要计算md5.
 
-        def do_worker_slice_sent(fid, slice_end, md5):
-            if fid not in self.workers:
-                return
-            row = self.get_row_by_fid(fid)
-            if not row:
-                return
-            row[CURRSIZE_COL] = slice_end
-            total_size = util.get_human_size(row[SIZE_COL])[0]
-            curr_size = util.get_human_size(slice_end, False)[0]
-            row[PERCENT_COL] = int(slice_end / row[SIZE_COL] * 100)
-            row[HUMANSIZE_COL] = '{0} / {1}'.format(curr_size, total_size)
-            self.update_task_db(row)
-            self.add_slice_db(fid, slice_end, md5)
+        这里只查看self.hashed, 不访问磁盘和HashCache; 缓存中已有的md5 由
+        HashPool 在后台线程中查到, 再通过on_file_hashed() 通知.
+        '''
+        return (row[FID_COL] in self.hashed or
+                row[SIZE_COL] <= SLICE_THRESHOLD)
+
+    def on_file_hashed(self, fid, error=None):
+        '''HashPool 完成了一个文件, 在工作线程中被调用'''
+        def do_file_hashed():
+            # 即使出错也标记为已完成, 由Uploader 来报告磁盘错误
+            self.hashed.add(fid)
+            self.scan_tasks()
+
+        GLib.idle_add(do_file_hashed)
+
+    def on_progress(self, fid, delta, value, slices):
+        '''由ProgressAggregator 定时调用, 保存已上传的分片并更新进度.
+
+        分片完成的顺序不确定, 所以已上传的大小是累加出来的.
+        '''
+        if fid not in self.workers:
+            return
+        row = self.get_row_by_fid(fid)
+        if not row:
+            return
+        row[CURRSIZE_COL] = min(row[CURRSIZE_COL] + delta, row[SIZE_COL])
+        total_size = util.get_human_size(row[SIZE_COL])[0]
+        curr_size = util.get_human_size(row[CURRSIZE_COL], False)[0]
+        row[PERCENT_COL] = int(row[CURRSIZE_COL] / row[SIZE_COL] * 100)
+        row[HUMANSIZE_COL] = '{0} / {1}'.format(curr_size, total_size)
+        self.update_task_db(row)
+        for slice_index, slice_end, md5 in slices:
+            self.add_slice_db(fid, slice_index, slice_end, md5)
+
+    def start_worker(self, row):
+        def on_worker_slice_sent(worker, fid, slice_index, slice_end, md5):
+            slice_size = slice_end - slice_index * worker.row[THRESHOLD_COL]
+            self.progress.update(fid, slice_size,
+                                 record=(slice_index, slice_end, md5))
 
         def on_worker_merge_files(worker, fid):
             GLib.idle_add(do_worker_merge_files, fid)
 
         def do_worker_merge_files(fid):
+            # 确保所有分片都已写入数据库
+            self.progress.flush()
+
             def on_create_superfile(pcs_file, error=None):
                 if error or not pcs_file:
                     self.app.toast(_('Failed to upload, please try again'))
@@ -613,13 +783,18 @@ class UploadPage(Gtk.Box):
             row = self.get_row_by_fid(fid)
             if not row:
                 return
-            if not block_list:
-                # TODO:
-                pass
-            else:
-                gutil.async_call(pcs.create_superfile, self.app.cookie,
-                                 row[PATH_COL], block_list,
-                                 callback=on_create_superfile)
+            # 分片记录不完整时不能合并, 出错后重新开始时会补传缺少的分片
+            slice_num = math.ceil(row[SIZE_COL] / row[THRESHOLD_COL])
+            if len(block_list) != slice_num:
+                logger.error('UploadPage.do_worker_merge_files: %s, '
+                             'expected %s slices, got %s' %
+                             (row[PATH_COL], slice_num, len(block_list)))
+                self.app.toast(_('Failed to upload, please try again'))
+                do_worker_error(fid)
+                return
+            gutil.async_call(pcs.create_superfile, self.app.cookie,
+                             row[PATH_COL], block_list,
+                             callback=on_create_superfile)
 
         def on_worker_uploaded(worker, fid):
             GLib.idle_add(do_worker_uploaded, fid)
@@ -630,15 +805,8 @@ class UploadPage(Gtk.Box):
             row = self.get_row_by_fid(fid)
             if not row:
                 return
-            row[PERCENT_COL] = 100
-            total_size = util.get_human_size(row[SIZE_COL])[0]
-            row[HUMANSIZE_COL] = '{0} / {1}'.format(total_size, total_size)
-            row[STATE_COL] = State.FINISHED
-            row[STATENAME_COL] = StateNames[State.FINISHED]
-            self.update_task_db(row, force=True)
             self.workers.pop(fid, None)
-            self.app.toast(_('{0} uploaded').format(row[NAME_COL]))
-            self.app.home_page.reload()
+            self.set_task_uploaded(row)
             self.scan_tasks()
 
         def on_worker_disk_error(worker, fid):
@@ -659,9 +827,12 @@ class UploadPage(Gtk.Box):
 
         if row[FID_COL] in self.workers:
             return
+        # 确保之前上传的分片都已写入数据库
+        self.progress.flush()
         row[STATE_COL] = State.UPLOADING
         row[STATENAME_COL] = StateNames[State.UPLOADING]
-        worker = Uploader(self, row, self.app.cookie, self.app.tokens)
+        worker = Uploader(self, row, self.app.cookie, self.app.tokens,
+                          preflighted=row[FID_COL] in self.preflighted)
         self.workers[row[FID_COL]] = (worker, row)
         # For slice upload
         worker.connect('slice-sent', on_worker_slice_sent)
@@ -672,9 +843,24 @@ class UploadPage(Gtk.Box):
         worker.connect('network-error', on_worker_network_error)
         worker.start()
 
+    def set_task_uploaded(self, row):
+        row[PERCENT_COL] = 100
+        total_size = util.get_human_size(row[SIZE_COL])[0]
+        row[HUMANSIZE_COL] = '{0} / {1}'.format(total_size, total_size)
+        row[STATE_COL] = State.FINISHED
+        row[STATENAME_COL] = StateNames[State.FINISHED]
+        self.update_task_db(row)
+        self.archive_task_db(row[FID_COL])
+        self.check_commit(force=True)
+        self.preflighted.discard(row[FID_COL])
+        self.app.toast(_('{0} uploaded').format(row[NAME_COL]))
+        self.app.home_page.reload()
+
     def remove_worker(self, fid, stop=True):
         if fid not in self.workers:
             return
+        # 先保存这个任务已上传的分片
+        self.progress.flush()
         worker = self.workers[fid][0]
         if stop:
             worker.stop()
@@ -683,16 +869,10 @@ class UploadPage(Gtk.Box):
         self.workers.pop(fid, None)
 
     def get_row_by_source_path(self, source_path):
-        for row in self.liststore:
-            if row[SOURCEPATH_COL] == source_path:
-                return row
-        return None
+        return self.row_index.get(source_path, SOURCEPATH_COL)
 
     def get_row_by_fid(self, fid):
-        for row in self.liststore:
-            if row[FID_COL] == fid:
-                return row
-        return None
+        return self.row_index.get(fid)
 
     def operate_selected_rows(self, operator):
         '''对选中的条目进行操作.
@@ -727,8 +907,20 @@ class UploadPage(Gtk.Box):
         for tree_iter in tree_iters:
             if tree_iter:
                 self.remove_task_db(self.liststore[tree_iter][FID_COL], False)
-                self.liststore.remove(tree_iter)
-        self.check_commit()
+                self.row_index.remove(tree_iter)
+        self.check_commit(force=True)
+
+    def on_archive_button_clicked(self, button):
+        self.check_first()
+        dialog = ArchiveDialog(self, self.app, _('Finished tasks'), self.db,
+                               ARCHIVE_TABLE, (
+                                   (_('Name'), 'name'),
+                                   (_('Size'), 'human_size'),
+                                   (_('From'), 'source_path'),
+                                   (_('To'), 'path'),
+                               ))
+        dialog.run()
+        dialog.destroy()
 
     def on_open_folder_button_clicked(self, button):
         model, tree_paths = self.selection.get_selected_rows()
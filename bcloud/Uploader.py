@@ -3,17 +3,26 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in http://www.gnu.org/licenses/gpl-3.0.html
 
+import collections
+import math
 import os
+from queue import Queue
 import sys
 import threading
+import time
+import traceback
+import urllib.parse
 
 from gi.repository import GLib
 from gi.repository import GObject
 from gi.repository import Gtk
 
+from bcloud import const
 from bcloud.const import UploadState as State
 from bcloud.const import UploadMode
+from bcloud import hasher
 from bcloud.log import logger
+from bcloud import net
 from bcloud import pcs
 
 (FID_COL, NAME_COL, SOURCEPATH_COL, PATH_COL, SIZE_COL,
@@ -22,15 +31,57 @@ from bcloud import pcs
 
 
 SLICE_THRESHOLD = 2 ** 18  # 256k, 小于这个值, 不允许使用分片上传
+UPLOAD_HOST = urllib.parse.urlparse(const.PCS_URL_C).netloc
+SCHEDULER_WAIT = 1  # 等待空闲连接时, 每隔1秒检查一次任务状态
+PREFLIGHT_THREADS = 8  # 上传目录时, 同时检查/创建目录以及尝试快速上传的线程数
+FILEMETAS_BATCH = 100  # 每次filemetas 请求最多查询的路径数
+ERRNO_NOT_FOUND = -9   # filemetas: 文件或目录不存在
+ERRNO_PARTIAL = 12     # filemetas: 有的路径出错了, 各自的结果在info 中
+# 以下用于选择分片大小
+SERVER_MAX_SLICES = 1024        # create_superfile 最多合并1024 个分片
+SERVER_MAX_SLICE_SIZE = 2 ** 31  # 服务器允许的单个分片最大为2G
+SLICE_MIN_SIZE = 2 ** 17  # 128K
+SLICE_MAX_SIZE = 2 ** 26  # 64M, 分片太大的话, 断点续传时要重传的数据也多
+SLICE_ALIGN = 2 ** 16     # 分片大小是64K 的整数倍
+SLICE_SECONDS = 2         # 每个分片至少要上传2秒
+SLICE_RTT_FACTOR = 10     # 并且至少是RTT 的10倍, 这样请求本身的开销不超过10%
+SLICE_EWMA = 0.3          # 测量值的平滑系数
+
+
+def parallel_map(func, items, threads=PREFLIGHT_THREADS):
+    '''用最多threads 个线程, 对items 中的每一项调用func, 全部完成后返回'''
+    def worker():
+        while True:
+            item = queue.get()
+            if item is None:
+                break
+            try:
+                func(item)
+            except Exception:
+                logger.error(traceback.format_exc())
+
+    queue = Queue()
+    for item in items:
+        queue.put(item)
+    workers = []
+    for i in range(min(threads, len(items))):
+        queue.put(None)
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+        workers.append(thread)
+    for thread in workers:
+        thread.join()
 
 
 class Uploader(threading.Thread, GObject.GObject):
 
     __gsignals__ = {
-        # 一个新的文件分片完成上传
-        # fid, slice_end, md5 
+        # 一个新的文件分片完成上传, 多个分片同时上传时, 完成的顺序是不确定的
+        # fid, slice_index, slice_end, md5
         'slice-sent': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
-                       (GObject.TYPE_INT, GObject.TYPE_INT64, str)),
+                       (GObject.TYPE_INT, GObject.TYPE_INT, GObject.TYPE_INT64,
+                        str)),
         # 请求UploadPage来合并文件分片
         'merge-files': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
                         (GObject.TYPE_INT, )),
@@ -45,10 +96,12 @@ class Uploader(threading.Thread, GObject.GObject):
 
     is_slice_upload = False
 
-    def __init__(self, parent, row, cookie, tokens):
+    def __init__(self, parent, row, cookie, tokens, preflighted=False):
         '''
-        parent    - UploadPage
-        row       - UploadPage.liststore中的一个记录
+        parent      - UploadPage
+        row         - UploadPage.liststore中的一个记录
+        preflighted - 这个任务已经通过了UploadPreflight, 目录已创建, 快速上传
+                      也没有命中, 可以直接上传文件内容
         '''
         threading.Thread.__init__(self)
         GObject.GObject.__init__(self)
@@ -58,10 +111,41 @@ class Uploader(threading.Thread, GObject.GObject):
         self.cookie = cookie
         self.tokens = tokens
         self.upload_mode = self.parent.app.profile['upload-mode']
+        self.scheduler = self.parent.app.transfer_scheduler
+        self.limiter = self.parent.app.bandwidth_limiter
+        self.slice_threads = int(self.parent.app.profile['upload-slice-threads'])
 
+        self.preflighted = preflighted
         self.row = row[:]
+        # 已经上传完成的分片序号, 在run() 中从数据库读入
+        self.slices = set()
+        # 本地算出的每个分片的md5, 用于校验上传的分片
+        self.slice_md5s = None
+        self.hash_cache = self.parent.hash_cache
+        self.path_cache = self.parent.path_cache
+        self.slice_sizer = self.parent.slice_sizer
+        self.lock = threading.Lock()
 
     def run(self):
+        self.scheduler.register(self)
+        try:
+            # 查询会等待TaskDB 提交之前的修改, 所以不能放在主线程中
+            self.slices = set(self.parent.get_slice_indexes(
+                    self.row[FID_COL]))
+            self.upload_task()
+        finally:
+            self.scheduler.unregister(self)
+
+    def upload_task(self):
+        if self.preflighted:
+            # 目录已经创建过, 快速上传也已经试过了
+            if self.row[SIZE_COL] > SLICE_THRESHOLD:
+                if self.hash_file():
+                    self.slice_upload()
+            else:
+                self.upload()
+            return
+
         if self.check_exists() and self.upload_mode == UploadMode.IGNORE:
             self.emit('uploaded', self.row[FID_COL])
             return
@@ -86,74 +170,451 @@ class Uploader(threading.Thread, GObject.GObject):
     def stop(self):
         self.row[STATE_COL] = State.CANCELED
 
-    def check_exists(self):
-        meta = pcs.get_metas(self.cookie, self.tokens, self.row[PATH_COL])
-        return meta and meta.get('errno', 12) == 0
+    def acquire_conn(self):
+        '''从TransferScheduler 申请一个连接, 任务被暂停或取消时返回False'''
+        while self.row[STATE_COL] == State.UPLOADING:
+            if self.scheduler.acquire(self, UPLOAD_HOST, SCHEDULER_WAIT):
+                return True
+        return False
 
-    def check_dir_exists(self, remotepath):
-        meta = pcs.get_metas(self.cookie, self.tokens, remotepath)
-        return meta.get('errno', 12) == 0
+    def release_conn(self):
+        self.scheduler.release(self, UPLOAD_HOST)
+
+    def check_exists(self):
+        path = self.row[PATH_COL]
+        return self.path_cache.get_exists(self.cookie, self.tokens,
+                                          [path]).get(path, False)
 
     def mkdir(self, remotepath):
-        if not self.check_dir_exists(remotepath):
-            return pcs.mkdir(self.cookie, self.tokens, remotepath)
+        '''由RemotePathCache 创建目录, 每个目录只会被检查/创建一次'''
+        return not self.path_cache.makedirs(self.cookie, self.tokens,
+                                            [remotepath])
 
     def upload(self):
         '''一般上传模式.
 
         使用这种方式上传, 不可以中断上传过程, 但因为只用它来上传小的文件, 所以
         最终的影响不会很大.'''
-        info = pcs.upload(self.cookie, self.row[SOURCEPATH_COL],
-                          self.row[PATH_COL], self.upload_mode)
+        if not self.acquire_conn():
+            return
+        try:
+            info = pcs.upload(self.cookie, self.row[SOURCEPATH_COL],
+                              self.row[PATH_COL], self.upload_mode,
+                              self.limiter.upload)
+        finally:
+            self.release_conn()
         if info:
             self.emit('uploaded', self.row[FID_COL])
         else:
             self.emit('network-error', self.row[FID_COL])
 
+    def hash_file(self):
+        '''只读取一遍文件, 同时算出快速上传要用的md5 以及每个分片的md5;
+        文件没有变化的话, 直接使用HashCache 里的结果.
+
+        返回(content_md5, head_md5), 读取文件出错时返回None.
+        '''
+        try:
+            result = self.hash_cache.md5_slices(
+                    self.row[SOURCEPATH_COL], self.row[THRESHOLD_COL],
+                    pcs.RAPIDUPLOAD_THRESHOLD)
+        except OSError:
+            logger.error(traceback.format_exc())
+            self.emit('disk-error', self.row[FID_COL])
+            return None
+        content_md5, head_md5, self.slice_md5s = result
+        return content_md5, head_md5
+
     def rapid_upload(self):
         '''快速上传.
 
         如果失败, 就自动调用分片上传.
         '''
+        result = self.hash_file()
+        if not result:
+            return
+        content_md5, head_md5 = result
         info = pcs.rapid_upload(self.cookie, self.tokens,
                                 self.row[SOURCEPATH_COL], self.row[PATH_COL],
-                                self.upload_mode)
-        if info and info['md5'] and info['fs_id']:
+                                self.upload_mode, content_md5, head_md5)
+        if info and info.get('md5') and info.get('fs_id'):
             self.emit('uploaded', self.row[FID_COL])
         else:
             self.slice_upload()
 
     def slice_upload(self):
-        '''分片上传'''
+        '''分片上传.
+
+        同时上传slice_threads 个分片, 每个分片的序号都记录在数据库里, 以便
+        断点续传; 合并时按序号排列它们的md5.
+        '''
         self.is_slice_upload = True
         fid = self.row[FID_COL]
-        slice_start = self.row[CURRSIZE_COL]
-        slice_end = self.row[CURRSIZE_COL]
         file_size = os.path.getsize(self.row[SOURCEPATH_COL])
-        if file_size < slice_start:
+        slice_num = math.ceil(file_size / self.row[THRESHOLD_COL])
+        if any(index >= slice_num for index in self.slices):
             self.emit('disk-error', fid)
             return
-        elif file_size == slice_start and slice_start == self.row[SIZE_COL]:
-            self.emit('uploaded', fid)
-            return
-        fh = open(self.row[SOURCEPATH_COL], 'rb')
-        fh.seek(slice_start)
-        while self.row[STATE_COL] == State.UPLOADING:
-            if slice_end >= file_size:
-                self.emit('merge-files', self.row[FID_COL])
+        # 文件在计算md5 之后被修改了, 就不再校验分片
+        if self.slice_md5s and len(self.slice_md5s) != slice_num:
+            self.slice_md5s = None
+        self.pending_slices = collections.deque(
+                index for index in range(slice_num)
+                if index not in self.slices)
+        self.slice_error = False
+        threads = []
+        for i in range(min(self.slice_threads, len(self.pending_slices))):
+            thread = threading.Thread(target=self.upload_slices,
+                                      args=(file_size, ))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+
+        if self.slice_error:
+            self.emit('network-error', fid)
+        elif (self.row[STATE_COL] == State.UPLOADING and
+                len(self.slices) == slice_num):
+            self.emit('merge-files', fid)
+
+    def upload_slices(self, file_size):
+        '''上传分片的线程, 不断从pending_slices 中取出分片并上传'''
+        fid = self.row[FID_COL]
+        threshold = self.row[THRESHOLD_COL]
+        while self.row[STATE_COL] == State.UPLOADING and not self.slice_error:
+            if not self.acquire_conn():
                 break
-            slice_start = slice_end
-            slice_end = min(slice_start + self.row[THRESHOLD_COL], file_size)
-            data = fh.read(slice_end - slice_start)
-            slice_end = slice_start + len(data)
-            info = pcs.slice_upload(self.cookie, data)
+            try:
+                with self.lock:
+                    if not self.pending_slices:
+                        break
+                    index = self.pending_slices.popleft()
+                slice_start = index * threshold
+                slice_end = min(slice_start + threshold, file_size)
+                # 分片数据在发送时才从磁盘读取
+                data = net.FileSlice(self.row[SOURCEPATH_COL], slice_start,
+                                     slice_end - slice_start,
+                                     self.limiter.upload)
+                start_time = time.monotonic()
+                info = pcs.slice_upload(self.cookie, data)
+                if info and 'md5' in info:
+                    self.slice_sizer.add_sample(slice_end - slice_start,
+                                                time.monotonic() - start_time)
+            finally:
+                self.release_conn()
+            if (info and 'md5' in info and self.slice_md5s and
+                    info['md5'] != self.slice_md5s[index]):
+                logger.error('Uploader: md5 of slice %s mismatch, %s' %
+                             (index, self.row[SOURCEPATH_COL]))
+                info = None
             if info and 'md5' in info:
-                self.emit('slice-sent', fid, slice_end, info['md5'])
+                with self.lock:
+                    self.slices.add(index)
+                self.emit('slice-sent', fid, index, slice_end, info['md5'])
             else:
-                self.emit('network-error', fid)
-                break
-        if not fh.closed:
-            fh.close()
-        return
+                self.slice_error = True
 
 GObject.type_register(Uploader)
+
+
+class UploadPreflight(threading.Thread, GObject.GObject):
+    '''上传目录之前的批量预检.
+
+    上传目录时, 如果每个任务都由Uploader 依次检查文件是否存在, 检查并创建
+    目录, 再尝试快速上传, 大量小请求会一个接一个地进行. 这里先由
+    RemotePathCache 批量检查/创建所有用到的目录, 并批量检查文件是否存在;
+    然后用PREFLIGHT_THREADS 个线程为每个文件计算md5 并尝试快速上传.
+    只有没有命中的文件, 才需要交给Uploader 上传文件内容.
+
+    每个任务都会收到且只收到一个结果; 预检出错时, 还没有结果的任务会收到
+    checked(fid, False).
+    '''
+
+    __gsignals__ = {
+        # 文件已存在(upload-mode 为IGNORE) 或者快速上传成功, fid
+        'uploaded': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
+                     (GObject.TYPE_INT, )),
+        # 预检结束, 需要上传文件内容. fid, preflighted
+        # preflighted 为False 时表示预检出错了, Uploader 要重新检查一遍
+        'checked': (GObject.SIGNAL_RUN_LAST, GObject.TYPE_NONE,
+                    (GObject.TYPE_INT, GObject.TYPE_BOOLEAN)),
+    }
+
+    def __init__(self, parent, rows, cookie, tokens):
+        '''
+        parent - UploadPage
+        rows   - 要预检的任务, UploadPage.liststore中的记录
+        '''
+        threading.Thread.__init__(self)
+        GObject.GObject.__init__(self)
+        self.daemon = True
+
+        self.cookie = cookie
+        self.tokens = tokens
+        self.upload_mode = parent.app.profile['upload-mode']
+        self.hash_cache = parent.hash_cache
+        self.path_cache = parent.path_cache
+        self.rows = [row[:] for row in rows]
+        # 读取磁盘的线程数受限, 其余线程可以同时等待网络请求
+        self.hash_sem = threading.Semaphore(hasher.HASH_WORKERS)
+        self.reported = set()  # 已经发出结果的fid
+        self.lock = threading.Lock()
+
+    def report(self, signal, fid, *args):
+        '''发出一个任务的预检结果, 每个任务只发一次'''
+        with self.lock:
+            if fid in self.reported:
+                return
+            self.reported.add(fid)
+        self.emit(signal, fid, *args)
+
+    def run(self):
+        try:
+            self.preflight()
+        except Exception:
+            logger.error(traceback.format_exc())
+        finally:
+            # 出错的任务交给Uploader 重新检查, 不然它们会一直等待预检结束
+            for row in self.rows:
+                self.report('checked', row[FID_COL], False)
+
+    def preflight(self):
+        dir_names = set(os.path.dirname(row[PATH_COL]) for row in self.rows)
+        failed_dirs = self.path_cache.makedirs(self.cookie, self.tokens,
+                                               dir_names)
+        rows = []
+        for row in self.rows:
+            if os.path.dirname(row[PATH_COL]) in failed_dirs:
+                self.report('checked', row[FID_COL], False)
+            else:
+                rows.append(row)
+        if self.upload_mode == UploadMode.IGNORE:
+            exists = self.path_cache.get_exists(
+                    self.cookie, self.tokens, [row[PATH_COL] for row in rows])
+            probe_rows = []
+            for row in rows:
+                state = exists.get(row[PATH_COL])
+                if state is None:
+                    self.report('checked', row[FID_COL], False)
+                elif state:
+                    self.report('uploaded', row[FID_COL])
+                else:
+                    probe_rows.append(row)
+            rows = probe_rows
+        parallel_map(self.check_file, rows)
+
+    def check_file(self, row):
+        fid = row[FID_COL]
+        if row[SIZE_COL] <= SLICE_THRESHOLD:
+            self.report('checked', fid, True)
+            return
+        try:
+            with self.hash_sem:
+                result = self.hash_cache.md5_slices(
+                        row[SOURCEPATH_COL], row[THRESHOLD_COL],
+                        pcs.RAPIDUPLOAD_THRESHOLD)
+        except OSError:
+            # 由Uploader 报告磁盘错误
+            logger.error(traceback.format_exc())
+            self.report('checked', fid, False)
+            return
+        content_md5, head_md5 = result[:2]
+        info = pcs.rapid_upload(self.cookie, self.tokens, row[SOURCEPATH_COL],
+                                row[PATH_COL], self.upload_mode,
+                                content_md5, head_md5)
+        if info and info.get('md5') and info.get('fs_id'):
+            self.report('uploaded', fid)
+        else:
+            self.report('checked', fid, True)
+
+GObject.type_register(UploadPreflight)
+
+
+class RemotePathCache:
+    '''检查远程文件是否存在, 并创建上传时用到的目录, 可以在多个线程中使用.
+
+    每次filemetas 请求最多查询FILEMETAS_BATCH 个路径. 已知存在或者已经
+    创建的目录会被记住, 这样在整个会话中每个目录只会被检查/创建一次;
+    多个Uploader 同时需要同一个目录时, 只有一个线程去处理, 其它的等它完成.
+    '''
+
+    def __init__(self, slice_sizer=None):
+        '''slice_sizer - SliceSizer, 用filemetas 请求的耗时来估计RTT'''
+        self.slice_sizer = slice_sizer
+        self.dirs = set(['/'])  # 已知存在的目录
+        self.pending = {}       # {dir_name: threading.Event}
+        self.lock = threading.Lock()
+
+    def get_exists(self, cookie, tokens, paths):
+        '''批量检查这些路径是否存在.
+
+        返回{path: True/False}, 只包含服务器明确给出了结果的路径. 批量请求
+        失败时, 再逐个查询那些路径; 仍然没有结果的路径不在其中.
+        '''
+        exists = {}
+        paths = list(paths)
+        for i in range(0, len(paths), FILEMETAS_BATCH):
+            batch = paths[i:i+FILEMETAS_BATCH]
+            try:
+                exists.update(self._get_exists(cookie, tokens, batch))
+            except Exception:
+                logger.error(traceback.format_exc())
+        unknown = [path for path in paths if path not in exists]
+        if unknown and len(paths) > 1:
+            def get_exists_one(path):
+                exists.update(self._get_exists(cookie, tokens, [path]))
+            parallel_map(get_exists_one, unknown)
+        return exists
+
+    def _get_exists(self, cookie, tokens, paths):
+        start_time = time.monotonic()
+        meta = pcs.get_metas(cookie, tokens, paths)
+        if not meta:
+            return {}
+        if self.slice_sizer:
+            self.slice_sizer.add_rtt(time.monotonic() - start_time)
+        errno = meta.get('errno')
+        if errno == 0:
+            return {path: True for path in paths}
+        if errno == ERRNO_NOT_FOUND and len(paths) == 1:
+            return {paths[0]: False}
+        # 只要有一个路径不存在, errno 就是ERRNO_PARTIAL, 这时info 中是每个
+        # 路径各自的结果; 其它的errno 说明请求本身出错了, 结果未知
+        info = meta.get('info')
+        if errno != ERRNO_PARTIAL or not info:
+            return {}
+        if len(info) == len(paths):
+            items = zip(paths, info)
+        else:
+            items = [(item.get('path'), item) for item in info]
+        exists = {}
+        for path, item in items:
+            if path not in paths:
+                continue
+            item_errno = item.get('errno', 0)
+            if item_errno == 0:
+                exists[path] = True
+            elif item_errno == ERRNO_NOT_FOUND:
+                exists[path] = False
+        return exists
+
+    def makedirs(self, cookie, tokens, dir_names):
+        '''确保这些目录及它们的父目录都存在, 返回创建失败的目录'''
+        todo = set()
+        for dir_name in dir_names:
+            while dir_name not in todo and dir_name != '/':
+                todo.add(dir_name)
+                dir_name = os.path.dirname(dir_name)
+
+        owned, waiting = [], []
+        with self.lock:
+            for dir_name in todo:
+                if dir_name in self.dirs:
+                    continue
+                event = self.pending.get(dir_name)
+                if event:
+                    waiting.append(event)
+                else:
+                    self.pending[dir_name] = threading.Event()
+                    owned.append(dir_name)
+        # 先等其它线程处理完它们的目录, 这些目录可能是这里要创建的目录的
+        # 父目录. 它们都是更早被认领的, 所以不会互相等待.
+        for event in waiting:
+            event.wait()
+        try:
+            self._makedirs(cookie, tokens, owned)
+        finally:
+            with self.lock:
+                for dir_name in owned:
+                    self.pending.pop(dir_name).set()
+        with self.lock:
+            return set(d for d in todo if d not in self.dirs)
+
+    def _makedirs(self, cookie, tokens, dir_names):
+        if not dir_names:
+            return
+        exists = self.get_exists(cookie, tokens, dir_names)
+        with self.lock:
+            self.dirs.update(d for d in dir_names if exists.get(d))
+        # 只创建确认不存在的目录; 对已存在的目录调用mkdir, 服务器会创建
+        # 一个改名的副本, 比如dir(1). 结果未知的目录被当作创建失败.
+        missing = [d for d in dir_names if exists.get(d) is False]
+        # 按目录深度分层, 父目录先于子目录创建
+        levels = collections.defaultdict(list)
+        for dir_name in missing:
+            levels[dir_name.count('/')].append(dir_name)
+        for depth in sorted(levels):
+            parallel_map(lambda dir_name: self._mkdir(cookie, tokens, dir_name),
+                         levels[depth])
+
+    def _mkdir(self, cookie, tokens, dir_name):
+        with self.lock:
+            # 父目录创建失败了
+            if os.path.dirname(dir_name) not in self.dirs:
+                return
+        info = pcs.mkdir(cookie, tokens, dir_name)
+        if info and info.get('errno', 0) == 0:
+            with self.lock:
+                self.dirs.add(dir_name)
+        else:
+            logger.error('RemotePathCache.mkdir: %s, %s' % (dir_name, info))
+
+
+class SliceSizer:
+    '''根据测量到的上传速度及RTT, 选择新任务的分片大小, 可以在多个线程中使用.
+
+    每个分片都是一次单独的POST 请求, 并在数据库中占一条记录. 网速较快时,
+    小分片的耗时主要花在请求本身上. 这里让每个分片至少上传SLICE_SECONDS
+    秒, 并且至少是RTT 的SLICE_RTT_FACTOR 倍, 再限制在服务器允许的分片数
+    以及分片大小之内. 还没有测量数据时, 使用以前的固定分档.
+    '''
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.bandwidth = 0  # 单个连接的上传速度, bytes/s
+        self.rtt = 0
+
+    def add_rtt(self, seconds):
+        '''记录一个没有上传数据的小请求的耗时'''
+        with self.lock:
+            if self.rtt:
+                self.rtt += SLICE_EWMA * (seconds - self.rtt)
+            else:
+                self.rtt = seconds
+
+    def add_sample(self, size, seconds):
+        '''记录一个分片的大小及上传耗时'''
+        if size < SLICE_MIN_SIZE or seconds <= 0:
+            return
+        with self.lock:
+            bandwidth = size / max(seconds - self.rtt, seconds / 2)
+            if self.bandwidth:
+                self.bandwidth += SLICE_EWMA * (bandwidth - self.bandwidth)
+            else:
+                self.bandwidth = bandwidth
+
+    def get_slice_size(self, file_size, min_slices=1):
+        '''返回分片大小; 文件超出服务器的限制时返回0
+
+        min_slices - 文件至少要被分成这么多片, 以便同时上传多个分片
+        '''
+        with self.lock:
+            bandwidth, rtt = self.bandwidth, self.rtt
+        if bandwidth:
+            seconds = max(SLICE_SECONDS, rtt * SLICE_RTT_FACTOR)
+            slice_size = min(SLICE_MAX_SIZE, int(bandwidth * seconds),
+                             math.ceil(file_size / min_slices))
+            slice_size = max(SLICE_MIN_SIZE, slice_size)
+        elif file_size < 2 ** 27:    # 128M
+            slice_size = 2 ** 17     # 128K
+        elif file_size < 2 ** 29:    # 512M
+            slice_size = 2 ** 19     # 512K
+        else:
+            slice_size = math.ceil(file_size / 1000)
+        slice_size = max(slice_size,
+                         math.ceil(file_size / SERVER_MAX_SLICES))
+        slice_size = math.ceil(slice_size / SLICE_ALIGN) * SLICE_ALIGN
+        if slice_size > SERVER_MAX_SLICE_SIZE:
+            return 0
+        return slice_size
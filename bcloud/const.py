@@ -86,6 +86,13 @@ class SHARE_PERIOD:
 
 DownloadMode = UploadMode
 
+class FsyncMode:
+    '''下载时, 将数据同步到磁盘的方式'''
+    # 不主动同步, 由操作系统决定何时写入磁盘
+    NONE = 0
+    # 每次提交断点续传日志之前, 先同步.part 文件, 然后同步日志
+    JOURNAL = 1
+
 UPLOAD_ONDUP = ('', 'overwrite', 'newcopy')
 
 SHARE_PERIOD_NUM = (0, 1, 7)
@@ -3,6 +3,8 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in http://www.gnu.org/licenses/gpl-3.0.html
 
+import collections
+import heapq
 import json
 import os
 import subprocess
@@ -64,8 +66,16 @@ DEFAULT_PROFILE = {
     'save-dir': Config.HOME_DIR,
     # 同时进行的下载任务数, 1~5
     'concurr-download': 2,
+    # 不超过16M 的小文件另外可以同时下载的任务数, 0~10
+    'concurr-small-download': 2,
     # 下载单个任务的线程数 1~5
     'download-segments': 3,
+    # 根据带宽及延迟自动调整每个任务的线程数, 此时忽略download-segments
+    'download-segments-auto': False,
+    # 每个下载线程的写入缓存, 以字节为单位
+    'download-buffer-size': 1048576,
+    # 下载数据及断点续传日志同步到磁盘的方式, 见const.FsyncMode
+    'download-fsync': 1,
     # 隔5分钟后尝试重新下载
     'retries-each': 5,
     # 60 秒后下载超时
@@ -77,6 +87,16 @@ DEFAULT_PROFILE = {
 
     # 同时进行的上传任务数, 1~5
     'concurr-upload': 2,
+    # 所有上传及下载任务共用的最大连接数
+    'transfer-connections': 16,
+    # 限速, 单位是kB/s, 0 表示不限速
+    'bandwidth-limit': 0,
+    'download-limit': 0,
+    'upload-limit': 0,
+    # 按时间段限速, 见TransferScheduler.BandwidthLimiter
+    'bandwidth-schedule': [],
+    # 上传单个文件时, 同时上传的分片数
+    'upload-slice-threads': 3,
     # 上传隐藏文件.
     'upload-hidden-files': True,
     # 上传时如果服务器端已存在同名文件时的操作方式
@@ -99,6 +119,8 @@ DEFAULT_PROFILE = {
 }
 RETRIES = 3   # 调用keyring模块与libgnome-keyring交互的尝试次数
 AVATAR_UPDATE_INTERVAL = 604800  # 用户头像更新频率, 默认是7天
+PROGRESS_INTERVAL = 250  # 传输进度的刷新间隔, 250毫秒, 即每秒4次
+AGING_INTERVAL = 600  # 任务每等待10分钟, 相当于优先级提高一级
 
 
 def async_call(func, *args, callback=None):
@@ -123,6 +145,269 @@ def async_call(func, *args, callback=None):
     thread.daemon = True
     thread.start()
 
+class ProgressAggregator:
+    '''合并传输线程发出的进度事件, 再定时交给Gtk 主线程处理.
+
+    传输线程调用update() 时只是修改共享的计数器; 有新数据时, 主线程每隔
+    interval 毫秒调用一次callback(key, delta, value, records):
+      * delta - 这段时间内所有delta 的和, 比如收到的数据量;
+      * value - 最后一次的value, 比如已传输的总大小;
+      * records - 这段时间内按顺序收到的所有record, 不能丢失的信息(比如
+        上传分片的md5) 放在这里.
+    这样主线程的回调次数及数据库的写入次数, 不会随传输速度的增加而增加.
+    '''
+
+    def __init__(self, callback, interval=PROGRESS_INTERVAL):
+        self.callback = callback
+        self.interval = interval
+        self.pending = {}  # {key: [delta, value, records]}
+        self.source_id = 0
+        self.lock = threading.Lock()
+
+    def update(self, key, delta=0, value=None, record=None):
+        '''可以在任意线程中调用'''
+        with self.lock:
+            item = self.pending.get(key)
+            if not item:
+                item = self.pending[key] = [0, None, []]
+            item[0] += delta
+            if value is not None:
+                item[1] = value
+            if record is not None:
+                item[2].append(record)
+            if not self.source_id:
+                self.source_id = GLib.timeout_add(self.interval,
+                                                  self.on_timeout)
+
+    def discard(self, key):
+        '''丢弃这个任务尚未处理的进度'''
+        with self.lock:
+            self.pending.pop(key, None)
+
+    def flush(self):
+        '''立即处理所有进度, 只能在主线程中调用'''
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for key, (delta, value, records) in pending.items():
+            self.callback(key, delta, value, records)
+
+    def on_timeout(self):
+        with self.lock:
+            self.source_id = 0
+        self.flush()
+        return False
+
+
+class RowIndex:
+    '''由某一列的值(比如任务的fs_id) 找到ListStore 中的那一行.
+
+    ListStore 的TreeIter 在行被删除之前一直有效, 排序后也是, 所以这里直接
+    保存它们. columns 是要索引的列, get() 默认使用第一个. 要通过append()/
+    remove() 来添加或删除行, 索引才能保持同步; 其它方式删除的行(比如拖动
+    排序, clear()) 会让索引在下次查询时重建.
+
+    如果指定了state_column, 还会按状态把各行分组, 并保持它们在ListStore
+    中的顺序, 这样调度任务时只需访问处于某个状态的任务. 状态的变化由
+    row-changed 信号得到, 所以直接修改row[state_column] 就可以了. 每次
+    变化都会调用state_changed(row, old_state, state), 行被删除时state
+    为None.
+    '''
+
+    def __init__(self, liststore, *columns, state_column=None,
+                 state_changed=None):
+        self.liststore = liststore
+        self.columns = columns
+        self.state_column = state_column
+        self.state_changed = state_changed
+        self.iters = {}   # {column: {key: tree_iter}}
+        # 每个值出现的次数, 有重复时, 与以前的线性查找一样返回第一个
+        self.counts = {}  # {column: Counter}
+        # {state: OrderedDict(key: None)}, key 是第一个索引列的值
+        self.states = collections.defaultdict(collections.OrderedDict)
+        self.key_states = {}  # {key: state}
+        self.dirty = True
+        self.removing = False
+        liststore.connect('row-deleted', self.on_row_deleted)
+        if state_column is not None:
+            liststore.connect('row-changed', self.on_row_changed)
+
+    def append(self, row):
+        tree_iter = self.liststore.append(row)
+        if not self.dirty:
+            for column in self.columns:
+                key = row[column]
+                self.iters[column].setdefault(key, tree_iter)
+                self.counts[column][key] += 1
+            if self.state_column is not None:
+                self.set_state(row)
+        return tree_iter
+
+    def set_state(self, row):
+        key = row[self.columns[0]]
+        state = row[self.state_column]
+        old_state = self.key_states.get(key)
+        if old_state == state:
+            return
+        if old_state is not None:
+            self.states[old_state].pop(key, None)
+        self.states[state][key] = None
+        self.key_states[key] = state
+        if self.state_changed:
+            self.state_changed(row, old_state, state)
+
+    def remove(self, tree_iter):
+        if not self.dirty:
+            row = self.liststore[tree_iter]
+            for column in self.columns:
+                key = row[column]
+                counts = self.counts[column]
+                counts[key] -= 1
+                if counts[key] > 0:
+                    # 还有重复的行, 下次查询时再找到它们
+                    self.dirty = True
+                else:
+                    del counts[key]
+                    self.iters[column].pop(key, None)
+            key = row[self.columns[0]]
+            state = self.key_states.pop(key, None)
+            if state is not None:
+                self.states[state].pop(key, None)
+                if self.state_changed:
+                    self.state_changed(row, state, None)
+        self.removing = True
+        try:
+            self.liststore.remove(tree_iter)
+        finally:
+            self.removing = False
+
+    def get(self, key, column=None):
+        '''返回TreeModelRow, 不存在时返回None'''
+        self.sync()
+        if column is None:
+            column = self.columns[0]
+        tree_iter = self.iters[column].get(key)
+        if tree_iter is None:
+            return None
+        return self.liststore[tree_iter]
+
+    def get_by_state(self, state, limit=None, exclude=()):
+        '''按顺序返回处于这个状态的行, 最多limit 个, 跳过exclude 中的key'''
+        self.sync()
+        rows = []
+        for key in self.states[state]:
+            if limit is not None and len(rows) >= limit:
+                break
+            if key in exclude:
+                continue
+            rows.append(self.get(key))
+        return rows
+
+    def count(self, state):
+        '''处于这个状态的行数'''
+        self.sync()
+        return len(self.states[state])
+
+    def sync(self):
+        '''需要时重建索引, 之后所有行的state_changed 都已被调用过'''
+        if self.dirty:
+            self.rebuild()
+
+    def rebuild(self):
+        self.iters = {column: {} for column in self.columns}
+        self.counts = {column: collections.Counter()
+                       for column in self.columns}
+        self.states.clear()
+        self.key_states = {}
+        for row in self.liststore:
+            for column in self.columns:
+                self.iters[column].setdefault(row[column], row.iter)
+                self.counts[column][row[column]] += 1
+            if self.state_column is not None:
+                self.set_state(row)
+        self.dirty = False
+
+    def on_row_deleted(self, model, tree_path):
+        if not self.removing:
+            self.dirty = True
+
+    def on_row_changed(self, model, tree_path, tree_iter):
+        if self.dirty:
+            return
+        row = model[tree_iter]
+        key = row[self.columns[0]]
+        # 拖动排序时新插入的行, 会在原来的行被删除后重建索引
+        if key in self.key_states:
+            self.set_state(row)
+
+
+class TaskHeap:
+    '''等待中的任务, 按优先级及等待时间排序, 用于代替线性扫描.
+
+    优先级高的先出队, 但每等待aging 秒, 相当于优先级提高一级, 这样低优先级
+    的任务也不会一直等下去. 排序用的是"虚拟加入时间" 加入时间 - 优先级 *
+    aging, 它不随时间变化, 所以可以放在堆里. 被删除或修改的项只在出队时
+    才被丢弃.
+    '''
+
+    def __init__(self, aging=AGING_INTERVAL):
+        self.aging = aging
+        self.heap = []     # [(virtual_time, seq, key), ]
+        self.entries = {}  # {key: (seq, timestamp, priority)}
+        self.seq = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def push(self, key, priority=0, timestamp=None):
+        '''加入任务; 已在队列中的任务会保留原来的加入时间'''
+        entry = self.entries.get(key)
+        if entry:
+            if entry[2] == priority:
+                return
+            timestamp = entry[1]
+        elif timestamp is None:
+            timestamp = time.monotonic()
+        self.seq += 1
+        self.entries[key] = (self.seq, timestamp, priority)
+        heapq.heappush(self.heap,
+                       (timestamp - priority * self.aging, self.seq, key))
+
+    def remove(self, key):
+        self.entries.pop(key, None)
+
+    def pop(self):
+        '''取出排在最前的任务, 队列为空时返回None'''
+        while self.heap:
+            virtual_time, seq, key = heapq.heappop(self.heap)
+            entry = self.entries.get(key)
+            if entry and entry[0] == seq:
+                del self.entries[key]
+                return key
+        return None
+
+    def peek(self, num):
+        '''返回排在最前的num 个任务, 但不取出它们'''
+        items = []
+        while len(items) < num:
+            entry = None
+            key = None
+            while self.heap:
+                item = heapq.heappop(self.heap)
+                entry = self.entries.get(item[2])
+                if entry and entry[0] == item[1]:
+                    key = item[2]
+                    items.append(item)
+                    break
+            if key is None:
+                break
+        for item in items:
+            heapq.heappush(self.heap, item)
+        return [item[2] for item in items]
+
+
 def xdg_open(uri):
     '''使用桌面环境中默认的程序打开指定的URI
     
@@ -5,9 +5,17 @@
 
 import hashlib
 import os
+from queue import Queue
+import sqlite3
+import threading
+import traceback
 import zlib
 
+from bcloud.log import logger
+
 CHUNK = 2 ** 20
+# 后台计算md5 的线程数, 瓶颈通常在磁盘, 所以不需要太多
+HASH_WORKERS = min(2, os.cpu_count() or 1)
 
 
 def crc(path):
@@ -39,6 +47,173 @@ def md5(path, start=0, stop=-1):
     fh.close()
     return _md5.hexdigest()
 
+def md5_slices(path, slice_size, head_size=0):
+    '''只读取一遍文件, 同时算出整个文件的md5, 开头head_size 字节的md5, 以及
+    每个长度为slice_size 的分片的md5.
+
+    返回(content_md5, head_md5, slice_md5s), slice_md5s 是按顺序排列的
+    分片md5 列表.
+    '''
+    content_md5 = hashlib.md5()
+    head_md5 = hashlib.md5()
+    slice_md5s = []
+    _slice_md5 = hashlib.md5()
+    pos = 0
+    slice_pos = 0
+    fh = open(path, 'rb')
+    while True:
+        chunk = fh.read(CHUNK)
+        if not chunk:
+            break
+        content_md5.update(chunk)
+        if pos < head_size:
+            head_md5.update(chunk[:head_size - pos])
+        pos += len(chunk)
+        view = memoryview(chunk)
+        while view:
+            size = min(len(view), slice_size - slice_pos)
+            _slice_md5.update(view[:size])
+            view = view[size:]
+            slice_pos += size
+            if slice_pos == slice_size:
+                slice_md5s.append(_slice_md5.hexdigest())
+                _slice_md5 = hashlib.md5()
+                slice_pos = 0
+    fh.close()
+    if slice_pos:
+        slice_md5s.append(_slice_md5.hexdigest())
+    return content_md5.hexdigest(), head_md5.hexdigest(), slice_md5s
+
+class HashCache:
+    '''保存在SQLite 里的md5_slices() 结果.
+
+    以文件的(st_dev, st_ino) 为键, 同时记录文件的大小及st_mtime_ns, 它们
+    变化之后缓存就会失效. 这样已经计算过的文件, 再次上传或同步时只需要
+    一次stat(), 而不用重新读取整个文件. 可以在多个线程中使用.
+    '''
+
+    def __init__(self, db_path):
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+        self.conn.execute('''CREATE TABLE IF NOT EXISTS hashes (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        head_size INTEGER NOT NULL,
+        slice_size INTEGER NOT NULL,
+        content_md5 CHAR NOT NULL,
+        head_md5 CHAR NOT NULL,
+        slice_md5s TEXT NOT NULL,
+        PRIMARY KEY (dev, ino)
+        )
+        ''')
+        self.conn.commit()
+
+    def get(self, path, slice_size, head_size=0):
+        '''返回缓存的(content_md5, head_md5, slice_md5s), 没有的话返回None'''
+        stat = os.stat(path)
+        try:
+            with self.lock:
+                req = self.conn.execute(
+                        '''SELECT size, mtime_ns, head_size, slice_size,
+                        content_md5, head_md5, slice_md5s FROM hashes
+                        WHERE dev=? AND ino=?''', (stat.st_dev, stat.st_ino))
+                record = req.fetchone()
+                if not record:
+                    return None
+                if (record[0] != stat.st_size or
+                        record[1] != stat.st_mtime_ns):
+                    self.conn.execute(
+                            'DELETE FROM hashes WHERE dev=? AND ino=?',
+                            (stat.st_dev, stat.st_ino))
+                    self.conn.commit()
+                    return None
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+            return None
+        if record[2] != head_size or record[3] != slice_size:
+            return None
+        slice_md5s = record[6].split(',') if record[6] else []
+        return record[4], record[5], slice_md5s
+
+    def md5_slices(self, path, slice_size, head_size=0):
+        '''与md5_slices() 相同, 但会先查询缓存'''
+        result = self.get(path, slice_size, head_size)
+        if result:
+            return result
+        stat = os.stat(path)
+        result = md5_slices(path, slice_size, head_size)
+        # 计算过程中文件被修改了, 结果就不能被缓存
+        if os.stat(path).st_mtime_ns != stat.st_mtime_ns:
+            return result
+        sql = 'INSERT OR REPLACE INTO hashes VALUES(?,?,?,?,?,?,?,?,?)'
+        try:
+            with self.lock:
+                self.conn.execute(sql, (stat.st_dev, stat.st_ino, stat.st_size,
+                        stat.st_mtime_ns, head_size, slice_size, result[0],
+                        result[1], ','.join(result[2])))
+                self.conn.commit()
+        except sqlite3.Error:
+            logger.error(traceback.format_exc())
+        return result
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+
+class HashPool:
+    '''在后台线程中计算文件的md5_slices(), 结果存入HashCache.
+
+    hashlib 在计算时会释放GIL, 所以几个线程就可以同时使用多个CPU 核心.
+    每个文件计算完成后, 在工作线程中调用callback(key, error); 缓存中已有
+    结果的文件不会被重新计算, 很快就会完成.
+    '''
+
+    def __init__(self, hash_cache, workers=HASH_WORKERS):
+        self.hash_cache = hash_cache
+        self.queue = Queue()
+        self.pending = set()
+        self.lock = threading.Lock()
+        self.threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self.run)
+            thread.daemon = True
+            thread.start()
+            self.threads.append(thread)
+
+    def submit(self, key, path, slice_size, head_size, callback):
+        '''把文件加入计算队列, 已经在队列中的key 会被忽略'''
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
+        self.queue.put((key, path, slice_size, head_size, callback))
+
+    def run(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                break
+            key, path, slice_size, head_size, callback = job
+            error = None
+            try:
+                self.hash_cache.md5_slices(path, slice_size, head_size)
+            except Exception:
+                error = traceback.format_exc()
+                logger.error(error)
+            finally:
+                # 无论成败都要通知调用者, 否则任务会一直等待
+                with self.lock:
+                    self.pending.discard(key)
+                callback(key, error)
+
+    def stop(self):
+        for thread in self.threads:
+            self.queue.put(None)
+
+
 def sha1(path):
     _sha1 = hashlib.sha1()
     fh = open(path, 'rb')
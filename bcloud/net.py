@@ -3,11 +3,16 @@
 # Use of this source code is governed by GPLv3 license that can be found
 # in http://www.gnu.org/licenses/gpl-3.0.html
 
+import base64
 import gzip
 import http
 import http.client
 import mimetypes
 import os
+import select
+import ssl
+import threading
+import time
 import traceback
 import urllib.parse
 import urllib.request
@@ -19,6 +24,16 @@ from bcloud.log import logger
 RETRIES = 3
 TIMEOUT = 50
 DEBUG = 0
+POOL_MAXSIZE = 6        # 每个主机最多保留的空闲连接数
+POOL_IDLE_TIMEOUT = 30  # 空闲连接超过30秒后就被丢弃
+MAX_REDIRECTS = 5
+# 这些HTTP错误码的响应会被正常返回, 其它的错误码会抛出异常
+ACCEPTED_ERROR_CODES = (400, 403, 500)
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+CHUNK_SIZE = 2 ** 16    # 上传文件时每次读取的数据大小
+# 上传文件时, 如果是http 连接, 就使用sendfile() 直接把文件从页缓存发送到
+# socket, 而不用先复制到用户空间; https 连接总是使用普通的写入方式.
+UPLOAD_SENDFILE = True
 
 default_headers = {
     'User-agent': const.USER_AGENT,
@@ -31,6 +46,204 @@ default_headers = {
     'Cache-control': 'no-cache',
 }
 
+
+class ConnectionPool:
+    '''按主机分组的HTTP/1.1 长连接池, 可被多个线程共用.
+
+    只有完整读取了响应, 并且服务器没有要求关闭的连接, 才会被放回池中.
+    每个主机最多保留maxsize 个空闲连接, 空闲超过idle_timeout 秒或者已被
+    服务器关闭的连接, 在取出时会被丢弃.
+
+    连接池只限制空闲连接的数量, 不限制同时使用中的连接数: get() 在没有
+    空闲连接时总是新建一个. 上传及下载的并发连接数由TransferScheduler
+    控制, 其它请求的连接数不会超过发出请求的线程数.
+    '''
+
+    def __init__(self, maxsize=POOL_MAXSIZE, idle_timeout=POOL_IDLE_TIMEOUT):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.conns = {}  # {(scheme, netloc): [(conn, last_used), ]}
+
+    def get(self, scheme, netloc, timeout=TIMEOUT):
+        '''取出一个可用的连接, 如果没有的话, 就新建一个'''
+        key = (scheme, netloc)
+        now = time.time()
+        with self.lock:
+            idle_conns = self.conns.get(key)
+            while idle_conns:
+                conn, last_used = idle_conns.pop()
+                if (now - last_used < self.idle_timeout and
+                        not is_conn_dropped(conn)):
+                    conn.timeout = timeout
+                    conn.reused = True
+                    if conn.sock:
+                        conn.sock.settimeout(timeout)
+                    return conn
+                conn.close()
+        return new_connection(scheme, netloc, timeout)
+
+    def put(self, conn, resp=None):
+        '''将连接放回池中.
+
+        resp - 这个连接上最后一个响应, 它必须已被完整读取.
+        '''
+        if (conn.sock is None or resp is None or resp.will_close or
+                not resp.isclosed()):
+            conn.close()
+            return
+        key = (getattr(conn, 'pool_scheme', ''), getattr(conn, 'pool_netloc', ''))
+        with self.lock:
+            idle_conns = self.conns.setdefault(key, [])
+            if len(idle_conns) >= self.maxsize:
+                conn.close()
+            else:
+                idle_conns.append((conn, time.time()))
+
+    def clear(self):
+        '''关闭所有空闲连接'''
+        with self.lock:
+            for idle_conns in self.conns.values():
+                for conn, last_used in idle_conns:
+                    conn.close()
+            self.conns.clear()
+
+
+def is_conn_dropped(conn):
+    '''空闲连接上如果有数据可读, 说明它已被服务器关闭(或者状态异常)'''
+    if conn.sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([conn.sock], [], [], 0)
+        return bool(readable)
+    except (OSError, ValueError):
+        return True
+
+def new_connection(scheme, netloc, timeout=TIMEOUT):
+    '''新建一个HTTP(S)Connection, 会使用系统设定的代理服务器'''
+    proxies = urllib.request.getproxies()
+    host = netloc.rsplit('@', 1)[-1].split(':')[0]
+    proxy = proxies.get(scheme)
+    if proxy and urllib.request.proxy_bypass(host):
+        proxy = None
+    proxy_headers = {}
+    if proxy:
+        if '://' not in proxy:
+            proxy = 'http://' + proxy
+        proxy_url = urllib.parse.urlparse(proxy)
+        # 代理服务器的地址里可能带有用户名和密码, 它们要放在
+        # Proxy-Authorization 里, 而不是连接的主机名中
+        if proxy_url.username is not None:
+            credentials = '{0}:{1}'.format(
+                    urllib.parse.unquote(proxy_url.username),
+                    urllib.parse.unquote(proxy_url.password or ''))
+            proxy_headers['Proxy-Authorization'] = 'Basic ' + \
+                    base64.b64encode(credentials.encode()).decode()
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(
+                    proxy_url.hostname, proxy_url.port, timeout=timeout)
+            conn.set_tunnel(netloc, headers=proxy_headers)
+            proxy_headers = {}
+        else:
+            conn = http.client.HTTPConnection(
+                    proxy_url.hostname, proxy_url.port, timeout=timeout)
+    elif scheme == 'https':
+        conn = http.client.HTTPSConnection(netloc, timeout=timeout)
+    else:
+        conn = http.client.HTTPConnection(netloc, timeout=timeout)
+    conn.pool_scheme = scheme
+    conn.pool_netloc = netloc
+    # http 代理要求每个请求都带上认证信息, https 的放在CONNECT 请求里
+    conn.proxy_headers = proxy_headers
+    return conn
+
+_pool = ConnectionPool()
+
+def get_pool():
+    return _pool
+
+def request(method, url, headers, body=None, timeout=TIMEOUT,
+            redirect=True, preload=True, check_status=True):
+    '''通过连接池发送一个请求, 并返回HTTPResponse.
+
+    redirect - 是否自动处理重定向
+    preload  - 是否读取完整的响应数据, 并放到resp.data 里.
+               只有读取完整的响应后, 连接才能被复用.
+    check_status - 与urllib 一样, 除了ACCEPTED_ERROR_CODES 之外的HTTP 错误,
+                   都会抛出http.client.HTTPException.
+    '''
+    for i in range(MAX_REDIRECTS + 1):
+        schema = urllib.parse.urlparse(url)
+        conn = _pool.get(schema.scheme, schema.netloc, timeout)
+        try:
+            try:
+                send_request(conn, method, url, body, headers)
+                resp = conn.getresponse()
+            except (http.client.RemoteDisconnected, ConnectionResetError,
+                    BrokenPipeError):
+                # 复用的连接可能恰好被服务器关闭了, 换一个新连接重试一次
+                if not getattr(conn, 'reused', False):
+                    raise
+                conn.close()
+                conn = new_connection(schema.scheme, schema.netloc, timeout)
+                send_request(conn, method, url, body, headers)
+                resp = conn.getresponse()
+            resp.url = url
+            resp.code = resp.status
+            if preload or (redirect and resp.status in REDIRECT_CODES):
+                resp.data = resp.read()
+                _pool.put(conn, resp)
+        except:
+            conn.close()
+            raise
+
+        if redirect and resp.status in REDIRECT_CODES:
+            location = resp.getheader('Location')
+            if not location:
+                return resp
+            url = urllib.parse.urljoin(url, location)
+            if resp.status in (301, 302, 303) and method == 'POST':
+                method = 'GET'
+                body = None
+            continue
+        if (check_status and resp.status >= 400 and
+                resp.status not in ACCEPTED_ERROR_CODES):
+            raise http.client.HTTPException('HTTP Error %d: %s, %s' %
+                                            (resp.status, resp.reason, url))
+        return resp
+    raise http.client.HTTPException('Too many redirects: %s' % url)
+
+def send_request(conn, method, url, body, headers):
+    '''发送请求头及请求体.
+
+    MultipartBody 会被直接写入socket, 见MultipartBody.send().
+    '''
+    proxy_headers = getattr(conn, 'proxy_headers', None)
+    if proxy_headers:
+        headers = dict(headers, **proxy_headers)
+    if not isinstance(body, MultipartBody):
+        conn.request(method, url, body=body, headers=headers)
+        return
+    header_names = frozenset(key.lower() for key in headers)
+    conn.putrequest(method, url,
+                    skip_host='host' in header_names,
+                    skip_accept_encoding='accept-encoding' in header_names)
+    for key, value in headers.items():
+        conn.putheader(key, value)
+    if 'content-length' not in header_names:
+        conn.putheader('Content-Length', str(len(body)))
+    conn.endheaders()
+    body.send(conn.sock)
+
+def decompress(resp):
+    '''根据Content-encoding 解压resp.data'''
+    encoding = resp.getheader('Content-encoding')
+    if encoding == 'gzip':
+        resp.data = gzip.decompress(resp.data)
+    elif encoding == 'deflate':
+        resp.data = zlib.decompress(resp.data, -zlib.MAX_WBITS)
+    return resp
+
 def urloption(url, headers={}, retries=RETRIES):
     '''发送OPTION 请求'''
     if DEBUG:
@@ -43,15 +256,13 @@ def urloption(url, headers={}, retries=RETRIES):
     headers_merged = default_headers.copy()
     for key in headers.keys():
         headers_merged[key] = headers[key]
-    schema = urllib.parse.urlparse(url)
     for i in range(retries):
         try:
             if DEBUG and i > 0:
                 logger.debug('net.urloption: retried, %d' % i)
 
-            conn = http.client.HTTPConnection(schema.netloc)
-            conn.request('OPTIONS', url, headers=headers_merged)
-            resp = conn.getresponse()
+            resp = request('OPTIONS', url, headers_merged, redirect=False,
+                           check_status=False)
 
             if DEBUG:
                 logger.debug('net.urloption: > STATUS: %d %s ' %
@@ -69,16 +280,11 @@ def urloption(url, headers={}, retries=RETRIES):
     return None
 
 
-class ForbiddenHandler(urllib.request.HTTPErrorProcessor):
-
-    def http_error_403(self, req, fp, code, msg, headers):
-        return fp
-
-    http_error_400 = http_error_403
-    http_error_500 = http_error_403
-
-
 def urlopen_simple(url, retries=RETRIES, timeout=TIMEOUT):
+    '''打开一个http连接, 但不读取响应的内容.
+
+    返回的响应独占这个连接, 它不会被放回连接池.
+    '''
     if DEBUG:
         logger.debug('net.urlopen_simple: %s' % url)
 
@@ -87,9 +293,8 @@ def urlopen_simple(url, retries=RETRIES, timeout=TIMEOUT):
             if DEBUG and i > 0:
                 logger.debug('net.urlopen_simple: retried, %d' % i)
 
-            opener = urllib.request.build_opener(ForbiddenHandler)
-            opener.addheaders = [(k, v) for k,v in default_headers.items()]
-            return opener.open(url, timeout=timeout)
+            return request('GET', url, default_headers, timeout=timeout,
+                           preload=False)
         except OSError:
             logger.error(traceback.format_exc())
             
@@ -121,20 +326,19 @@ def urlopen(url, headers={}, data=None, retries=RETRIES, timeout=TIMEOUT):
     headers_merged = default_headers.copy()
     for key in headers.keys():
         headers_merged[key] = headers[key]
-    opener = urllib.request.build_opener(ForbiddenHandler)
-    opener.addheaders = [(k, v) for k,v in headers_merged.items()]
+    if data is not None:
+        method = 'POST'
+        if 'content-type' not in (key.lower() for key in headers_merged):
+            headers_merged['Content-type'] = const.CONTENT_FORM
+    else:
+        method = 'GET'
     for i in range(retries):
         try:
             if DEBUG and i > 0:
                 logger.debug('net.urlopen: retried, %d' % i)
 
-            req = opener.open(url, data=data, timeout=timeout)
-            encoding = req.headers.get('Content-encoding')
-            req.data = req.read()
-            if encoding == 'gzip':
-                req.data = gzip.decompress(req.data)
-            elif encoding == 'deflate':
-                req.data = zlib.decompress(req.data, -zlib.MAX_WBITS)
+            req = decompress(request(method, url, headers_merged, body=data,
+                                     timeout=timeout))
 
             if DEBUG:
                 logger.debug('net.urlopen: > STATUS: %d %s' %
@@ -156,6 +360,7 @@ def urlopen_without_redirect(url, headers={}, data=None, retries=RETRIES):
 
     使用这个函数可以返回URL重定向(Error 301/302)后的地址, 也可以重到URL中请
     求的文件的大小, 或者Header中的其它认证信息.
+    响应的内容会被完整读取到resp.data 里, 以便连接可以被复用.
     '''
     if DEBUG:
         logger.debug('net.urlopen_without_redirect: < URL: %s' % url)
@@ -169,21 +374,17 @@ def urlopen_without_redirect(url, headers={}, data=None, retries=RETRIES):
     headers_merged = default_headers.copy()
     for key in headers.keys():
         headers_merged[key] = headers[key]
-    parse_result = urllib.parse.urlparse(url)
     for i in range(retries):
         try:
             if DEBUG and i > 0:
                 logger.debug('net.urlopen_without_redirect: retried, %d' % i)
 
-            if parse_result.scheme == 'https':
-                conn = http.client.HTTPSConnection(parse_result.netloc)
-            else:
-                conn = http.client.HTTPConnection(parse_result.netloc)
             if data:
-                conn.request('POST', url, body=data, headers=headers_merged)
+                resp = request('POST', url, headers_merged, body=data,
+                               redirect=False, check_status=False)
             else:
-                conn.request('GET', url, body=data, headers=headers_merged)
-            resp = conn.getresponse()
+                resp = request('GET', url, headers_merged, redirect=False,
+                               check_status=False)
 
             if DEBUG:
                 logger.debug('net.urlopen_without_redirect: > STATUS: %d %s' %
@@ -202,7 +403,6 @@ def urlopen_without_redirect(url, headers={}, data=None, retries=RETRIES):
 
 def post_multipart(url, headers, fields, files, retries=RETRIES):
     content_type, body = encode_multipart_formdata(fields, files)
-    schema = urllib.parse.urlparse(url)
 
     headers_merged = default_headers.copy()
     for key in headers.keys():
@@ -224,15 +424,8 @@ def post_multipart(url, headers, fields, files, retries=RETRIES):
             if DEBUG and i > 0:
                 logger.debug('net.post_multipart: retried, %d' % i)
 
-            h = http.client.HTTPConnection(schema.netloc)
-            h.request('POST', url, body=body, headers=headers_merged)
-            req = h.getresponse()
-            encoding = req.getheader('Content-encoding')
-            req.data = req.read()
-            if encoding == 'gzip':
-                req.data = gzip.decompress(req.data)
-            elif encoding == 'deflate':
-                req.data = zlib.decompress(req.data, -zlib.MAX_WBITS)
+            req = decompress(request('POST', url, headers_merged, body=body,
+                                     redirect=False, check_status=False))
 
             if DEBUG:
                 logger.debug('net.post_multipart: > STATUS: %d %s' %
@@ -249,12 +442,100 @@ def post_multipart(url, headers, fields, files, retries=RETRIES):
             #return None
     return None
 
+
+class FileSlice:
+    '''文件中的一段数据.
+
+    上传时按需从磁盘读取, 而不用把它一次性读入内存.
+    length 为-1 时, 表示一直到文件末尾.
+    throttle - 用于限速, 每发送一块数据之前, 都会以它的大小调用throttle().
+    '''
+
+    def __init__(self, path, offset=0, length=-1, throttle=None):
+        self.path = path
+        self.offset = offset
+        if length < 0:
+            length = os.path.getsize(path) - offset
+        self.length = length
+        self.throttle = throttle
+
+    def __len__(self):
+        return self.length
+
+    def read_chunks(self, chunk_size=CHUNK_SIZE):
+        remaining = self.length
+        with open(self.path, 'rb') as fh:
+            fh.seek(self.offset)
+            while remaining > 0:
+                size = min(chunk_size, remaining)
+                if self.throttle:
+                    self.throttle(size)
+                chunk = fh.read(size)
+                if not chunk:
+                    raise OSError('FileSlice: unexpected EOF, %s' % self.path)
+                remaining -= len(chunk)
+                yield chunk
+
+    def send(self, sock):
+        '''把这段数据写入socket.
+
+        对于http 连接, 使用sendfile(), 数据不经过用户空间;
+        否则就分块读取后再写入.
+        '''
+        if UPLOAD_SENDFILE and not isinstance(sock, ssl.SSLSocket):
+            # 限速时分块发送
+            step = CHUNK_SIZE if self.throttle else self.length
+            sent = 0
+            with open(self.path, 'rb') as fh:
+                while sent < self.length:
+                    size = min(step, self.length - sent)
+                    if self.throttle:
+                        self.throttle(size)
+                    count = sock.sendfile(fh, self.offset + sent, size)
+                    if not count:
+                        break
+                    sent += count
+            if sent != self.length:
+                raise OSError('FileSlice: unexpected EOF, %s' % self.path)
+        else:
+            for chunk in self.read_chunks():
+                sock.sendall(chunk)
+
+
+class MultipartBody:
+    '''流式的multipart/form-data 请求体.
+
+    parts 里的每一项是bytes 或者FileSlice, 它的长度可以预先算出来, 用于
+    Content-Length; 每次发送都会重新读取文件, 所以请求可以被重试.
+    '''
+
+    def __init__(self, parts):
+        self.parts = parts
+
+    def __len__(self):
+        return sum(len(part) for part in self.parts)
+
+    def send(self, sock):
+        '''依次写入multipart 头, 文件数据及结尾'''
+        for part in self.parts:
+            if isinstance(part, FileSlice):
+                part.send(sock)
+            else:
+                sock.sendall(part)
+
+
 def encode_multipart_formdata(fields, files):
+    '''生成multipart/form-data 请求体.
+
+    files 里每一项是(key, filename, content), content 可以是bytes, 也可以
+    是一个FileSlice. 返回的body 是一个MultipartBody.
+    '''
     BOUNDARY = b'----------ThIs_Is_tHe_bouNdaRY_$'
     S_BOUNDARY = b'--' + BOUNDARY
     E_BOUNARY = S_BOUNDARY + b'--'
     CRLF = b'\r\n'
     BLANK = b''
+    parts = []
     l = []
     for (key, value) in fields:
         l.append(S_BOUNDARY)
@@ -268,10 +549,14 @@ def encode_multipart_formdata(fields, files):
             'Content-Disposition: form-data; name="{0}"; filename="{1}"'.format(
                 key, filename).encode())
         l.append(BLANK)
-        l.append(content)
+        # 文件内容之前的部分
+        parts.append(CRLF.join(l) + CRLF)
+        parts.append(content)
+        l = [BLANK]
     l.append(E_BOUNARY)
     l.append(BLANK)
-    body = CRLF.join(l)
+    parts.append(CRLF.join(l))
+    body = MultipartBody(parts)
     content_type = 'multipart/form-data; boundary={0}'.format(BOUNDARY.decode())
     return content_type, body
 
@@ -9,7 +9,10 @@
 
 import json
 import os
+from queue import Queue, Empty
 import re
+import threading
+import traceback
 
 from lxml import html
 from lxml.cssselect import CSSSelector as CSS
@@ -24,6 +27,8 @@ from bcloud.RequestCookie import RequestCookie
 from bcloud import util
 
 RAPIDUPLOAD_THRESHOLD = 256 * 1024  # 256K
+WALK_THREADS = 8      # 遍历远程目录时, 同时发出的请求数
+WALK_PAGES_AHEAD = 4  # 目录的一页已满时, 同时请求之后的几页
 
 
 def get_quota(cookie, tokens):
@@ -558,6 +563,81 @@ def list_dir_all(cookie, tokens, path):
         pcs_files.extend(content['list'])
         page = page + 1
 
+def walk_dir(cookie, tokens, paths, threads=WALK_THREADS, num=100):
+    '''广度优先遍历远程目录paths, 并行地获取各个目录以及它们的分页.
+
+    这是一个生成器, 每得到一页就返回(path, pcs_files), pcs_files 只包含
+    这一页中的文件, 子目录会被继续遍历; 目录获取失败时pcs_files 为None.
+    这样调用者可以一边遍历一边开始下载.
+
+    子目录一被发现就加入队列, 不用等父目录的所有页都返回. 不知道一个目录
+    有几页, 所以某一页满了之后, 会同时请求之后的WALK_PAGES_AHEAD 页, 超出
+    的页返回的是空列表.
+    '''
+    def worker():
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            path, page = job
+            content = None
+            try:
+                content = list_dir(cookie, tokens, path, page, num)
+            except Exception:
+                logger.error(traceback.format_exc())
+            finally:
+                # 无论成败都要返回结果, 否则生成器会一直等待这一页
+                results.put((path, page, content))
+
+    def request(path, first_page, last_page):
+        nonlocal pending
+        for page in range(first_page, last_page + 1):
+            jobs.put((path, page))
+            pending += 1
+        last_pages[path] = last_page
+
+    jobs = Queue()
+    results = Queue()
+    last_pages = {}  # {path: 已请求的最大页码}
+    failed = set()
+    pending = 0
+    for i in range(threads):
+        thread = threading.Thread(target=worker)
+        thread.daemon = True
+        thread.start()
+    try:
+        for path in paths:
+            if path not in last_pages:
+                request(path, 1, 1)
+        while pending:
+            path, page, content = results.get()
+            pending -= 1
+            if path in failed:
+                continue
+            if not content or 'list' not in content:
+                failed.add(path)
+                yield (path, None)
+                continue
+            if len(content['list']) >= num and page == last_pages[path]:
+                request(path, page + 1, page + WALK_PAGES_AHEAD)
+            pcs_files = []
+            for pcs_file in content['list']:
+                if not pcs_file['isdir']:
+                    pcs_files.append(pcs_file)
+                elif pcs_file['path'] not in last_pages:
+                    request(pcs_file['path'], 1, 1)
+            if pcs_files:
+                yield (path, pcs_files)
+    finally:
+        # 提前结束遍历时, 丢掉还没有开始的请求
+        while True:
+            try:
+                jobs.get_nowait()
+            except Empty:
+                break
+        for i in range(threads):
+            jobs.put(None)
+
 def list_dir(cookie, tokens, path, page=1, num=100):
     '''得到一个目录中的所有文件的信息(最多100条记录).'''
     timestamp = util.timestamp()
@@ -811,6 +891,20 @@ def get_download_link(cookie, path):
     '''获取文件的下载链接.
 
     path - 一个文件的绝对路径.
+    只返回排名最靠前的那个链接, 见get_download_links().
+    '''
+    urls, rank_param = get_download_links(cookie, path)
+    if urls:
+        return urls[0]
+    else:
+        return None
+
+def get_download_links(cookie, path):
+    '''获取文件的所有下载链接(mirror).
+
+    path - 一个文件的绝对路径.
+    返回(urls, rank_param), urls 是按rank 排好序的链接列表, rank_param 用于
+    控制在各个mirror 间切换的策略. 如果失败, 返回([], None).
 
     API返回的数据：
     {"client_ip":"xxxxxx","urls":[{"url":"xxxxxx","rank":1},{"url":"xxxxxx","rank":2}],"rank_param":{"max_continuous_failure":30,"bak_rank_slice_num":20},"sl":78,"max_timeout":30,"min_timeout":20,"request_id":xxxxxx}}
@@ -833,12 +927,13 @@ def get_download_link(cookie, path):
     if req:
         info = json.loads(req.data.decode())
         if info and 'urls' in info and len(info['urls']) >= 1:
-            return info['urls'][0]['url']
+            urls = sorted(info['urls'], key=lambda u: u.get('rank', 0))
+            return [u['url'] for u in urls], info.get('rank_param')
         else:
-            logger.error('pcs.get_download_link(): %s' % info)
-            return None
+            logger.error('pcs.get_download_links(): %s' % info)
+            return [], None
     else:
-        return None
+        return [], None
 
 def batch_download(cookie, tokens, fidlist):
     '''批量下载多个文件, 需要timestamp和sign参数.
@@ -907,13 +1002,14 @@ def get_streaming_playlist(cookie, path, video_type='M3U8_AUTO_480'):
 #    else:
 #        return None
 
-def upload(cookie, source_path, path, upload_mode):
+def upload(cookie, source_path, path, upload_mode, throttle=None):
     '''上传一个文件.
 
     这个是使用的网页中的上传接口.
     upload_mode - const.UploadMode, 如果文件已在服务器上存在:
       * overwrite, 直接将其重写.
       * newcopy, 保留原先的文件, 并在新上传的文件名尾部加上当前时间戳.
+    throttle - 用于限速, 见net.FileSlice.
     '''
     ondup = const.UPLOAD_ONDUP[upload_mode]
     dir_name, file_name = os.path.split(path)
@@ -925,10 +1021,9 @@ def upload(cookie, source_path, path, upload_mode):
         '&filename=', encoder.encode_uri_component(file_name),
         '&', cookie.sub_output('BDUSS'),
     ])
-    with open(source_path, 'rb') as fh:
-        data = fh.read()
     fields = []
-    files = [('file', file_name, data)]
+    files = [('file', file_name, net.FileSlice(source_path,
+                                               throttle=throttle))]
     headers = {'Accept': const.ACCEPT_HTML, 'Origin': const.PAN_URL}
     req = net.post_multipart(url, headers, fields, files)
     if req:
@@ -936,14 +1031,21 @@ def upload(cookie, source_path, path, upload_mode):
     else:
         return None
 
-def rapid_upload(cookie, tokens, source_path, path, upload_mode):
-    '''快速上传'''
+def rapid_upload(cookie, tokens, source_path, path, upload_mode,
+                 content_md5=None, slice_md5=None):
+    '''快速上传
+
+    content_md5 - 整个文件的md5, slice_md5 - 文件开头RAPIDUPLOAD_THRESHOLD
+    字节的md5. 如果调用者已经算出了它们, 就不用再读取一遍文件.
+    '''
     ondup = const.UPLOAD_ONDUP[upload_mode]
     content_length = os.path.getsize(source_path)
     assert content_length > RAPIDUPLOAD_THRESHOLD, 'file size is not satisfied!'
     dir_name, file_name = os.path.split(path)
-    content_md5 = hasher.md5(source_path)
-    slice_md5 = hasher.md5(source_path, 0, RAPIDUPLOAD_THRESHOLD)
+    if not content_md5:
+        content_md5 = hasher.md5(source_path)
+    if not slice_md5:
+        slice_md5 = hasher.md5(source_path, 0, RAPIDUPLOAD_THRESHOLD)
     url = ''.join([
         const.PCS_URL_C,
         'file?method=rapidupload&app_id=250528',
@@ -969,7 +1071,8 @@ def slice_upload(cookie, data):
     分片上传完成后, 会返回这个分片的MD5, 用于最终的文件合并.
     如果上传失败, 需要重新上传.
     不需要指定上传路径, 上传后的数据会被存储在服务器的临时目录里.
-    data - 这个文件分片的数据.
+    data - 这个文件分片的数据, 可以是bytes, 也可以是一个net.FileSlice,
+           后者会在上传时才从磁盘读取.
     '''
     url = ''.join([
         const.PCS_URL_C,